@@ -0,0 +1,185 @@
+"""asyncio server core, used with server_mode = asyncio.
+
+Connections, request parsing and socket writes are handled by one event
+loop. Each request is still dispatched by TivoHTTPHandler, unchanged, on a
+thread from a small executor, since plugins do blocking metadata work.
+Video transfers hand their body back to the loop (see
+TivoHTTPHandler.defer_body), so a stream holds no thread while it runs:
+files go out with loop.sendfile() and transcodes read ffmpeg through
+asyncio.create_subprocess_exec(), with writes throttled by drain().
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import re
+from typing import Any, Callable, Optional, Set, Tuple
+
+from pytivo.httpserver import REQUEST_LINE_TIMEOUT, TivoHTTPHandler, TivoServerBase
+from pytivo.pytivo_types import Bdict
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_LENGTH = re.compile(rb"^content-length:\s*(\d+)\s*$", re.I | re.M)
+
+MAX_HEADER_SIZE = 0x10000
+MAX_BODY_SIZE = 0x100000
+
+# How long shutdown waits for open connections to wind down.
+SHUTDOWN_TIMEOUT = 5
+
+
+class LoopWriter(io.RawIOBase):
+    """Write end of a connection for code running outside the event loop.
+    Each write waits until the loop has drained the transport, so a slow
+    client slows the writer rather than filling memory."""
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter
+    ) -> None:
+        super().__init__()
+        self.loop = loop
+        self.writer = writer
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        data = bytes(data)
+        asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+        return len(data)
+
+    async def _write(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class BridgeHandler(TivoHTTPHandler):
+    """TivoHTTPHandler for one request that the event loop has already read."""
+
+    def __init__(
+        self,
+        raw: bytes,
+        client_address: Tuple[str, int],
+        server: "AsyncTivoServer",
+        wfile: io.BufferedIOBase,
+        connection: Any,
+    ) -> None:
+        # no BaseHTTPRequestHandler.__init__, which would serve a socket
+        self.container = Bdict({})
+        self.server_version = "pyTivo/1.0"
+        self.protocol_version = "HTTP/1.1"
+        self.sys_version = ""
+        self.client_address = client_address
+        self.server = server  # type: ignore
+        self.rfile = io.BytesIO(raw)
+        self.wfile = wfile
+        # the transport's socket, for setsockopt() (see socktune)
+        self.connection = connection
+        self.deferred: Optional[Tuple[Callable, Tuple]] = None
+
+    def defer_body(self, fn: Callable, *args: Any) -> None:  # type: ignore
+        self.deferred = (fn, args)
+
+    def run(self) -> bool:
+        """Handle the request, returning whether to keep the connection."""
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+        except Exception:
+            self.server.handle_error(b"", self.client_address)
+            return False
+        return not self.close_connection
+
+
+class AsyncTivoServer(TivoServerBase):
+    def __init__(self, server_address: Tuple[str, int], workers: int = 8) -> None:
+        self.init_tivo_server()
+        self.server_address = server_address
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="request"
+        )
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopping: Optional[asyncio.Event] = None
+        self.connections: Set[Tuple[asyncio.Task, asyncio.StreamWriter]] = set()
+
+    def serve_forever(self) -> None:
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.executor)
+        self.stopping = asyncio.Event()
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self.handle_connection, host or None, port, reuse_address=True
+        )
+        async with server:
+            await self.stopping.wait()
+            for _, writer in self.connections:
+                writer.close()
+            if self.connections:
+                await asyncio.wait(
+                    [task for task, _ in self.connections], timeout=SHUTDOWN_TIMEOUT
+                )
+
+    def shutdown(self) -> None:
+        """Stop serve_forever(); called from a request thread."""
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def server_close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        """The next request on a connection, headers and body, or None when
+        the client is done."""
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), REQUEST_LINE_TIMEOUT
+            )
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        except asyncio.LimitOverrunError:
+            LOGGER.warning("Request headers too large")
+            return None
+        if len(head) > MAX_HEADER_SIZE:
+            return None
+        match = CONTENT_LENGTH.search(head)
+        if match:
+            length = int(match.group(1))
+            if length > MAX_BODY_SIZE:
+                LOGGER.warning("Request body too large: %d bytes" % length)
+                return None
+            head += await reader.readexactly(length)
+        return head
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        assert self.loop is not None
+        peer = writer.get_extra_info("peername")[:2]
+        sock = writer.get_extra_info("socket")
+        wfile = io.BufferedWriter(LoopWriter(self.loop, writer), 0x10000)
+        conn = (asyncio.current_task(), writer)
+        self.connections.add(conn)  # type: ignore
+        try:
+            while True:
+                raw = await self.read_request(reader)
+                if raw is None:
+                    break
+                handler = BridgeHandler(raw, peer, self, wfile, sock)
+                keep_alive = await self.loop.run_in_executor(None, handler.run)
+                if handler.deferred is not None:
+                    fn, args = handler.deferred
+                    await fn(writer, *args)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            LOGGER.exception("Exception during request from %s" % (peer,))
+        finally:
+            self.connections.discard(conn)  # type: ignore
+            writer.close()
@@ -130,7 +130,7 @@ class ZCBroadcast:
 
 
 class Beacon:
-    def __init__(self) -> None:
+    def __init__(self, use_zc: bool = True) -> None:
         self.UDPSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.UDPSock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.services: List[bytes] = []
@@ -146,7 +146,7 @@ class Beacon:
                 self.platform = PLATFORM_MAIN
                 break
 
-        if get_zc():
+        if use_zc and get_zc():
             try:
                 self.bd = ZCBroadcast()
             except:
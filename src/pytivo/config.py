@@ -7,7 +7,7 @@ import socket
 import sys
 import uuid
 from functools import reduce
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 from pytivo.pytivo_types import Bdict, Settings
 
@@ -20,6 +20,8 @@ TIVOS_FOUND = False
 BIN_PATHS: Dict[str, str] = {}
 CONFIG = configparser.ConfigParser()
 CONFIGS_FOUND: List[str] = []
+CONFIG_GENERATION = 0  # bumped whenever CONFIG is reloaded or rewritten
+PROFILES: Dict[str, "TivoProfile"] = {}  # tsn_class -> resolved settings
 
 
 def config_init(config: Optional[str] = None, extraconf: Optional[str] = None) -> None:
@@ -51,8 +53,11 @@ def config_reset() -> None:
     global CONFIG
     global CONFIGS_FOUND
     global TIVOS_FOUND
+    global CONFIG_GENERATION
 
     BIN_PATHS = {}
+    CONFIG_GENERATION += 1
+    PROFILES.clear()
 
     CONFIG = configparser.ConfigParser()
     CONFIGS_FOUND = CONFIG.read(CONFIG_FILES)
@@ -76,6 +81,10 @@ def config_reset() -> None:
 
 
 def config_write() -> None:
+    global CONFIG_GENERATION
+
+    CONFIG_GENERATION += 1
+    PROFILES.clear()
     f = open(CONFIGS_FOUND[-1], "w")
     CONFIG.write(f)
     f.close()
@@ -144,6 +153,10 @@ def get169Letterbox(tsn: str) -> bool:  # tivo pads 16:9 video for 4:3 display
 
 
 def get169Setting(tsn: str) -> bool:
+    return tivo_profile(tsn).aspect169
+
+
+def _aspect169(tsn: str) -> bool:
     if not tsn:
         return True
 
@@ -166,6 +179,10 @@ def getAllowedClients() -> List[str]:
 
 
 def getIsExternal(tsn: str) -> bool:
+    return tivo_profile(tsn).external
+
+
+def _external(tsn: str) -> bool:
     tsnsect = "_tivo_" + tsn
     if tsnsect in CONFIG.sections():
         if CONFIG.has_option(tsnsect, "external"):
@@ -178,7 +195,15 @@ def getIsExternal(tsn: str) -> bool:
 
 
 def isTsnInConfig(tsn: str) -> bool:
-    return ("_tivo_" + tsn) in CONFIG.sections()
+    return CONFIG.has_section("_tivo_" + tsn)
+
+
+def tsn_class(tsn: str) -> str:
+    """Key for TiVos that share settings: the TSN itself if it has its own
+    config section, else its model prefix."""
+    if isTsnInConfig(tsn):
+        return tsn
+    return tsn[:3]
 
 
 def getShares(tsn: str = "") -> List[Tuple[str, Settings]]:
@@ -219,6 +244,10 @@ def getDebug() -> bool:
 
 
 def getOptres(tsn: str) -> bool:
+    return tivo_profile(tsn).optres
+
+
+def _optres(tsn: str) -> bool:
     try:
         return CONFIG.getboolean("_tivo_" + tsn, "optres")
     except:
@@ -272,7 +301,36 @@ def getFFmpegWait() -> int:
         return 0
 
 
+def get_server_int(name: str, default: int) -> int:
+    try:
+        return int(get_server(name, str(default)))
+    except ValueError:
+        LOGGER.error("Invalid %s, using %d" % (name, default))
+        return default
+
+
+def get_prefetch_workers() -> int:
+    return max(get_server_int("prefetch_workers", 2), 0)
+
+
+def get_server_mode() -> str:
+    return get_server("server_mode", "threading").lower()
+
+
+def get_cache_snapshot() -> Optional[str]:
+    path = get_server("cache_snapshot", "off")
+    if path.lower() in ["", "false", "no", "off"]:
+        return None
+    if path.lower() in ["true", "yes", "on"]:
+        path = "~/.cache/pytivo/cache_snapshot.pickle"
+    return os.path.expanduser(path)
+
+
 def getFFmpegPrams(tsn: str) -> Optional[str]:
+    return tivo_profile(tsn).ffmpeg_pram
+
+
+def _ffmpeg_pram(tsn: str) -> Optional[str]:
     return get_tsn("ffmpeg_pram", tsn, True)
 
 
@@ -332,12 +390,16 @@ def _trunc64(i: str) -> int:
 
 
 def getAudioBR(tsn: str) -> str:
+    return tivo_profile(tsn).audio_br
+
+
+def _audio_br(tsn: str) -> str:
     rate = get_tsn("audio_br", tsn)
     if not rate:
         rate = "448k"
     # convert to non-zero multiple of 64 to ensure ffmpeg compatibility
     # compare audio_br to max_audio_br and return lowest
-    return str(min(_trunc64(rate), getMaxAudioBR(tsn))) + "k"
+    return str(min(_trunc64(rate), _max_audio_br(tsn))) + "k"
 
 
 def _k(i: str) -> str:
@@ -345,6 +407,10 @@ def _k(i: str) -> str:
 
 
 def getVideoBR(tsn: str) -> str:
+    return tivo_profile(tsn).video_br
+
+
+def _video_br(tsn: str) -> str:
     rate = get_tsn("video_br", tsn)
     if rate:
         return _k(rate)
@@ -352,6 +418,10 @@ def getVideoBR(tsn: str) -> str:
 
 
 def getMaxVideoBR(tsn: str) -> str:
+    return tivo_profile(tsn).max_video_br
+
+
+def _max_video_br(tsn: str) -> str:
     rate = get_tsn("max_video_br", tsn)
     if rate:
         return _k(rate)
@@ -359,6 +429,10 @@ def getMaxVideoBR(tsn: str) -> str:
 
 
 def getBuffSize(tsn: str) -> str:
+    return tivo_profile(tsn).buffsize
+
+
+def _buffsize(tsn: str) -> str:
     size = get_tsn("bufsize", tsn)
     if size:
         return _k(size)
@@ -366,6 +440,10 @@ def getBuffSize(tsn: str) -> str:
 
 
 def getMaxAudioBR(tsn: str) -> int:
+    return tivo_profile(tsn).max_audio_br
+
+
+def _max_audio_br(tsn: str) -> int:
     rate = get_tsn("max_audio_br", tsn)
     # convert to non-zero multiple of 64 for ffmpeg compatibility
     if rate:
@@ -373,6 +451,20 @@ def getMaxAudioBR(tsn: str) -> int:
     return 448
 
 
+def _stream_sndbuf(tsn: str) -> int:
+    size = get_tsn("stream_sndbuf", tsn)
+    if size:
+        return strtod(size)
+    return 0  # leave it to the OS, which tunes it per connection
+
+
+def _tsn_boolean(name: str, tsn: str, default: bool) -> bool:
+    value = get_tsn(name, tsn)
+    if value is None:
+        return default
+    return CONFIG.BOOLEAN_STATES.get(value.lower(), default)
+
+
 def get_section(tsn: str) -> str:
     return ["_tivo_SD", "_tivo_HD"][isHDtivo(tsn)]
 
@@ -390,6 +482,67 @@ def get_tsn(name: str, tsn: str, raw: bool = False) -> Optional[str]:
                 return None
 
 
+class TivoProfile(NamedTuple):
+    """The settings for one TiVo, resolved from its _tivo_ section, the SD or
+    HD section and Server, with bit rates parsed."""
+
+    hd: bool
+    ts_capable: bool
+    width: int
+    height: int
+    aspect169: bool
+    blacklist169: bool
+    letterbox169: bool
+    optres: bool
+    external: bool
+    audio_br: str  # as given to ffmpeg, e.g. "448k"
+    max_audio_br: int  # kbit/s
+    video_br: str
+    video_bps: int
+    max_video_br: str
+    max_video_bps: int
+    buffsize: str
+    ffmpeg_pram: Optional[str]
+    audio_lang: Optional[str]
+    stream_sndbuf: int  # bytes, 0 for the OS default
+    stream_cork: bool
+    xml_nodelay: bool
+
+
+def tivo_profile(tsn: str) -> TivoProfile:
+    """The profile for tsn, shared by every TiVo of its tsn_class and kept
+    until the config is reloaded or rewritten."""
+    key = tsn_class(tsn)
+    profile = PROFILES.get(key)
+    if profile is None:
+        video_br = _video_br(tsn)
+        max_video_br = _max_video_br(tsn)
+        profile = PROFILES[key] = TivoProfile(
+            hd=isHDtivo(tsn),
+            ts_capable=is_ts_capable(tsn),
+            width=getTivoWidth(tsn),
+            height=getTivoHeight(tsn),
+            aspect169=_aspect169(tsn),
+            blacklist169=get169Blacklist(tsn),
+            letterbox169=get169Letterbox(tsn),
+            optres=_optres(tsn),
+            external=_external(tsn),
+            audio_br=_audio_br(tsn),
+            max_audio_br=_max_audio_br(tsn),
+            video_br=video_br,
+            video_bps=strtod(video_br),
+            max_video_br=max_video_br,
+            max_video_bps=strtod(max_video_br),
+            buffsize=_buffsize(tsn),
+            ffmpeg_pram=_ffmpeg_pram(tsn),
+            audio_lang=get_tsn("audio_lang", tsn),
+            stream_sndbuf=_stream_sndbuf(tsn),
+            stream_cork=_tsn_boolean("stream_cork", tsn, False),
+            xml_nodelay=_tsn_boolean("xml_nodelay", tsn, False),
+        )
+    return profile
+
+
 # Parse a bitrate using the SI/IEEE suffix values as if by ffmpeg
 # For example, 2K==2000, 2Ki==2048, 2MB==16000000, 2MiB==16777216
 # Algorithm: http://svn.mplayerhq.hu/ffmpeg/trunk/libavcodec/eval.c
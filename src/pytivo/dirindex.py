@@ -0,0 +1,230 @@
+"""On-disk index of share contents, for shares too large to walk per request.
+
+The index stores one row per file or folder, and the mtime of every folder
+at the time it was scanned. A refresh stats each folder and lists again only
+those whose mtime changed. In the others it stats the files, at most once
+every SETTLE_TIME seconds, since a file can grow or be rewritten without
+changing its folder's mtime. So a listing of an unchanged tree costs one
+stat per folder, and no directory reads.
+
+Paths are stored as bytes (os.fsencode) so that names which are not valid
+UTF-8 survive the trip through sqlite.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+DEFAULT_INDEX_FILE = "~/.cache/pytivo/dir_index.sqlite3"
+
+# A folder is rescanned until this long after its last change, so files still
+# being written when it was scanned get their final size and mtime; after
+# that its files are restatted at most this often.
+SETTLE_TIME = 300
+
+# (path, isdir, mtime, ctime, size)
+IndexRow = Tuple[str, bool, float, float, int]
+
+INDEXES: Dict[str, Optional["DirIndex"]] = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def _prefix_range(path: bytes) -> Tuple[bytes, bytes]:
+    """Bounds such that lo <= p < hi for every p inside folder path."""
+    lo = os.path.join(path, b"")
+    hi = lo[:-1] + bytes([lo[-1] + 1])
+    return lo, hi
+
+
+class DirIndex:
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(db_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.executescript(
+                """
+                DROP TABLE IF EXISTS dirs;
+                DROP TABLE IF EXISTS files;
+                CREATE TABLE dirs (
+                    path BLOB PRIMARY KEY, mtime REAL, scanned REAL
+                );
+                CREATE TABLE files (
+                    path BLOB PRIMARY KEY,
+                    parent BLOB NOT NULL,
+                    isdir INTEGER,
+                    size INTEGER,
+                    mtime REAL,
+                    ctime REAL
+                );
+                CREATE INDEX files_parent ON files (parent);
+                """
+            )
+            self.db.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+            self.db.commit()
+
+    def refresh(self, root: str, recurse: bool) -> bool:
+        """Bring the index for root (and with recurse, everything below it)
+        up to date. Returns True if anything had changed."""
+        changed = False
+        with self.lock:
+            try:
+                stack = [os.fsencode(root)]
+                while stack:
+                    path = stack.pop()
+                    changed = self._refresh_dir(path) or changed
+                    if recurse:
+                        stack.extend(
+                            row[0]
+                            for row in self.db.execute(
+                                "SELECT path FROM files WHERE parent=? AND isdir=1",
+                                (path,),
+                            )
+                        )
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        return changed
+
+    def _refresh_dir(self, path: bytes) -> bool:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return self._forget(path)
+
+        row = self.db.execute(
+            "SELECT mtime, scanned FROM dirs WHERE path=?", (path,)
+        ).fetchone()
+        if row is not None and row[0] == mtime and row[1] > mtime + SETTLE_TIME:
+            now = time.time()
+            if row[1] + SETTLE_TIME > now:
+                return False
+            self.db.execute("UPDATE dirs SET scanned=? WHERE path=?", (now, path))
+            return self._restat_files(path)
+
+        entries = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith(b"."):
+                        continue
+                    try:
+                        isdir = entry.is_dir()
+                        st = entry.stat()
+                    except OSError as msg:
+                        LOGGER.warning("Unable to stat %r: %s" % (entry.path, msg))
+                        continue
+                    entries.append(
+                        (entry.path, path, isdir, st.st_size, st.st_mtime, st.st_ctime)
+                    )
+        except OSError as msg:
+            LOGGER.error("Unable to list %r: %s" % (path, msg))
+            return self._forget(path)
+
+        old = {
+            row[0]: (bool(row[1]), row[2], row[3], row[4])
+            for row in self.db.execute(
+                "SELECT path, isdir, size, mtime, ctime FROM files WHERE parent=?",
+                (path,),
+            )
+        }
+        new_subdirs = {e[0] for e in entries if e[2]}
+        for old_path, (isdir, _, _, _) in old.items():
+            if isdir and old_path not in new_subdirs:
+                self._forget(old_path)
+
+        self.db.execute("DELETE FROM files WHERE parent=?", (path,))
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", entries)
+        self.db.execute(
+            "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (path, mtime, time.time())
+        )
+        return row is None or old != {e[0]: (e[2], e[3], e[4], e[5]) for e in entries}
+
+    def _restat_files(self, path: bytes) -> bool:
+        """Update the sizes and times of the files in a folder that hasn't
+        changed itself."""
+        changed = []
+        for name, size, mtime, ctime in self.db.execute(
+            "SELECT path, size, mtime, ctime FROM files WHERE parent=? AND isdir=0",
+            (path,),
+        ).fetchall():
+            try:
+                st = os.stat(name)
+            except OSError:
+                # removing it changed the folder's mtime, for the next refresh
+                continue
+            if (st.st_size, st.st_mtime, st.st_ctime) != (size, mtime, ctime):
+                changed.append((st.st_size, st.st_mtime, st.st_ctime, name))
+        self.db.executemany(
+            "UPDATE files SET size=?, mtime=?, ctime=? WHERE path=?", changed
+        )
+        return bool(changed)
+
+    def _forget(self, path: bytes) -> bool:
+        """Drop a folder that is gone, and everything in it."""
+        lo, hi = _prefix_range(path)
+        cur = self.db.execute("DELETE FROM dirs WHERE path=?", (path,))
+        removed = cur.rowcount
+        for table in ["dirs", "files"]:
+            cur = self.db.execute(
+                "DELETE FROM %s WHERE path >= ? AND path < ?" % table, (lo, hi)
+            )
+            removed += cur.rowcount
+        return removed > 0
+
+    def listing(self, root: str, recurse: bool) -> List[IndexRow]:
+        """The contents of root, in name order. With recurse, the files in
+        root and all folders below it, without the folders themselves."""
+        path = os.fsencode(root)
+        with self.lock:
+            if recurse:
+                lo, hi = _prefix_range(path)
+                rows: Iterator = self.db.execute(
+                    "SELECT path, isdir, mtime, ctime, size FROM files"
+                    " WHERE path >= ? AND path < ? AND isdir=0 ORDER BY path",
+                    (lo, hi),
+                )
+            else:
+                rows = self.db.execute(
+                    "SELECT path, isdir, mtime, ctime, size FROM files"
+                    " WHERE parent=? ORDER BY path",
+                    (path,),
+                )
+            return [
+                (os.fsdecode(name), bool(isdir), mtime, ctime, size)
+                for name, isdir, mtime, ctime, size in rows
+            ]
+
+
+def get_index(setting: str) -> Optional[DirIndex]:
+    """The index for a share's dir_index setting, which is off, on (for the
+    default location) or the path of the index file."""
+    setting = setting.strip()
+    if setting.lower() in ["", "false", "no", "off"]:
+        return None
+    if setting.lower() in ["true", "yes", "on"]:
+        setting = DEFAULT_INDEX_FILE
+    db_path = os.path.expanduser(setting)
+
+    with INDEXES_LOCK:
+        if db_path not in INDEXES:
+            try:
+                INDEXES[db_path] = DirIndex(db_path)
+            except (OSError, sqlite3.Error) as msg:
+                LOGGER.error("Unable to open directory index %s: %s" % (db_path, msg))
+                INDEXES[db_path] = None
+        return INDEXES[db_path]
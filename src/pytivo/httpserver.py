@@ -2,16 +2,18 @@ import http.server
 import socketserver
 import cgi
 import gzip
+import ipaddress
 import logging
 import mimetypes
 import os
-import shutil
+import queue
 import socket
+import threading
 from io import BytesIO
-from email.utils import formatdate
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import unquote_plus, quote, parse_qs
 from xml.sax.saxutils import escape
-from typing import Dict, Optional, List, Tuple, Any
+from typing import TYPE_CHECKING, Dict, Optional, List, Tuple, Any, BinaryIO, Callable
 
 from Cheetah.Template import Template  # type: ignore
 
@@ -22,11 +24,20 @@ from pytivo.config import (
     is_ts_capable,
     isTsnInConfig,
     getAllowedClients,
+    tivo_profile,
 )
-from pytivo.plugin import GetPlugin
+from pytivo.lrucache import CacheKeyError, LockedLRUCache
+import pytivo.metrics
+import pytivo.profiler
+import pytivo.socktune
+from pytivo.responsecache import CachedResponse
+from pytivo.routing import get_routes
 from pytivo.beacon import Beacon
 from pytivo.pytivo_types import Query, Settings, Bdict
 
+if TYPE_CHECKING:
+    from pytivo.prefork import Router
+
 LOGGER = logging.getLogger(__name__)
 
 SCRIPTDIR = os.path.dirname(__file__)
@@ -57,6 +68,14 @@ BASE_HTML = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
 <link rel="stylesheet" type="text/css" href="/main.css">
 </head> <body> %s </body> </html>"""
 
+# how long a connection may take to send its next request line, in the pooled
+# and asyncio modes; an idle kept-alive connection is closed after this
+REQUEST_LINE_TIMEOUT = 30
+
+# files in content/ up to this size are kept in memory
+STATIC_MAX_SIZE = 0x10000
+STATIC_CACHE = LockedLRUCache(100)
+
 RELOAD = '<p>The <a href="%s">page</a> will reload in %d seconds.</p>'
 UNSUP = "<h3>Unsupported Command</h3> <p>Query:</p> <ul>%s</ul>"
 
@@ -68,16 +87,18 @@ INFO_PAGE_TCLASS = Template.compile(
 )
 
 
-class TivoHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    def __init__(
-        self, server_address: Tuple[str, int], RequestHandlerClass: type
-    ) -> None:
+class TivoServerBase:
+    """The shares and state that TivoHTTPHandler expects of its server,
+    whichever server implementation runs it."""
+
+    def init_tivo_server(self) -> None:
         self.containers: Dict[str, Settings] = {}
         self.beacon: Optional[Beacon] = None
+        self.router: Optional["Router"] = None
+        # set where a connection waiting for its next request holds a thread
+        self.idle_timeout: Optional[float] = None
         self.stop = False
         self.restart = False
-        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass)
-        self.daemon_threads = True
 
     def add_container(self, name: str, settings: Settings) -> None:
         if name in self.containers or name == "TiVoConnect":
@@ -102,7 +123,200 @@ class TivoHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
         self.in_service = status
 
 
+class TivoHTTPServer(
+    TivoServerBase, socketserver.ThreadingMixIn, http.server.HTTPServer
+):
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        RequestHandlerClass: type,
+        reuse_port: bool = False,
+    ) -> None:
+        self.init_tivo_server()
+        self.reuse_port = reuse_port
+        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.daemon_threads = True
+
+    def server_bind(self) -> None:
+        if self.reuse_port:
+            # other pre-forked workers listen on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request_thread(
+        self, request: Any, client_address: Tuple[str, int]
+    ) -> None:
+        if self.router is not None and self.router.forward(
+            self, request, client_address
+        ):
+            return
+        super().process_request_thread(request, client_address)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # ETags compare weakly for If-None-Match, ignoring any W/ prefix
+    tags = [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]
+    return "*" in tags or etag.replace("W/", "", 1) in tags
+
+
+def byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """The span (start, end exclusive) of a Range header with one range, or
+    None to send the whole file, as for one that is malformed or has
+    several ranges. Raises ValueError if the range is past the end."""
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    try:
+        if not dash or not (first or last):
+            return None
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+            if last and end <= start:
+                return None
+        else:
+            start = max(size - int(last), 0)
+            end = size
+    except ValueError:
+        return None
+    if start >= size or start == end:
+        raise ValueError("Range %s not satisfiable" % header)
+    return start, min(end, size)
+
+
+def peek_path(request: Any) -> Optional[str]:
+    """The path of the first request on a connection, without consuming it,
+    or None if the client closes or sends nothing in time."""
+    line = peek_request_line(request)
+    if line is None:
+        return None
+    return line[1]
+
+
+def peek_request_line(request: Any) -> Optional[Tuple[str, str]]:
+    """The method and path of the first request on a connection, as
+    peek_path()."""
+    timeout = request.gettimeout()
+    request.settimeout(REQUEST_LINE_TIMEOUT)
+    try:
+        data = request.recv(2048, socket.MSG_PEEK)
+    except OSError:
+        return None
+    finally:
+        request.settimeout(timeout)
+    if not data:
+        return None
+    words = data.split(b"\r\n", 1)[0].split()
+    if len(words) < 2:
+        return ("", "")
+    return (words[0].decode("latin-1"), words[1].decode("latin-1"))
+
+
+class WorkerPool:
+    """A fixed number of threads working through a bounded queue."""
+
+    def __init__(self, name: str, workers: int, queue_depth: int) -> None:
+        self.jobs: "queue.Queue[Tuple[Callable, Tuple]]" = queue.Queue(queue_depth)
+        self.stopped = False
+        for i in range(workers):
+            threading.Thread(
+                target=self.work, name="%s-%d" % (name, i), daemon=True
+            ).start()
+
+    def submit(self, fn: Callable, *args: Any) -> bool:
+        """Queue fn(*args), or return False if the queue is full."""
+        try:
+            self.jobs.put_nowait((fn, args))
+        except queue.Full:
+            return False
+        return True
+
+    def work(self) -> None:
+        while not self.stopped:
+            try:
+                fn, args = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                LOGGER.exception("Worker job failed")
+
+    def shutdown(self) -> None:
+        # idle workers notice within a second, busy ones after their job
+        self.stopped = True
+
+
+class PooledTivoHTTPServer(TivoHTTPServer):
+    """TivoHTTPServer that serves connections from two fixed pools of threads
+    rather than a new thread each. Connections that fetch a file from a share
+    go to the stream pool, so long transfers can't starve menu requests in
+    the control pool. A connection that arrives when the queue of its pool is
+    full is refused, by overflow: "reject" answers 503, "close" just closes
+    it."""
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        RequestHandlerClass: type,
+        control_threads: int = 8,
+        stream_threads: int = 8,
+        queue_depth: int = 32,
+        overflow: str = "reject",
+        reuse_port: bool = False,
+    ) -> None:
+        super().__init__(server_address, RequestHandlerClass, reuse_port)
+        self.control_pool = WorkerPool("control", control_threads, queue_depth)
+        self.stream_pool = WorkerPool("stream", stream_threads, queue_depth)
+        self.overflow = overflow
+        self.idle_timeout = REQUEST_LINE_TIMEOUT
+
+    def process_request(self, request: Any, client_address: Tuple[str, int]) -> None:
+        if not self.control_pool.submit(self.dispatch_request, request, client_address):
+            self.refuse_request(request, client_address)
+
+    def dispatch_request(self, request: Any, client_address: Tuple[str, int]) -> None:
+        path = peek_path(request)
+        if path is None:
+            self.shutdown_request(request)
+            return
+
+        splitpath = [x for x in unquote_plus(path.split("?", 1)[0]).split("/") if x]
+        if splitpath and splitpath[0] in self.containers:
+            if not self.stream_pool.submit(
+                self.process_request_thread, request, client_address
+            ):
+                self.refuse_request(request, client_address)
+            return
+        self.process_request_thread(request, client_address)
+
+    def refuse_request(self, request: Any, client_address: Tuple[str, int]) -> None:
+        LOGGER.warning("Server busy, refusing %s" % client_address[0])
+        if self.overflow == "reject":
+            try:
+                request.sendall(
+                    b"HTTP/1.1 503 Service Unavailable\r\n"
+                    b"Retry-After: 5\r\n"
+                    b"Content-Length: 0\r\n"
+                    b"Connection: close\r\n\r\n"
+                )
+            except OSError:
+                pass
+        self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.control_pool.shutdown()
+        self.stream_pool.shutdown()
+
+
 class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
+    # Set by the asyncio server: a plugin may call defer_body(coro_fn, *args)
+    # instead of writing a long body, and the server then awaits
+    # coro_fn(writer, *args) once the request handler has returned.
+    defer_body: Optional[Callable[..., None]] = None
+
     def __init__(
         self, request: bytes, client_address: Tuple[str, int], server: TivoHTTPServer
     ) -> None:
@@ -116,6 +330,18 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
             self, request, client_address, server
         )
 
+    def handle_one_request(self) -> None:
+        if self.server.idle_timeout is not None:
+            self.connection.settimeout(self.server.idle_timeout)
+        http.server.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def parse_request(self) -> bool:
+        # the request line is in; a stream may stall for as long as the TiVo
+        # pauses it
+        if self.server.idle_timeout is not None:
+            self.connection.settimeout(None)
+        return http.server.BaseHTTPRequestHandler.parse_request(self)
+
     def address_string(self) -> str:
         host, port = self.client_address[:2]
         return host
@@ -128,6 +354,9 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         return self.server_version
 
     def do_GET(self) -> None:
+        if self.path == "/metrics" and self.is_local():
+            self.send_fixed(pytivo.metrics.render(), pytivo.metrics.CONTENT_TYPE)
+            return
         tsn = self.headers.get("TiVo_TCD_ID", self.headers.get("tsn", ""))
         if not self.authorize(tsn):
             return
@@ -174,20 +403,19 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         self.handle_query(query, tsn)
 
     def do_command(self, query: Query, command: str, target: str, tsn: str) -> bool:
-        for name, container in getShares(tsn):
-            if target == name:
-                plugin = GetPlugin(container["type"])
-                if hasattr(plugin, command):
-                    self.cname = name
-                    self.container = container
-                    method = getattr(plugin, command)
+        route = get_routes(tsn).get(target)
+        if route is not None and hasattr(route.plugin, command):
+            self.cname = route.name
+            self.container = route.settings
+            method = getattr(route.plugin, command)
+            with pytivo.metrics.REQUEST_SECONDS.time(command):
+                with pytivo.profiler.request(command):
                     method(self, query)
-                    return True
-                else:
-                    break
+            return True
         return False
 
     def handle_query(self, query: Query, tsn: str) -> None:
+        pytivo.socktune.tune_xml(self.connection, tivo_profile(tsn))
         if "Command" in query and len(query["Command"]) >= 1:
 
             command = query["Command"][0]
@@ -196,7 +424,9 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
             if command == "QueryContainer" and (
                 "Container" not in query or query["Container"][0] == "/"
             ):
-                self.root_container()
+                with pytivo.metrics.REQUEST_SECONDS.time(command):
+                    with pytivo.profiler.request(command):
+                        self.root_container()
                 return
 
             if "Container" in query:
@@ -239,59 +469,160 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         # anything.
         self.unsupported(query)
 
-    def send_content_file(self, path: str) -> None:
-        lmdate = os.path.getmtime(path)
+    def send_content_file(
+        self, path: str, mime: Optional[str] = None, cache: bool = False
+    ) -> None:
+        """Send a file as is, honouring a single-range Range header and
+        If-None-Match / If-Modified-Since. With cache, small files are kept
+        in memory (for the icons and stylesheets in content/)."""
         try:
-            handle = open(path, "rb")
-        except:
+            st = os.stat(path)
+        except OSError:
             self.send_error(404)
             return
+        size = st.st_size
+        stamp = (st.st_mtime, size)
+        cache = cache and size <= STATIC_MAX_SIZE
 
-        # Send the header
-        mime = mimetypes.guess_type(path)[0]
-        self.send_response(200)
-        if mime:
-            self.send_header("Content-Type", mime)
-        self.send_header("Content-Length", str(os.path.getsize(path)))
-        self.send_header("Last-Modified", formatdate(lmdate))
-        self.end_headers()
+        body: Optional[bytes] = None
+        handle: Optional[BinaryIO] = None
+        if cache:
+            try:
+                cached_stamp, body = STATIC_CACHE[path]
+                if cached_stamp != stamp:
+                    body = None
+            except CacheKeyError:
+                pass
+            pytivo.metrics.cache_lookup("static", body is not None)
+        if body is None:
+            try:
+                handle = open(path, "rb")
+            except OSError:
+                self.send_error(404)
+                return
+            if cache:
+                with handle:
+                    body = handle.read()
+                handle = None
+                STATIC_CACHE[path] = (stamp, body)
 
-        # Send the body of the file
         try:
-            shutil.copyfileobj(handle, self.wfile)
-        except:
-            pass
-        handle.close()
+            etag = '"%x-%x"' % (int(st.st_mtime), size)
+            lmdate = formatdate(st.st_mtime, usegmt=True)
+            if self.not_modified(etag, st.st_mtime):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", lmdate)
+                self.end_headers()
+                return
+
+            span = None
+            if "Range" in self.headers and self.headers.get("If-Range") in [
+                None,
+                etag,
+                lmdate,
+            ]:
+                try:
+                    span = byte_range(self.headers["Range"], size)
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % size)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            start, end = span or (0, size)
+
+            if mime is None:
+                mime = mimetypes.guess_type(path)[0]
+            self.send_response(206 if span else 200)
+            if mime:
+                self.send_header("Content-Type", mime)
+            self.send_header("Content-Length", str(end - start))
+            if span:
+                self.send_header(
+                    "Content-Range", "bytes %d-%d/%d" % (start, end - 1, size)
+                )
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", lmdate)
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+            try:
+                if body is not None:
+                    self.wfile.write(body[start:end])
+                elif handle is not None:
+                    self.copy_range(handle, start, end - start)
+                self.wfile.flush()
+                pytivo.metrics.SENT_BYTES.inc(amount=end - start)
+            except OSError:
+                pass
+        finally:
+            if handle is not None:
+                handle.close()
+
+    def not_modified(self, etag: str, mtime: float) -> bool:
+        """Whether the client's conditional GET allows a 304."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        since = self.headers.get("If-Modified-Since")
+        if since is None:
+            return False
+        try:
+            return int(mtime) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def copy_range(self, handle: BinaryIO, offset: int, count: int) -> None:
         self.wfile.flush()
+        sock = getattr(self, "connection", None)
+        if isinstance(sock, socket.socket):
+            # zero-copy with os.sendfile() where the platform has it
+            sock.sendfile(handle, offset, count)
+            return
+        # the asyncio server's handler has no socket of its own
+        handle.seek(offset)
+        while count > 0:
+            block = handle.read(min(count, 0x10000))
+            if not block:
+                break
+            self.wfile.write(block)
+            count -= len(block)
 
     def handle_file(self, query: Query, splitpath: List[str]) -> None:
         if ".." not in splitpath:  # Protect against path exploits
             # Pass it off to a plugin?
-            for name, container in list(self.server.containers.items()):
-                if splitpath[0] == name:
-                    self.cname = name
-                    self.container = container
-                    base = os.path.normpath(container["path"])
-                    path = os.path.join(base, *splitpath[1:])
-                    plugin = GetPlugin(container["type"])
-                    # plugin could be Error, with no send_file method
-                    try:
-                        plugin.send_file(self, path, query)  # type: ignore
-                    except AttributeError:
-                        pass
-                    return
+            route = get_routes().get(splitpath[0])
+            if route is not None:
+                self.cname = route.name
+                self.container = route.settings
+                base = os.path.normpath(route.settings["path"])
+                path = os.path.join(base, *splitpath[1:])
+                # plugin could be Error, with no send_file method
+                try:
+                    with pytivo.profiler.request("send_file"):
+                        route.plugin.send_file(self, path, query)  # type: ignore
+                except AttributeError:
+                    pass
+                return
 
             # Serve it from a "content" directory?
             base = os.path.join(SCRIPTDIR, *splitpath[:-1])
             path = os.path.join(base, "content", splitpath[-1])
 
             if os.path.isfile(path):
-                self.send_content_file(path)
+                self.send_content_file(path, cache=True)
                 return
 
         # Give up
         self.send_error(404)
 
+    def is_local(self) -> bool:
+        try:
+            return ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            return False
+
     def authorize(self, tsn: Optional[str] = None) -> bool:
         # if allowed_clients is empty, we are completely open
         allowed_clients = getAllowedClients()
@@ -306,23 +637,35 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         return False
 
     def send_fixed(
-        self, data: bytes, mime: str, code: int = 200, refresh: str = ""
+        self,
+        data: bytes,
+        mime: str,
+        code: int = 200,
+        refresh: str = "",
+        etag: str = "",
+        gzipped: Optional[bytes] = None,
     ) -> None:
+        """gzipped, if given, is data already compressed."""
         squeeze = (
             len(data) > 256
             and mime.startswith("text")
             and "gzip" in self.headers.get("Accept-Encoding", "")
         )
         if squeeze:
-            out = BytesIO()
-            gzip.GzipFile(mode="wb", fileobj=out).write(data)
-            data = out.getvalue()
-            out.close()
+            if gzipped is not None:
+                data = gzipped
+            else:
+                out = BytesIO()
+                gzip.GzipFile(mode="wb", fileobj=out).write(data)
+                data = out.getvalue()
+                out.close()
         self.send_response(code)
         self.send_header("Content-Type", mime)
         self.send_header("Content-Length", str(len(data)))
         if squeeze:
             self.send_header("Content-Encoding", "gzip")
+        if etag:
+            self.send_header("ETag", etag)
         self.send_header("Expires", "0")
         if refresh:
             self.send_header("Refresh", refresh)
@@ -330,6 +673,18 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         self.wfile.write(data)
         self.wfile.flush()
 
+    def send_cached(self, response: CachedResponse, mime: str) -> None:
+        """Send a cached response, or 304 Not Modified if the client's copy
+        has the same ETag."""
+        if etag_matches(self.headers.get("If-None-Match", ""), response.etag):
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.end_headers()
+            return
+        self.send_fixed(
+            response.body, mime, etag=response.etag, gzipped=response.gzipped
+        )
+
     def send_xml(self, page: str) -> None:
         # use page: str because Cheetah outputs unicode str
         self.send_fixed(page.encode("utf-8"), "text/xml")
@@ -340,17 +695,6 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
 
     def root_container(self) -> None:
         tsn = self.headers.get("TiVo_TCD_ID", "")
-        tsnshares = getShares(tsn)
-        tsncontainers = []
-        for section, settings in tsnshares:
-            try:
-                mime = GetPlugin(settings["type"]).CONTENT_TYPE
-                if mime.split("/")[1] in ("tivo-videos", "tivo-music", "tivo-photos"):
-                    settings["content_type"] = mime
-                    tsncontainers.append((section, settings))
-            except Exception as msg:
-                LOGGER.error(section + " - " + str(msg), exc_info=True)
-
         t = ROOT_CONTAINER_TCLASS()
 
         if self.server.beacon is None:
@@ -360,7 +704,7 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
             t.renamed = self.server.beacon.bd.renamed
         else:
             t.renamed = {}
-        t.containers = tsncontainers
+        t.containers = get_routes(tsn).containers
         t.hostname = socket.gethostname()
         t.escape = escape
         t.quote = quote
@@ -375,7 +719,7 @@ class TivoHTTPHandler(http.server.BaseHTTPRequestHandler):
         else:
             t.togo = ""
 
-        for section, settings in getShares():
+        for section, settings, _ in get_routes().routes:
             plugin_type = settings.get("type")
             if plugin_type == "settings":
                 t.admin += (
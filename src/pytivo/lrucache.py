@@ -42,11 +42,13 @@ discarded. [1]_
 """
 
 
+import threading
 import time
 from heapq import heappush, heappop, heapify
+from typing import Any
 
 __version__ = "0.2"
-__all__ = ["CacheKeyError", "LRUCache", "DEFAULT_SIZE"]
+__all__ = ["CacheKeyError", "LRUCache", "LockedLRUCache", "DEFAULT_SIZE"]
 __docformat__ = "reStructuredText en"
 
 DEFAULT_SIZE = 16
@@ -225,6 +227,36 @@ class LRUCache(object):
             return node.mtime
 
 
+class LockedLRUCache(LRUCache):
+    """LRUCache whose reads and writes may be shared between threads."""
+
+    def __init__(self, num: int) -> None:
+        LRUCache.__init__(self, num)
+        self.lock = threading.RLock()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        return self.lock.acquire(blocking)
+
+    def release(self) -> None:
+        self.lock.release()
+
+    def __setitem__(self, key: Any, obj: Any) -> None:
+        self.acquire()
+        try:
+            LRUCache.__setitem__(self, key, obj)
+        finally:
+            self.release()
+
+    def __getitem__(self, key: Any) -> Any:
+        item = None
+        self.acquire()
+        try:
+            item = LRUCache.__getitem__(self, key)
+        finally:
+            self.release()
+        return item
+
+
 if __name__ == "__main__":
     cache = LRUCache(25)
     print(cache)
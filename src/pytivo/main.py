@@ -27,8 +27,14 @@ from pytivo.config import (
     getPort,
     getShares,
     getBeaconAddresses,
+    get_server,
+    get_server_int,
+    get_server_mode,
 )
-from pytivo.httpserver import TivoHTTPServer, TivoHTTPHandler
+from pytivo.aioserver import AsyncTivoServer
+from pytivo.httpserver import PooledTivoHTTPServer, TivoHTTPServer, TivoHTTPHandler
+from pytivo.snapshot import load_snapshot, save_snapshot
+import pytivo.prefork
 
 LOGGER = logging.getLogger(__name__)
 
@@ -108,25 +114,63 @@ def setup(
     extraconf: Optional[str] = None,
     in_service: bool = False,
 ) -> TivoHTTPServer:
+    init(config=config, extraconf=extraconf)
+    return start_server(in_service=in_service)
+
+
+def init(config: Optional[str] = None, extraconf: Optional[str] = None) -> None:
     config_init(config=config, extraconf=extraconf)
     init_logging()
     sys.excepthook = exceptionLogger
+    load_snapshot()
 
-    port = getPort()
-
-    httpd = TivoHTTPServer(("", int(port)), TivoHTTPHandler)
     LOGGER.info("Last modified: " + last_date())
     LOGGER.info("Python: " + platform.python_version())
     LOGGER.info("System: " + platform.platform())
 
+
+def start_server(
+    in_service: bool = False, reuse_port: bool = False, announce: bool = True
+) -> TivoHTTPServer:
+    """Create the server for the configured shares. With announce False
+    (pre-forked workers other than the first) the beacon is only used to
+    look up TiVo names, and isn't started."""
+    port = getPort()
+
+    httpd: TivoHTTPServer
+    server_mode = get_server_mode()
+    if server_mode == "asyncio" and in_service:
+        LOGGER.warning("server_mode asyncio is not available in the service")
+        server_mode = "threading"
+    if server_mode == "asyncio" and sys.version_info < (3, 7):
+        LOGGER.warning("server_mode asyncio needs Python 3.7 or later")
+        server_mode = "threading"
+    if server_mode == "asyncio":
+        httpd = AsyncTivoServer(  # type: ignore
+            ("", int(port)), get_server_int("control_threads", 8)
+        )
+    elif server_mode == "pool":
+        httpd = PooledTivoHTTPServer(
+            ("", int(port)),
+            TivoHTTPHandler,
+            get_server_int("control_threads", 8),
+            get_server_int("stream_threads", 8),
+            get_server_int("queue_depth", 32),
+            get_server("overflow", "reject").lower(),
+            reuse_port,
+        )
+    else:
+        httpd = TivoHTTPServer(("", int(port)), TivoHTTPHandler, reuse_port)
+
     for section, settings in getShares():
         httpd.add_container(section, settings)
 
-    b = Beacon()
-    b.add_service(b"TiVoMediaServer:%d/http" % int(port))
-    b.start()
-    if "listen" in getBeaconAddresses():
-        b.listen()
+    b = Beacon(use_zc=announce)
+    if announce:
+        b.add_service(b"TiVoMediaServer:%d/http" % int(port))
+        b.start()
+        if "listen" in getBeaconAddresses():
+            b.listen()
 
     httpd.set_beacon(b)
     httpd.set_service_status(in_service)
@@ -142,11 +186,35 @@ def serve(httpd: TivoHTTPServer) -> None:
         pass
 
 
+def run_worker(index: int, router: pytivo.prefork.Router) -> bool:
+    httpd = start_server(reuse_port=True, announce=index == 0)
+    router.start(httpd)
+    serve(httpd)
+    httpd.server_close()
+    if index == 0:
+        if httpd.beacon is not None:
+            httpd.beacon.stop()
+        save_snapshot()
+    return httpd.restart
+
+
 def mainloop(args: argparse.Namespace) -> bool:
-    httpd = setup(config=args.config, extraconf=args.extraconf)
+    init(config=args.config, extraconf=args.extraconf)
+
+    processes = get_server_int("processes", 1)
+    if processes > 1 and get_server_mode() == "asyncio":
+        LOGGER.warning("processes is not supported with server_mode asyncio")
+    elif processes > 1 and not pytivo.prefork.available():
+        LOGGER.warning("processes is not supported on this platform")
+    elif processes > 1:
+        return pytivo.prefork.run(processes, run_worker)
+
+    httpd = start_server()
     serve(httpd)
+    httpd.server_close()
     if httpd.beacon is not None:
         httpd.beacon.stop()
+    save_snapshot()
     return httpd.restart
 
 
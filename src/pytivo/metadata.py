@@ -10,7 +10,7 @@ import subprocess
 import sys
 import tempfile
 import time
-from typing import Dict, Any, Optional, NamedTuple, List, Tuple, TextIO
+from typing import Dict, Any, Optional, NamedTuple, List, Tuple, TextIO, BinaryIO
 from xml.dom import minidom  # type: ignore
 from xml.parsers import expat
 
@@ -22,12 +22,21 @@ except:
 import mutagen  # type: ignore
 
 from pytivo.config import get_bin, getFFmpegWait, get_server
-from pytivo.lrucache import LRUCache
+from pytivo.lrucache import CacheKeyError, LockedLRUCache
+import pytivo.metrics
+from pytivo.snapshot import register_cache
 from pytivo.turing import Turing
 
 LOGGER = logging.getLogger(__name__)
 
-INFO_CACHE = LRUCache(1000)
+# written by prefetch threads as well as request threads
+INFO_CACHE = LockedLRUCache(1000)
+register_cache("info", INFO_CACHE)
+TIVO_HEADER_CACHE = LockedLRUCache(1000)
+register_cache("tivo_header", TIVO_HEADER_CACHE)
+
+# folder -> number of files added to INFO_CACHE, see info_added()
+INFO_ADDED: Dict[str, int] = {}
 
 # Something to strip
 TRIBUNE_CR = " Copyright Tribune Media Services, Inc."
@@ -838,37 +847,108 @@ def _tdcat_bin(tdcat_path: str, full_path: str, tivo_mak: str) -> str:
     return tdcat.stdout
 
 
-def _tdcat_py(full_path: str, tivo_mak: str) -> str:
-    xml_data = {}
+class TivoChunk(NamedTuple):
+    id: int
+    type: int  # 0 = plaintext, 1 = encrypted
+    data: bytes
+    start: int  # file offset of data
+
+
+class TivoHeader(NamedTuple):
+    is_ts: bool
+    mpeg_offset: int
+    chunks: List[TivoChunk]
 
-    tfile = open(full_path, "rb")
-    header = tfile.read(16)
-    offset, chunks = struct.unpack(">LH", header[10:])
-    rawdata = tfile.read(offset - 16)
-    tfile.close()
 
-    count = 0
-    for i in range(chunks):
+TIVO_HEADER_SIZE = 16
+TIVO_CHUNK_ENCRYPTED = 1
+TIVO_KEY_CHUNK_ID = 3  # plaintext chunk the decryption keys are derived from
+
+
+def parse_tivo_header(rawdata: bytes) -> TivoHeader:
+    """Parse a .TiVo file header from the first mpeg_offset bytes of the file."""
+    if rawdata[:4] != b"TiVo":
+        raise ValueError("Not a TiVo file")
+    is_ts = bool(rawdata[7] & 0x20)
+    offset, num_chunks = struct.unpack(">LH", rawdata[10:16])
+
+    chunks = []
+    count = TIVO_HEADER_SIZE
+    for i in range(num_chunks):
         chunk_size, data_size, id, enc = struct.unpack(
             ">LLHH", rawdata[count : count + 12]
         )
-        count += 12
-        data = rawdata[count : count + data_size]
-        xml_data[id] = {"enc": enc, "data": data, "start": count + 16}
-        count += chunk_size - 12
+        data = rawdata[count + 12 : count + 12 + data_size]
+        chunks.append(TivoChunk(id, enc, data, count + 12))
+        count += chunk_size
+
+    return TivoHeader(is_ts, offset, chunks)
+
+
+class TivoHeaderInfo(NamedTuple):
+    flags: int
+    is_ts: bool
+    mpeg_offset: int
+    num_chunks: int
+
+
+def tivo_header_info(
+    full_path: str, mtime: Optional[float] = None
+) -> Optional[TivoHeaderInfo]:
+    """Fixed fields of a .TiVo file's header, cached until its mtime changes.
+    None if the file can't be read or isn't a TiVo file."""
+    if mtime is None:
+        try:
+            mtime = os.path.getmtime(full_path)
+        except OSError:
+            return None
+
+    try:
+        cached_mtime, info = TIVO_HEADER_CACHE[full_path]
+        if cached_mtime == mtime:
+            return info
+    except CacheKeyError:
+        pass
+
+    try:
+        with open(full_path, "rb") as tfile:
+            header = tfile.read(TIVO_HEADER_SIZE)
+    except OSError:
+        return None
+
+    info = None
+    if len(header) == TIVO_HEADER_SIZE and header[:4] == b"TiVo":
+        flags, mpeg_offset, num_chunks = struct.unpack(">H2xLH", header[6:])
+        info = TivoHeaderInfo(flags, bool(flags & 0x20), mpeg_offset, num_chunks)
+    TIVO_HEADER_CACHE[full_path] = (mtime, info)
+    return info
+
+
+def read_tivo_header(tfile: BinaryIO) -> TivoHeader:
+    header = tfile.read(TIVO_HEADER_SIZE)
+    offset = struct.unpack(">L", header[10:14])[0]
+    return parse_tivo_header(header + tfile.read(offset - TIVO_HEADER_SIZE))
+
+
+def tivo_turing_key(key: bytes) -> Tuple[bytes, bytes]:
+    """Turing key and IV for a 20 byte TiVo key."""
+    return hashlib.sha1(key[:17]).digest(), hashlib.sha1(key).digest()
+
+
+def _tdcat_py(full_path: str, tivo_mak: str) -> str:
+    with open(full_path, "rb") as tfile:
+        header = read_tivo_header(tfile)
+    xml_data = {chunk.id: chunk for chunk in header.chunks}
 
     chunk = xml_data[2]
-    details = chunk["data"]
-    if chunk["enc"]:
-        xml_key = xml_data[3]["data"]
+    details = chunk.data
+    if chunk.type == TIVO_CHUNK_ENCRYPTED:
+        xml_key = xml_data[TIVO_KEY_CHUNK_ID].data
 
         hexmak = hashlib.md5(b"tivo:TiVo DVR:" + tivo_mak.encode("utf-8")).hexdigest()
-        key = hashlib.sha1(hexmak + xml_key).digest()[:16] + b"\0\0\0\0"
+        key = hashlib.sha1(hexmak.encode("ascii") + xml_key).digest()[:16] + b"\0\0\0\0"
 
-        turkey = hashlib.sha1(key[:17]).digest()
-        turiv = hashlib.sha1(key).digest()
-
-        details = Turing(turkey, turiv).crypt(details, chunk["start"])
+        details = Turing(*tivo_turing_key(key)).crypt(details, chunk.start)
 
     return details
 
@@ -907,11 +987,25 @@ def dump(output: TextIO, metadata: Dict[str, Any]) -> None:
                 output.write("%s: %s\n" % (key, value.encode("utf-8")))
 
 
+def cache_info(inFile: str, mtime: float, vid_info: Any) -> None:
+    if inFile not in INFO_CACHE:
+        folder = os.path.normpath(os.path.dirname(inFile))
+        INFO_ADDED[folder] = INFO_ADDED.get(folder, 0) + 1
+    INFO_CACHE[inFile] = (mtime, vid_info)
+
+
+def info_added(folder: str) -> int:
+    """Changes whenever a file in folder is added to INFO_CACHE."""
+    return INFO_ADDED.get(os.path.normpath(folder), 0)
+
+
 def video_info(inFile: str, cache: bool = True) -> VideoInfo:
     vInfo: Dict[str, Any] = {}
     mtime = os.path.getmtime(inFile)
     if cache:
-        if inFile in INFO_CACHE and INFO_CACHE[inFile][0] == mtime:
+        hit = inFile in INFO_CACHE and INFO_CACHE[inFile][0] == mtime
+        pytivo.metrics.cache_lookup("info", hit)
+        if hit:
             LOGGER.debug("CACHE HIT! %s" % inFile)
             return INFO_CACHE[inFile][1]
 
@@ -930,7 +1024,7 @@ def video_info(inFile: str, cache: bool = True) -> VideoInfo:
         vInfo.update({"millisecs": 0, "vWidth": 704, "vHeight": 480, "rawmeta": {}})
         vid_info = VideoInfo(**vInfo)
         if cache:
-            INFO_CACHE[inFile] = (mtime, vid_info)
+            cache_info(inFile, mtime, vid_info)
         return vid_info
 
     cmd = [ffmpeg_path, "-i", inFile]
@@ -953,7 +1047,7 @@ def video_info(inFile: str, cache: bool = True) -> VideoInfo:
             vInfo["Supported"] = False
             vid_info = VideoInfo(**vInfo)
             if cache:
-                INFO_CACHE[inFile] = (mtime, vid_info)
+                cache_info(inFile, mtime, vid_info)
             return vid_info
     else:
         ffmpeg.wait()
@@ -1150,11 +1244,11 @@ def video_info(inFile: str, cache: bool = True) -> VideoInfo:
                 vInfo[key.replace("Override_", "")] = data[key]
 
     if cache:
-        INFO_CACHE[inFile] = (mtime, vInfo)
+        cache_info(inFile, mtime, vInfo)
     LOGGER.debug("; ".join(["%s=%s" % (k, v) for k, v in list(vInfo.items())]))
     vid_info = VideoInfo(**vInfo)
     if cache:
-        INFO_CACHE[inFile] = (mtime, vid_info)
+        cache_info(inFile, mtime, vid_info)
     return vid_info
 
 
@@ -0,0 +1,200 @@
+"""Request timing and traffic counters, in the Prometheus text format.
+
+pyTivo answers GET /metrics with these when the request comes from the
+local machine. The values are kept per process: with processes > 1 each
+worker reports its own, and a scrape sees whichever worker it reached.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds; send_file waits on ffmpeg probes, so the top buckets are long
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[str, ...]
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ['%s="%s"' % (n, escape_label(v)) for n, v in zip(names, values)]
+    return "{%s}" % ",".join(pairs)
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def header(self) -> List[str]:
+        return [
+            "# HELP %s %s" % (self.name, self.doc),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """The metric's lines, header included."""
+
+
+class Counter(Metric):
+    """A value per label set, that goes up (or, as a gauge, down)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()) -> None:
+        Metric.__init__(self, name, doc, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        lines = self.header()
+        for label_values, value in values:
+            lines.append(
+                "%s%s %s"
+                % (
+                    self.name,
+                    format_labels(self.labels, label_values),
+                    format_value(value),
+                )
+            )
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *values: str, amount: float = 1) -> None:
+        self.inc(*values, amount=-amount)
+
+    @contextmanager
+    def track(self, *values: str) -> Iterator[None]:
+        """Count one more for the length of the with block."""
+        self.inc(*values)
+        try:
+            yield
+        finally:
+            self.dec(*values)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, +Inf last; sum)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *values: str) -> None:
+        with self.lock:
+            if values not in self.values:
+                self.values[values] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.values[values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *values: str) -> Iterator[None]:
+        """Observe how long the with block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *values)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = [
+                (label_values, list(counts), total[0])
+                for label_values, (counts, total) in sorted(self.values.items())
+            ]
+        lines = self.header()
+        names = self.labels + ("le",)
+        for label_values, counts, total in values:
+            cumulative = 0
+            bounds = [format_value(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (
+                        self.name,
+                        format_labels(names, label_values + (bound,)),
+                        cumulative,
+                    )
+                )
+            labels = format_labels(self.labels, label_values)
+            lines.append("%s_sum%s %s" % (self.name, labels, format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+METRICS: List[Metric] = []
+
+REQUEST_SECONDS = Histogram(
+    "pytivo_request_seconds",
+    "Time to answer a TiVoConnect command, or to start sending a video.",
+    ["command"],
+)
+SENT_BYTES = Counter(
+    "pytivo_sent_bytes_total", "Bytes of video, music and static files sent."
+)
+ACTIVE_STREAMS = Gauge("pytivo_active_streams", "Videos being sent.")
+TRANSCODES = Counter(
+    "pytivo_transcodes_total", "ffmpeg transcodes started.", ["plugin"]
+)
+CACHE_REQUESTS = Counter(
+    "pytivo_cache_requests_total",
+    "Cache lookups, by cache and whether they hit.",
+    ["cache", "result"],
+)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def render() -> bytes:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode("utf-8")
@@ -1,50 +1,192 @@
+import concurrent.futures
+import itertools
 import logging
+from operator import attrgetter, itemgetter
 import os
-import sys
 import threading
 import time
-from typing import List, Any, Tuple, TYPE_CHECKING, Optional, Callable, Union, Generic
+from typing import (
+    Iterator,
+    List,
+    Any,
+    Tuple,
+    TYPE_CHECKING,
+    Optional,
+    Callable,
+    Union,
+    Generic,
+    Type,
+    Dict,
+)
+import sqlite3
 import urllib.request
 import urllib.parse
 import urllib.error
 
-from pytivo.lrucache import LRUCache
-from pytivo.pytivo_types import Query, FileData, FileDataLike
+import pytivo.config
+from pytivo.dirindex import DirIndex, get_index
+from pytivo.lrucache import CacheKeyError, LockedLRUCache, LRUCache
+from pytivo.pytivo_types import Bdict, Query, FileData, FileDataLike, Settings
+from pytivo.snapshot import register_cache
 
 if TYPE_CHECKING:
     from pytivo.httpserver import TivoHTTPHandler
 
 LOGGER = logging.getLogger(__name__)
 
+# os.scandir gets the stat info along with the names only on Windows
+STAT_IS_FREE = os.name == "nt"
+
 
 def no_anchor(handler: "TivoHTTPHandler", anchor: str) -> None:
     LOGGER.warning("Anchor not found: " + anchor)
 
 
+def scan_directory(
+    path: str,
+    recurse: bool,
+    filterFunction: Optional[Callable],
+    file_type: str,
+    file_class: Type[FileDataLike],
+) -> List[Union[FileDataLike, str]]:
+    """List one directory with os.scandir, so the entry type needs no
+    further syscalls. With recurse, subdirectories are returned as
+    their path, in place, for the caller to descend into. filterFunction
+    is called as filterFunction(full_path, file_type, isdir)."""
+    items: List[Union[FileDataLike, str]] = []
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError as msg:
+        LOGGER.error("Unable to list %s: %s" % (path, msg))
+        return items
+
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        try:
+            isdir = entry.is_dir()
+        except OSError:
+            isdir = False
+        if recurse and isdir:
+            items.append(entry.path)
+        elif filterFunction is None or filterFunction(entry.path, file_type, isdir):
+            if STAT_IS_FREE:
+                st = entry.stat()
+                items.append(
+                    file_class(entry.path, isdir, st.st_mtime, st.st_ctime, st.st_size)
+                )
+            else:
+                # FileData stats lazily, often only for the page that is shown
+                items.append(file_class(entry.path, isdir))
+    return items
+
+
 # TODO 20191125 Maybe omit file_type if no filter functions use it?
 def build_recursive_list(
     path: str,
     recurse: bool = True,
     filterFunction: Optional[Callable] = None,
     file_type: str = "",
-) -> List[FileData]:
-    files = []
-    try:
-        for f in os.listdir(path):
-            if f.startswith("."):
-                continue
-            f = os.path.join(path, f)
-            isdir = os.path.isdir(f)
-            if recurse and isdir:
-                files.extend(
-                    build_recursive_list(f, recurse, filterFunction, file_type)
+    file_class: Type[FileDataLike] = FileData,  # type: ignore
+) -> List[FileDataLike]:
+    files: List[FileDataLike] = []
+    for item in scan_directory(path, recurse, filterFunction, file_type, file_class):
+        if isinstance(item, str):
+            files.extend(
+                build_recursive_list(
+                    item, recurse, filterFunction, file_type, file_class
                 )
-            else:
-                if filterFunction is None or filterFunction(f, file_type):
-                    files.append(FileData(f, isdir))
-    except:
-        print(f"build_recursive_list() Exception", file=sys.stderr)
-        pass
+            )
+        else:
+            files.append(item)
+    return files
+
+
+def build_recursive_list_parallel(
+    path: str,
+    threads: int,
+    filterFunction: Optional[Callable] = None,
+    file_type: str = "",
+    file_class: Type[FileDataLike] = FileData,  # type: ignore
+) -> List[FileDataLike]:
+    """Recursive build_recursive_list() that scans up to threads directories
+    at once, for filesystems where latency rather than CPU is the limit.
+    The result is in the same order as the serial walk."""
+    scanned: Dict[str, List[Union[FileDataLike, str]]] = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        threads, thread_name_prefix="walk"
+    ) as pool:
+
+        def submit(subdir: str) -> "concurrent.futures.Future":
+            return pool.submit(
+                scan_directory, subdir, True, filterFunction, file_type, file_class
+            )
+
+        pending = {submit(path): path}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                items = future.result()
+                scanned[pending.pop(future)] = items
+                for item in items:
+                    if isinstance(item, str):
+                        pending[submit(item)] = item
+
+    # merge depth first, as the serial walk would
+    files: List[FileDataLike] = []
+    stack = [iter(scanned[path])]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, str):
+                stack.append(iter(scanned[item]))
+                break
+            files.append(item)
+        else:
+            stack.pop()
+    return files
+
+
+def iter_sorted_files(
+    path: str,
+    filterFunction: Optional[Callable] = None,
+    file_type: str = "",
+    file_class: Type[FileDataLike] = FileData,  # type: ignore
+) -> Iterator[FileDataLike]:
+    """Yield the files below path in the order sorting their names would
+    give, reading each directory only when the walk reaches it."""
+    items = scan_directory(path, True, filterFunction, file_type, file_class)
+    # a folder's contents sort as its name plus a separator
+    keyed = sorted(
+        (
+            (item + os.path.sep, item) if isinstance(item, str) else (item.name, item)
+            for item in items
+        ),
+        key=itemgetter(0),
+    )
+    for _, item in keyed:
+        if isinstance(item, str):
+            yield from iter_sorted_files(item, filterFunction, file_type, file_class)
+        else:
+            yield item
+
+
+def sort_files(
+    files: List[FileDataLike], sortby: str, force_alpha: bool
+) -> List[FileDataLike]:
+    """files in the order a QueryContainer with SortOrder sortby lists them."""
+    if force_alpha:
+        # secondary by ascending name
+        files = sorted(files, key=attrgetter("name"))
+        # primary by descending isdir
+        files.sort(key=attrgetter("isdir"), reverse=True)
+    elif sortby == "!CaptureDate":
+        # most recent date at top
+        files = sorted(files, key=attrgetter("mdate"), reverse=True)
+    else:
+        files = sorted(files, key=attrgetter("name"))
     return files
 
 
@@ -72,6 +214,61 @@ class SortList(Generic[FileDataLike]):
         self.unsorted: bool = True
         self.sortby: Optional[str] = None
         self.last_start: int = 0
+        # name -> position in files, built on first lookup after a sort
+        self.positions: Optional[Dict[str, int]] = None
+        # filtered subsets of files in the same order, see view()
+        self.views: Dict[str, "SortList[FileDataLike]"] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # positions and views are cheap to rebuild, so keep them out of snapshots
+        state = self.__dict__.copy()
+        state["positions"] = None
+        state["views"] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.positions = None
+        self.views = {}
+        self.__dict__.update(state)
+
+    def mark_sorted(self, sortby: str) -> None:
+        """Call after reordering files. To keep pages already handed out
+        consistent, reorder a new list and assign it to files rather than
+        sorting files in place."""
+        self.sortby = sortby
+        self.unsorted = False
+        self.positions = None
+        self.views = {}
+
+    def view(
+        self, name: str, predicate: Callable[[FileDataLike], bool]
+    ) -> "SortList[FileDataLike]":
+        """The files for which predicate is true, kept until the next sort.
+        name identifies the predicate."""
+        views = self.views
+        if name not in views:
+            sub = SortList[FileDataLike]([x for x in self.files if predicate(x)])
+            sub.mark_sorted(self.sortby or "")
+            views[name] = sub
+        return views[name]
+
+    def index(self, name: str) -> int:
+        """Position of the file called name, like list.index()."""
+        positions = self.positions
+        if positions is None:
+            positions = {}
+            for i, x in enumerate(self.files):
+                positions.setdefault(x.name, i)
+            self.positions = positions
+        try:
+            return positions[name]
+        except KeyError:
+            raise ValueError(name) from None
+
+    def move_to_front(self, name: str) -> None:
+        self.files.insert(0, self.files.pop(self.index(name)))
+        self.positions = None
+        self.views = {}
 
 
 def GetPlugin(name: str) -> Union["Plugin", Error]:
@@ -96,6 +293,14 @@ class Plugin:
 
     recurse_cache = LRUCache(5)
     dir_cache = LRUCache(10)
+    # path -> thread finishing a Recurse=Yes listing, see first_recursive_page
+    recurse_walks: Dict[str, threading.Thread] = {}
+    recurse_walks_lock = threading.Lock()
+    # (path, file_type) -> (folder mtime, number of children shown)
+    count_cache = LockedLRUCache(1000)
+
+    register_cache("dir", dir_cache)
+    register_cache("count", count_cache, lambda key: key[0])
 
     # TODO 20191124: What is going on here with __it__
     # TODO 20191124: add types to this
@@ -113,6 +318,209 @@ class Plugin:
     def send_file(self, handler: "TivoHTTPHandler", path: str, query: Query) -> None:
         handler.send_content_file(path)
 
+    def get_dir_index(self, handler: "TivoHTTPHandler") -> Optional[DirIndex]:
+        return get_index(handler.container.get("dir_index", "off"))
+
+    def list_files(
+        self,
+        handler: "TivoHTTPHandler",
+        path: str,
+        recurse: bool,
+        filterFunction: Optional[Callable] = None,
+        file_type: str = "",
+        file_class: Type[FileDataLike] = FileData,  # type: ignore
+        refresh: bool = True,
+    ) -> List[FileDataLike]:
+        """List path, from the share's directory index if it has one,
+        otherwise by walking it. refresh=False skips bringing the index up
+        to date, when the caller just did."""
+        return self.list_share_files(
+            handler.container,
+            path,
+            recurse,
+            filterFunction,
+            file_type,
+            file_class,
+            refresh,
+        )
+
+    def list_share_files(
+        self,
+        container: Settings,
+        path: str,
+        recurse: bool,
+        filterFunction: Optional[Callable] = None,
+        file_type: str = "",
+        file_class: Type[FileDataLike] = FileData,  # type: ignore
+        refresh: bool = True,
+    ) -> List[FileDataLike]:
+        """list_files() for the share with settings container, for work that
+        outlives the request (the handler's container changes with the next
+        request on its connection)."""
+        index = get_index(container.get("dir_index", "off"))
+        if index is not None:
+            try:
+                if refresh:
+                    index.refresh(path, recurse)
+                return [
+                    file_class(name, isdir, mtime, ctime, size)
+                    for name, isdir, mtime, ctime, size in index.listing(path, recurse)
+                    if filterFunction is None or filterFunction(name, file_type, isdir)
+                ]
+            except sqlite3.Error as msg:
+                LOGGER.error("Directory index failed, walking %s: %s" % (path, msg))
+
+        try:
+            threads = int(container.get("walk_threads", "0"))
+        except ValueError:
+            threads = 0
+        if recurse and threads > 1:
+            return build_recursive_list_parallel(
+                path, threads, filterFunction, file_type, file_class
+            )
+        return build_recursive_list(
+            path, recurse, filterFunction, file_type, file_class
+        )
+
+    def child_count(
+        self,
+        handler: "TivoHTTPHandler",
+        path: str,
+        filterFunction: Callable,
+        file_type: str = "",
+        stamp: Any = None,
+    ) -> int:
+        """Number of entries in folder path that filterFunction accepts,
+        cached until the folder's mtime, the config or stamp (anything else
+        filterFunction depends on) changes."""
+        key = (path, file_type, pytivo.config.CONFIG_GENERATION)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError as msg:
+            LOGGER.warning("Unable to count %s: %s" % (path, msg))
+            return 0
+
+        cc = self.count_cache
+        if key in cc:
+            cached_mtime, cached_stamp, count = cc[key]
+            if cached_mtime == mtime and cached_stamp == stamp:
+                return count
+
+        index = self.get_dir_index(handler)
+        if index is not None:
+            try:
+                index.refresh(path, False)
+                count = sum(
+                    1
+                    for name, isdir, _, _, _ in index.listing(path, False)
+                    if filterFunction(name, file_type, isdir)
+                )
+                cc[key] = (mtime, stamp, count)
+                return count
+            except sqlite3.Error as msg:
+                LOGGER.error("Directory index failed for %s: %s" % (path, msg))
+
+        count = 0
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    try:
+                        isdir = entry.is_dir()
+                    except OSError:
+                        isdir = False
+                    if filterFunction(entry.path, file_type, isdir):
+                        count += 1
+        except OSError as msg:
+            LOGGER.warning("Unable to list %s: %s" % (path, msg))
+            return count
+        cc[key] = (mtime, stamp, count)
+        return count
+
+    def first_recursive_page(
+        self,
+        handler: "TivoHTTPHandler",
+        query: Query,
+        path: str,
+        filterFunction: Optional[Callable],
+        file_type: str,
+        sortby: str,
+        estimate: Optional[int],
+    ) -> Optional[Tuple[List[FileData], int, int]]:
+        """Answer the first page of a name-sorted Recurse=Yes listing by
+        walking only as far as that page needs, and finish the listing in the
+        background for later pages. TotalItems is estimate, the total of an
+        earlier listing of an unchanged path; without one, None is returned
+        so the listing is walked in full."""
+        if estimate is None or not handler.container.getboolean("stream_recurse"):
+            return None
+        if "AnchorItem" in query or self.get_dir_index(handler) is not None:
+            return None
+        try:
+            count = int(query["ItemCount"][0])
+        except (KeyError, ValueError):
+            return None
+        if count <= 0:
+            return None
+
+        with self.recurse_walks_lock:
+            if path not in self.recurse_walks:
+                walk = threading.Thread(
+                    target=self.finish_recursive_walk,
+                    args=(
+                        Bdict(handler.container),
+                        path,
+                        filterFunction,
+                        file_type,
+                        sortby,
+                    ),
+                    name="recurse-walk",
+                    daemon=True,
+                )
+                self.recurse_walks[path] = walk
+                walk.start()
+
+        files = list(
+            itertools.islice(
+                iter_sorted_files(path, filterFunction, file_type), count + 1
+            )
+        )
+        if len(files) <= count:
+            return files, len(files), 0
+        return files[:count], max(estimate, len(files)), 0
+
+    def finish_recursive_walk(
+        self,
+        container: Settings,
+        path: str,
+        filterFunction: Optional[Callable],
+        file_type: str,
+        sortby: str,
+    ) -> None:
+        try:
+            filelist = SortList[FileData](
+                sorted(
+                    self.list_share_files(
+                        container, path, True, filterFunction, file_type
+                    ),
+                    key=attrgetter("name"),
+                )
+            )
+            filelist.mark_sorted(sortby)
+            self.recurse_cache[path] = filelist
+        except Exception:
+            LOGGER.exception("Unable to list %s" % path)
+        finally:
+            with self.recurse_walks_lock:
+                del self.recurse_walks[path]
+
+    def wait_for_recursive_walk(self, path: str) -> None:
+        with self.recurse_walks_lock:
+            walk = self.recurse_walks.get(path)
+        if walk is not None:
+            walk.join()
+
     def get_local_base_path(self, handler: "TivoHTTPHandler", query: Query) -> str:
         return os.path.normpath(handler.container["path"])
 
@@ -134,10 +542,12 @@ class Plugin:
         cname: str,
         files: List[FileDataLike],
         last_start: int = 0,
+        find: Optional[Callable[[str], int]] = None,
     ) -> Tuple[List[FileDataLike], int, int]:
         """Return only the desired portion of the list, as specified by
            ItemCount, AnchorItem and AnchorOffset. 'files' is
-           a list of objects with a 'name' attribute.
+           a list of objects with a 'name' attribute. 'find', if given,
+           maps a name to its index in files, e.g. SortList.index.
         """
 
         totalFiles = len(files)
@@ -158,21 +568,23 @@ class Plugin:
                 if "://" not in anchor:
                     anchor = os.path.normpath(anchor)
 
-                # if type(files[0]) == str:
-                #    filenames = files
-                # else:
-                #    filenames = [x.name for x in files]
-                filenames = [x.name for x in files]
-                try:
-                    index = filenames.index(anchor, last_start)
-                except ValueError:
-                    if last_start:
-                        try:
-                            index = filenames.index(anchor, 0, last_start)
-                        except ValueError:
-                            no_anchor(handler, anchor)
-                    else:
+                if find is not None:
+                    try:
+                        index = find(anchor)
+                    except ValueError:
                         no_anchor(handler, anchor)  # just use index = 0
+                else:
+                    filenames = [x.name for x in files]
+                    try:
+                        index = filenames.index(anchor, last_start)
+                    except ValueError:
+                        if last_start:
+                            try:
+                                index = filenames.index(anchor, 0, last_start)
+                            except ValueError:
+                                no_anchor(handler, anchor)
+                        else:
+                            no_anchor(handler, anchor)  # just use index = 0
 
                 if count > 0:
                     index += 1
@@ -183,12 +595,31 @@ class Plugin:
             if count < 0:
                 index = (index + count) % len(files)
                 count = -count
+            # only the window is copied, files may be a cached listing
             files = files[index : index + count]
 
         return files, totalFiles, index
 
     # Returns List[Any] but really we want here List[FileData] and in
     #   children parent List[FileData*]
+    def cached_files(
+        self, handler: "TivoHTTPHandler", query: Query, allow_recurse: bool = True
+    ) -> List[Any]:
+        """The sorted listing that get_files() just answered query from, or
+        an empty list if it wasn't kept."""
+        path = self.get_local_path(handler, query)
+        if allow_recurse and query.get("Recurse", ["No"])[0] == "Yes":
+            cache = self.recurse_cache
+        else:
+            cache = self.dir_cache
+        try:
+            filelist = cache[path]
+        except CacheKeyError:
+            return []
+        if filelist.sortby != query.get("SortOrder", ["Normal"])[0]:
+            return []
+        return filelist.files
+
     def get_files(
         self,
         handler: "TivoHTTPHandler",
@@ -203,12 +634,27 @@ class Plugin:
 
         recurse = allow_recurse and query.get("Recurse", ["No"])[0] == "Yes"
 
+        sortby = query.get("SortOrder", ["Normal"])[0]
+
         filelist = SortList[FileData]([])
         rc = self.recurse_cache
         dc = self.dir_cache
+        index = self.get_dir_index(handler)
+        refresh = True
         if recurse:
+            self.wait_for_recursive_walk(path)
             if path in rc and rc.mtime(path) + 300 >= time.time():
                 filelist = rc[path]
+            elif path in rc and index is not None:
+                # the index tells us whether anything below path changed
+                try:
+                    if not index.refresh(path, True):
+                        filelist = rc[path]
+                        # good for another 300 seconds
+                        rc[path] = filelist
+                    refresh = False
+                except sqlite3.Error as msg:
+                    LOGGER.error("Directory index failed for %s: %s" % (path, msg))
         else:
             updated = os.path.getmtime(path)
             if path in dc and dc.mtime(path) >= updated:
@@ -217,9 +663,33 @@ class Plugin:
                 if path.startswith(p) and rc.mtime(p) < updated:
                     del rc[p]
 
+        if not filelist.files and recurse and (force_alpha or sortby != "!CaptureDate"):
+            # a recursive listing has no folders, so force_alpha is name order
+            estimate = None
+            if path in rc and rc.mtime(path) >= os.path.getmtime(path):
+                estimate = len(rc[path].files)
+            first_page = self.first_recursive_page(
+                handler,
+                query,
+                path,
+                filterFunction,
+                file_type,
+                sortby,
+                estimate,
+            )
+            if first_page is not None:
+                return first_page
+
         if not filelist.files:
             filelist = SortList[FileData](
-                build_recursive_list(path, recurse, filterFunction, file_type)
+                self.list_files(
+                    handler,
+                    path,
+                    recurse,
+                    filterFunction,
+                    file_type,
+                    refresh=refresh,
+                )
             )
 
             if recurse:
@@ -227,27 +697,18 @@ class Plugin:
             else:
                 dc[path] = filelist
 
-        sortby = query.get("SortOrder", ["Normal"])[0]
         if filelist.unsorted or filelist.sortby != sortby:
-            if force_alpha:
-                # secondary by ascending name
-                filelist.files.sort(key=lambda x: x.name)
-                # primary by descending isdir
-                filelist.files.sort(key=lambda x: x.isdir, reverse=True)
-            elif sortby == "!CaptureDate":
-                # most recent date at top
-                filelist.files.sort(key=lambda x: x.mdate, reverse=True)
-            else:
-                filelist.files.sort(key=lambda x: x.name)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
-
-        files = filelist.files[:]
+            filelist.files = sort_files(filelist.files, sortby, force_alpha)
+            filelist.mark_sorted(sortby)
 
         # Trim the list
         files, total, start = self.item_count(
-            handler, query, handler.cname, files, filelist.last_start
+            handler,
+            query,
+            handler.cname,
+            filelist.files,
+            filelist.last_start,
+            filelist.index,
         )
         if len(files) > 1:
             filelist.last_start = start
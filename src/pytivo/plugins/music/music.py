@@ -1,9 +1,9 @@
 from functools import partial
+from operator import attrgetter
 import logging
 import os
 import random
 import re
-import shutil
 import subprocess
 import time
 from typing import TYPE_CHECKING, Dict, Any, List, Optional, Union, Callable, Tuple
@@ -17,11 +17,15 @@ from mutagen.easyid3 import EasyID3  # type: ignore
 from mutagen.mp3 import MP3  # type: ignore
 from Cheetah.Template import Template  # type: ignore
 
-from pytivo.lrucache import LRUCache
+from pytivo.lrucache import LockedLRUCache, LRUCache
+import pytivo.config
 from pytivo.config import get_bin
+import pytivo.metrics
 from pytivo.plugin import Plugin, SortList, quote, unquote
 from pytivo.plugins.video.transcode import kill
 from pytivo.pytivo_types import Query, FileData
+from pytivo.snapshot import register_cache
+from pytivo.xmlstream import FragmentCache, send_page
 
 if TYPE_CHECKING:
     from pytivo.httpserver import TivoHTTPHandler
@@ -70,8 +74,11 @@ plslength = re.compile(r"[Ll]ength(\d+)=(\d+)").match
 durre = re.compile(r".*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),").search
 
 # Compile the templates
-MUSIC_CONTAINER_TCLASS = Template.compile(
-    file=os.path.join(SCRIPTDIR, "templates", "container.tmpl")
+MUSIC_CONTAINER_HEAD_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_head.tmpl")
+)
+MUSIC_CONTAINER_ITEM_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_item.tmpl")
 )
 MUSIC_M3U_TCLASS = Template.compile(
     file=os.path.join(SCRIPTDIR, "templates", "m3u.tmpl")
@@ -82,8 +89,17 @@ MUSIC_ITEM_TCLASS = Template.compile(
 
 
 class FileDataMusic(FileData):
-    def __init__(self, name: str, isdir: bool) -> None:
-        super().__init__(name, isdir)
+    __slots__ = ("isplay", "title", "duration")
+
+    def __init__(
+        self,
+        name: str,
+        isdir: bool,
+        mdate: Optional[float] = None,
+        cdate: Optional[float] = None,
+        size: Optional[int] = None,
+    ) -> None:
+        super().__init__(name, isdir, mdate, cdate, size)
         self.isplay = os.path.splitext(name)[1].lower() in PLAYLISTS
         self.title = ""
         self.duration = 0
@@ -102,31 +118,6 @@ def get_tag(tagname: str, d: Dict[str, Any]) -> str:
     return ""
 
 
-def build_recursive_list(
-    path: str,
-    recurse: bool = True,
-    filterFunction: Optional[Callable] = None,
-    file_type: str = "",
-) -> List[FileDataMusic]:
-    files = []
-    try:
-        for f in os.listdir(path):
-            if f.startswith("."):
-                continue
-            f = os.path.join(path, f)
-            isdir = os.path.isdir(f)
-            if recurse and isdir:
-                files.extend(
-                    build_recursive_list(f, recurse, filterFunction, file_type)
-                )
-            else:
-                if filterFunction is None or filterFunction(f, file_type):
-                    files.append(FileDataMusic(f, isdir))
-    except:
-        pass
-    return files
-
-
 class Music(Plugin):
     CONTENT_TYPE = "x-container/tivo-music"
     AUDIO = "audio"
@@ -136,6 +127,13 @@ class Music(Plugin):
     media_data_cache = LRUCache(300)
     recurse_cache = LRUCache(5)
     dir_cache = LRUCache(10)
+    count_cache = LockedLRUCache(1000)
+
+    register_cache("music.media_data", media_data_cache)
+    register_cache("music.dir", dir_cache)
+    register_cache("music.count", count_cache, lambda key: key[0])
+    # rendered container items, see container_item
+    fragment_cache = FragmentCache(1000)
 
     def send_file(self, handler: "TivoHTTPHandler", path: str, query: Query) -> None:
         seek = int(query.get("Seek", ["0"])[0])
@@ -146,52 +144,45 @@ class Music(Plugin):
         needs_transcode = ext in TRANSCODE or seek or duration or always
 
         if not needs_transcode:
-            fsize = os.path.getsize(path)
-            handler.send_response(200)
-            handler.send_header("Content-Length", str(fsize))
-        else:
-            if get_bin("ffmpeg") is None:
-                LOGGER.error("ffmpeg is not found.  Aborting transcode.")
-                return
-            handler.send_response(206)
-            handler.send_header("Transfer-Encoding", "chunked")
+            handler.send_content_file(path, "audio/mpeg")
+            return
+
+        if get_bin("ffmpeg") is None:
+            LOGGER.error("ffmpeg is not found.  Aborting transcode.")
+            return
+        handler.send_response(206)
+        handler.send_header("Transfer-Encoding", "chunked")
         handler.send_header("Content-Type", "audio/mpeg")
         handler.end_headers()
 
-        if needs_transcode:
-            cmd: List[str]
-            cmd = [get_bin("ffmpeg"), "-i", path, "-vn"]  # type: ignore
-            if ext in [".mp3", ".mp2"]:
-                cmd += ["-acodec", "copy"]
-            else:
-                cmd += ["-ab", "320k", "-ar", "44100"]
-            cmd += ["-f", "mp3", "-"]
-            if seek:
-                cmd[-1:] = ["-ss", "%.3f" % (seek / 1000.0), "-"]
-            if duration:
-                cmd[-1:] = ["-t", "%.3f" % (duration / 1000.0), "-"]
-
-            ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE, stdout=subprocess.PIPE)
-            while True:
-                try:
-                    block = ffmpeg.stdout.read(BLOCKSIZE)
-                    handler.wfile.write(b"%x\r\n" % len(block))
-                    handler.wfile.write(block)
-                    handler.wfile.write(b"\r\n")
-                except Exception as msg:
-                    LOGGER.info(msg)
-                    kill(ffmpeg)
-                    break
-
-                if not block:
-                    break
+        cmd: List[str]
+        cmd = [get_bin("ffmpeg"), "-i", path, "-vn"]  # type: ignore
+        if ext in [".mp3", ".mp2"]:
+            cmd += ["-acodec", "copy"]
         else:
-            f = open(path, "rb")
+            cmd += ["-ab", "320k", "-ar", "44100"]
+        cmd += ["-f", "mp3", "-"]
+        if seek:
+            cmd[-1:] = ["-ss", "%.3f" % (seek / 1000.0), "-"]
+        if duration:
+            cmd[-1:] = ["-t", "%.3f" % (duration / 1000.0), "-"]
+
+        pytivo.metrics.TRANSCODES.inc("music")
+        ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE, stdout=subprocess.PIPE)
+        while True:
             try:
-                shutil.copyfileobj(f, handler.wfile)
-            except:
-                pass
-            f.close()
+                block = ffmpeg.stdout.read(BLOCKSIZE)
+                handler.wfile.write(b"%x\r\n" % len(block))
+                handler.wfile.write(block)
+                handler.wfile.write(b"\r\n")
+                pytivo.metrics.SENT_BYTES.inc(amount=len(block))
+            except Exception as msg:
+                LOGGER.info(msg)
+                kill(ffmpeg)
+                break
+
+            if not block:
+                break
 
         try:
             handler.wfile.flush()
@@ -200,7 +191,7 @@ class Music(Plugin):
 
     # TODO 20191125: should this return only bool?
     def AudioFileFilter(
-        self, f: str, filter_type: Optional[str] = None
+        self, f: str, filter_type: Optional[str] = None, isdir: Optional[bool] = None
     ) -> Union[bool, str]:
         ext = os.path.splitext(f)[1].lower()
 
@@ -214,7 +205,7 @@ class Music(Plugin):
             if filter_type is None or filter_type.split("/")[0] != self.AUDIO:
                 if ext in PLAYLISTS:
                     file_type = self.PLAYLIST
-                elif os.path.isdir(f):
+                elif isdir or (isdir is None and os.path.isdir(f)):
                     file_type = self.DIRECTORY
 
             return file_type
@@ -324,20 +315,59 @@ class Music(Plugin):
         if os.path.splitext(subcname)[1].lower() in PLAYLISTS:
             t = MUSIC_M3U_TCLASS()
             t.files, t.total, t.start = self.get_playlist(handler, query)
-        else:
-            t = MUSIC_CONTAINER_TCLASS()
-            t.files, t.total, t.start = self.get_files(
-                handler, query, self.AudioFileFilter
+            t.files = list(
+                map(partial(self.media_data, local_base_path=local_base_path), t.files)
             )
-        t.files = list(
-            map(partial(self.media_data, local_base_path=local_base_path), t.files)
+            t.container = handler.cname
+            t.name = subcname
+            t.quote = quote
+            t.escape = escape
+            handler.send_xml(str(t))
+            return
+
+        files, total, start = self.get_files(handler, query, self.AudioFileFilter)
+        file_type = query.get("Filter", [""])[0]
+
+        head = MUSIC_CONTAINER_HEAD_TCLASS()
+        head.name = subcname
+        head.start = start
+        head.total = total
+        head.count = len(files)
+        head.escape = escape
+        items = (
+            self.container_item(handler, subcname, f, local_base_path, file_type)
+            for f in files
         )
-        t.container = handler.cname
-        t.name = subcname
-        t.quote = quote
-        t.escape = escape
+        send_page(handler, str(head), items, len(files))
 
-        handler.send_xml(str(t))
+    def container_item(
+        self,
+        handler: "TivoHTTPHandler",
+        subcname: str,
+        f: FileDataMusic,
+        local_base_path: str,
+        file_type: str,
+    ) -> bytes:
+        count = None
+        if f.isdir:
+            count = self.child_count(handler, f.name, self.AudioFileFilter, file_type)
+
+        def render() -> str:
+            item = self.media_data(f, local_base_path)
+            if f.isdir:
+                # media_data items are cached, so don't store the count in them
+                item = dict(item, total_items=count)
+            t = MUSIC_CONTAINER_ITEM_TCLASS()
+            t.file = item
+            t.container = handler.cname
+            t.name = subcname
+            t.quote = quote
+            t.escape = escape
+            return str(t)
+
+        key = (handler.cname, subcname, f.name)
+        stamp = (f.mdate, count, pytivo.config.CONFIG_GENERATION)
+        return self.fragment_cache.render(key, stamp, render)
 
     # this is a TivoConnect Command, so must be named this exactly
     def QueryItem(self, handler: "TivoHTTPHandler", query: Query) -> None:
@@ -479,7 +509,9 @@ class Music(Plugin):
 
         if not filelist.files:
             filelist = SortList[FileDataMusic](
-                build_recursive_list(path, recurse, filterFunction, file_type)
+                self.list_files(
+                    handler, path, recurse, filterFunction, file_type, FileDataMusic
+                )
             )
 
             if recurse:
@@ -501,38 +533,40 @@ class Music(Plugin):
 
         if filelist.unsorted or filelist.sortby != sortby:
             if "Random" in sortby:
+                files = filelist.files[:]
                 self.random_lock.acquire()
                 if seed:
                     random.seed(seed)
-                random.shuffle(filelist.files)
+                random.shuffle(files)
                 self.random_lock.release()
+                filelist.files = files
                 if start:
                     local_base_path = self.get_local_base_path(handler, query)
                     start = unquote(start)
                     start = start.replace(
                         os.path.sep + handler.cname, local_base_path, 1
                     )
-                    filenames = [x.name for x in filelist.files]
                     try:
-                        index = filenames.index(start)
-                        i = filelist.files.pop(index)
-                        filelist.files.insert(0, i)
+                        filelist.move_to_front(start)
                     except ValueError:
                         LOGGER.warning("Start not found: " + start)
             else:
                 # secondary by ascending name
-                filelist.files.sort(key=lambda x: x.name)
+                files = sorted(filelist.files, key=attrgetter("name"))
                 # primary by descending isdir
-                filelist.files.sort(key=lambda x: x.isdir, reverse=True)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
+                files.sort(key=attrgetter("isdir"), reverse=True)
+                filelist.files = files
 
-        files = filelist.files[:]
+            filelist.mark_sorted(sortby)
 
         # Trim the list
         files, total, start_item = self.item_count(
-            handler, query, handler.cname, files, filelist.last_start
+            handler,
+            query,
+            handler.cname,
+            filelist.files,
+            filelist.last_start,
+            filelist.index,
         )
         filelist.last_start = start_item
         return files, total, start_item
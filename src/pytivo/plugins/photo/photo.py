@@ -24,7 +24,7 @@
 # Version 0.2,  Dec. 8  -- thumbnail caching, faster thumbnails
 # Version 0.1,  Dec. 7, 2007
 
-from functools import partial
+from operator import attrgetter
 import logging
 import os
 import re
@@ -49,11 +49,14 @@ except ImportError:
 
 from Cheetah.Template import Template  # type: ignore
 
+import pytivo.config
 from pytivo.config import getFFmpegWait, get_bin
-from pytivo.lrucache import LRUCache
-from pytivo.plugin import Plugin, SortList, build_recursive_list, quote, unquote
+from pytivo.lrucache import LockedLRUCache
+from pytivo.plugin import Plugin, SortList, quote, unquote
 from pytivo.plugins.video.transcode import kill
 from pytivo.pytivo_types import Query, FileData
+from pytivo.snapshot import register_cache
+from pytivo.xmlstream import FragmentCache, send_page
 
 if TYPE_CHECKING:
     from pytivo.httpserver import TivoHTTPHandler
@@ -96,8 +99,11 @@ exif_orient_m = re.compile(b"\x01\x12\x00\x03\x00\x00\x00\x01\x00(.)\x00\x00").s
 ffmpeg_size = re.compile(r".*Video: .+, (\d+)x(\d+)[, ].*")
 
 # Compile the templates
-PHOTO_CONTAINER_TCLASS = Template.compile(
-    file=os.path.join(SCRIPTDIR, "templates", "container.tmpl")
+PHOTO_CONTAINER_HEAD_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_head.tmpl")
+)
+PHOTO_CONTAINER_ITEM_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_item.tmpl")
 )
 PHOTO_ITEM_TCLASS = Template.compile(
     file=os.path.join(SCRIPTDIR, "templates", "item.tmpl")
@@ -106,8 +112,10 @@ PHOTO_ITEM_TCLASS = Template.compile(
 JFIF_TAG = b"\xff\xe0\x00\x10JFIF\x00\x01\x02\x00\x00\x01\x00\x01\x00\x00"
 
 
-def ImageFileFilter(f: str, filter_type: Optional[str] = None) -> bool:
-    if os.path.isdir(f):
+def ImageFileFilter(
+    f: str, filter_type: Optional[str] = None, isdir: Optional[bool] = None
+) -> bool:
+    if isdir or (isdir is None and os.path.isdir(f)):
         return True
     return os.path.splitext(f)[1].lower() in IMAGE_FILE_EXTS
 
@@ -121,16 +129,14 @@ class SortListLock(SortList):
         super().__init__(files)
         self.lock = threading.RLock()
 
-    def acquire(self, blocking: bool = True) -> bool:
-        return self.lock.acquire(blocking)
-
-    def release(self) -> None:
-        self.lock.release()
-
+    def __getstate__(self) -> Dict[str, Any]:
+        # locks can't be pickled, so drop it for cache snapshots
+        state = super().__getstate__()
+        del state["lock"]
+        return state
 
-class LockedLRUCache(LRUCache):
-    def __init__(self, num: int) -> None:
-        LRUCache.__init__(self, num)
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        super().__setstate__(state)
         self.lock = threading.RLock()
 
     def acquire(self, blocking: bool = True) -> bool:
@@ -139,22 +145,6 @@ class LockedLRUCache(LRUCache):
     def release(self) -> None:
         self.lock.release()
 
-    def __setitem__(self, key: str, obj: Any) -> None:
-        self.acquire()
-        try:
-            LRUCache.__setitem__(self, key, obj)
-        finally:
-            self.release()
-
-    def __getitem__(self, key: str) -> Any:
-        item = None
-        self.acquire()
-        try:
-            item = LRUCache.__getitem__(self, key)
-        finally:
-            self.release()
-        return item
-
 
 class Photo(Plugin):
 
@@ -164,6 +154,11 @@ class Photo(Plugin):
     recurse_cache = LockedLRUCache(5)  # recursive directory lists
     dir_cache = LockedLRUCache(10)  # non-recursive lists
 
+    register_cache("photo.media_data", media_data_cache)
+    register_cache("photo.dir", dir_cache)
+    # rendered container items, see container_item
+    fragment_cache = FragmentCache(1000)
+
     def new_size(
         self, oldw: int, oldh: int, width: int, height: int, pshape: str
     ) -> Tuple[int, int]:
@@ -488,17 +483,39 @@ class Photo(Plugin):
             handler.send_error(404)
             return
 
-        t = PHOTO_CONTAINER_TCLASS()
-        t.name = query["Container"][0]
-        t.container = handler.cname
-        t.files, t.total, t.start = self.get_files(handler, query, ImageFileFilter)
-        t.files = list(
-            map(partial(self.media_data, local_base_path=local_base_path), t.files)
+        subcname = query["Container"][0]
+        files, total, start = self.get_files(handler, query, ImageFileFilter)
+
+        head = PHOTO_CONTAINER_HEAD_TCLASS()
+        head.name = subcname
+        head.start = start
+        head.total = total
+        head.count = len(files)
+        head.escape = escape
+        items = (
+            self.container_item(handler, subcname, f, local_base_path) for f in files
         )
-        t.quote = quote
-        t.escape = escape
+        send_page(handler, str(head), items, len(files))
 
-        handler.send_xml(str(t))
+    def container_item(
+        self,
+        handler: "TivoHTTPHandler",
+        subcname: str,
+        f: FileData,
+        local_base_path: str,
+    ) -> bytes:
+        def render() -> str:
+            t = PHOTO_CONTAINER_ITEM_TCLASS()
+            t.file = self.media_data(f, local_base_path)
+            t.container = handler.cname
+            t.name = subcname
+            t.quote = quote
+            t.escape = escape
+            return str(t)
+
+        key = (handler.cname, subcname, f.name)
+        stamp = (f.mdate, pytivo.config.CONFIG_GENERATION)
+        return self.fragment_cache.render(key, stamp, render)
 
     def QueryItem(self, handler: "TivoHTTPHandler", query: Query) -> None:
         uq = urllib.parse.unquote_plus
@@ -541,7 +558,9 @@ class Photo(Plugin):
                     del rc[p]
 
         if not filelist.files:
-            filelist = SortListLock(build_recursive_list(path, recurse, filterFunction))
+            filelist = SortListLock(
+                self.list_files(handler, path, recurse, filterFunction)
+            )
 
             if recurse:
                 rc[path] = filelist
@@ -564,56 +583,54 @@ class Photo(Plugin):
 
         if filelist.unsorted or filelist.sortby != sortby:
             if "Random" in sortby:
+                files = filelist.files[:]
                 self.random_lock.acquire()
                 if seed:
                     random.seed(seed)
-                random.shuffle(filelist.files)
+                random.shuffle(files)
                 self.random_lock.release()
+                filelist.files = files
                 if start:
                     local_base_path = self.get_local_base_path(handler, query)
                     start = unquote(start)
                     start = start.replace(
                         os.path.sep + handler.cname, local_base_path, 1
                     )
-                    filenames = [x.name for x in filelist.files]
                     try:
-                        index = filenames.index(start)
-                        i = filelist.files.pop(index)
-                        filelist.files.insert(0, i)
+                        filelist.move_to_front(start)
                     except ValueError:
                         LOGGER.warning("Start not found: " + start)
             else:
                 if "Type" in sortby:
                     # secondary by ascending name
-                    filelist.files.sort(key=lambda x: x.name)
+                    files = sorted(filelist.files, key=attrgetter("name"))
                     # primary by descending isdir
-                    filelist.files.sort(key=lambda x: x.isdir, reverse=True)
+                    files.sort(key=attrgetter("isdir"), reverse=True)
                 elif "CaptureDate" in sortby:
-                    filelist.files.sort(key=lambda x: x.cdate)
+                    files = sorted(filelist.files, key=attrgetter("cdate"))
                 elif "LastChangeDate" in sortby:
-                    filelist.files.sort(key=lambda x: x.mdate)
+                    files = sorted(filelist.files, key=attrgetter("mdate"))
                 else:
-                    filelist.files.sort(key=lambda x: x.name)
-
-            filelist.sortby = sortby
-            filelist.unsorted = False
+                    files = sorted(filelist.files, key=attrgetter("name"))
+                filelist.files = files
 
-        files = filelist.files[:]
+            filelist.mark_sorted(sortby)
 
         # Filter it -- this section needs work
+        shown: SortList = filelist
         if "Filter" in query:
             # e.g. "x-container/folder,image/*"
             q_filter = query["Filter"][0]
             usedir = "folder" in q_filter
             useimg = "image" in q_filter
             if not usedir:
-                files = [x for x in files if not x.isdir]
+                shown = filelist.view("items", lambda x: not x.isdir)
             elif usedir and not useimg:
-                files = [x for x in files if x.isdir]
+                shown = filelist.view("folders", lambda x: x.isdir)
 
         files, total, start_item = self.item_count(
-            handler, query, handler.cname, files, filelist.last_start
+            handler, query, handler.cname, shown.files, shown.last_start, shown.index
         )
-        filelist.last_start = start_item
+        shown.last_start = start_item
         filelist.release()
         return files, total, start_item
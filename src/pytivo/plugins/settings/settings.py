@@ -1,5 +1,7 @@
 import logging
+import math
 import os
+import time
 from typing import TYPE_CHECKING
 from urllib.parse import quote
 
@@ -8,6 +10,7 @@ from Cheetah.Template import Template  # type: ignore
 from . import buildhelp
 import pytivo.config
 from pytivo.config import config_reset, config_write
+import pytivo.profiler
 from pytivo.plugin import Plugin
 from pytivo.pytivo_types import Query
 
@@ -29,6 +32,11 @@ RESTART_MSG = """<h3>Restart</h3> <p>pyTivo will now restart.</p>"""
 
 GOODBYE_MSG = "Goodbye.\n"
 
+PROFILE_BUSY_MSG = "A profile is already being taken.\n"
+
+# seconds to profile for when neither Seconds nor Requests is given
+PROFILE_SECONDS = 10
+
 SETTINGS_MSG = """<h3>Settings Saved</h3> <p>Your settings have been
  saved to the pyTivo.conf file. However you may need to do a <b>Soft
  Reset</b> or <b>Restart</b> before these changes will take effect.</p>"""
@@ -71,6 +79,52 @@ class Settings(Plugin):
         handler.redir(RESET_MSG, 3)
         LOGGER.info("pyTivo has been soft reset.")
 
+    def Profile(self, handler: "TivoHTTPHandler", query: Query) -> None:
+        """Sample the server's threads and send back where they spent their
+        time. Seconds=N samples every thread for N seconds; Requests=N and
+        Match=<command> sample only the threads answering that command
+        (or send_file), until N of them are done. Format is collapsed
+        (default) or pstats."""
+        try:
+            requests = int(query.get("Requests", ["0"])[0])
+            default = pytivo.profiler.MAX_SECONDS if requests else PROFILE_SECONDS
+            seconds = float(query.get("Seconds", [str(default)])[0])
+        except ValueError:
+            handler.send_error(400)
+            return
+        match = query.get("Match", [""])[0]
+        fmt = query.get("Format", ["collapsed"])[0]
+        if (
+            not math.isfinite(seconds)
+            or seconds <= 0
+            or requests < 0
+            or fmt not in pytivo.profiler.FORMATS
+            or bool(requests) != bool(match)
+        ):
+            handler.send_error(400)
+            return
+
+        LOGGER.info("Profiling %s" % (match or "%g seconds" % seconds))
+        session = pytivo.profiler.profile(seconds, match or None, requests)
+        if session is None:
+            handler.send_fixed(PROFILE_BUSY_MSG.encode("utf-8"), "text/plain", 409)
+            return
+        LOGGER.info("Profile done, %d samples" % session.samples)
+
+        body = pytivo.profiler.render(session, fmt)
+        if fmt == "pstats":
+            mime, ext = "application/octet-stream", "pstats"
+        else:
+            mime, ext = "text/plain; charset=utf-8", "txt"
+        name = "pytivo-%s.%s" % (time.strftime("%Y%m%d-%H%M%S"), ext)
+        handler.send_response(200)
+        handler.send_header("Content-Type", mime)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.send_header("Content-Disposition", 'attachment; filename="%s"' % name)
+        handler.end_headers()
+        handler.wfile.write(body)
+        handler.wfile.flush()
+
     def Settings(self, handler: "TivoHTTPHandler", query: Query) -> None:
         # Read config file new each time in case there was any outside edits
         config_reset()
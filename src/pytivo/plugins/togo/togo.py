@@ -18,7 +18,6 @@ from Cheetah.Template import Template  # type: ignore
 import pytivo.config
 from pytivo.config import (
     getShares,
-    get_bin,
     get_server,
     get_tsn,
     is_ts_capable,
@@ -27,6 +26,7 @@ from pytivo.config import (
 from pytivo.metadata import dump, from_container, from_details, human_size, tag_data
 from pytivo.plugin import Plugin
 from pytivo.pytivo_types import Query
+from pytivo.tivodecode import decoder_cmd
 
 if TYPE_CHECKING:
     from pytivo.httpserver import TivoHTTPHandler
@@ -157,7 +157,6 @@ class ToGo(Plugin):
         shows_per_page = 50  # Change this to alter the number of shows returned
         folder = ""
         FirstAnchor = ""
-        has_tivodecode = bool(get_bin("tivodecode"))
 
         if "TiVo" in query:
             tivoIP = query["TiVo"][0]
@@ -283,7 +282,6 @@ class ToGo(Plugin):
         t.status = STATUS
         if tivoIP in QUEUE:
             t.queue = QUEUE[tivoIP]
-        t.has_tivodecode = has_tivodecode
         t.togo_mpegts = is_ts_capable(tsn)
         t.tname = tivo_name
         t.tivoIP = tivoIP
@@ -358,13 +356,7 @@ class ToGo(Plugin):
         )
 
         if STATUS[url]["decode"]:
-            tivodecode_path = get_bin("tivodecode")
-            if tivodecode_path is None:
-                STATUS[url]["running"] = False
-                STATUS[url]["error"] = "Can't find binary 'tivodecode'."
-                return
-
-            tcmd = [tivodecode_path, "-m", mak, "-o", outfile, "-"]
+            tcmd = decoder_cmd(mak) + ["-o", outfile, "-"]
             tivodecode = subprocess.Popen(
                 tcmd, stdin=subprocess.PIPE, bufsize=(512 * 1024)
             )
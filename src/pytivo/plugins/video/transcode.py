@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import math
 import os
@@ -10,27 +11,21 @@ import time
 from typing import Any, BinaryIO, Dict, List, Optional, Tuple, TypeVar
 
 from pytivo.config import (
-    get169Blacklist,
-    get169Letterbox,
-    get169Setting,
     getAudioBR,
     getBuffSize,
     getFFmpegPrams,
     getMaxAudioBR,
     getMaxVideoBR,
-    getOptres,
-    getTivoHeight,
-    getTivoWidth,
-    getVideoBR,
     get_bin,
     get_server,
-    get_tsn,
     isHDtivo,
     nearestTivoHeight,
     nearestTivoWidth,
-    strtod,
+    tivo_profile,
 )
 from pytivo.metadata import video_info, VideoInfo
+import pytivo.metrics
+from pytivo.tivodecode import decoder_cmd
 
 LOGGER = logging.getLogger(__name__)
 
@@ -94,47 +89,47 @@ def transcode_settings(
     return settings
 
 
-def transcode(
-    inFile: str, outFile: BinaryIO, tsn: str = "", mime: str = "", thead: bytes = b""
-) -> int:
+def transcode_cmds(
+    inFile: str, tsn: str = "", mime: str = ""
+) -> Optional[List[List[str]]]:
+    """The commands that transcode inFile for tsn, each one's output feeding
+    the next, or None if that isn't possible."""
     settings = transcode_settings(isQuery=False, inFile=inFile, tsn=tsn, mime=mime)
 
     ffmpeg_path = get_bin("ffmpeg")
     if ffmpeg_path is None:
         LOGGER.error("No ffmpeg binary found")
-        return 0
+        return None
 
     if inFile[-5:].lower() == ".tivo":
-        tivodecode_path = get_bin("tivodecode")
-        if tivodecode_path is None:
-            LOGGER.error("No tivodecode binary found.")
-            return 0
         tivo_mak = get_server("tivo_mak", "")
         if tivo_mak == "":
             LOGGER.error("No valid tivo_mak found.")
-            return 0
-        tcmd = [tivodecode_path, "-m", tivo_mak, inFile]
-        tivodecode = subprocess.Popen(
-            tcmd, stdout=subprocess.PIPE, bufsize=(512 * 1024)
-        )
+            return None
+        tcmd = decoder_cmd(tivo_mak) + [inFile]
         if tivo_compatible(inFile, tsn)[0]:
-            cmd = [""]
-            ffmpeg = tivodecode
-        else:
-            cmd = [ffmpeg_path, "-i", "-"] + settings
-            ffmpeg = subprocess.Popen(
-                cmd,
-                stdin=tivodecode.stdout,
-                stdout=subprocess.PIPE,
-                bufsize=(512 * 1024),
-            )
-    else:
-        cmd = [ffmpeg_path, "-i", inFile] + settings
-        ffmpeg = subprocess.Popen(cmd, bufsize=(512 * 1024), stdout=subprocess.PIPE)
+            return [tcmd]
+        return [tcmd, [ffmpeg_path, "-i", "-"] + settings]
+    return [[ffmpeg_path, "-i", inFile] + settings]
 
-    if cmd:
-        LOGGER.debug("transcoding to tivo model " + tsn[:3] + " using ffmpeg command:")
-        LOGGER.debug(" ".join(cmd))
+
+def transcode(
+    inFile: str, outFile: BinaryIO, tsn: str = "", mime: str = "", thead: bytes = b""
+) -> int:
+    cmds = transcode_cmds(inFile, tsn, mime)
+    if cmds is None:
+        return 0
+
+    LOGGER.debug("transcoding to tivo model " + tsn[:3] + " using command:")
+    LOGGER.debug(" | ".join(" ".join(cmd) for cmd in cmds))
+
+    pytivo.metrics.TRANSCODES.inc("video")
+    stdin = None
+    for cmd in cmds:
+        ffmpeg = subprocess.Popen(
+            cmd, stdin=stdin, stdout=subprocess.PIPE, bufsize=(512 * 1024)
+        )
+        stdin = ffmpeg.stdout
 
     FFMPEG_PROCS[inFile] = FfmpegProcess(
         process=ffmpeg, start=0, end=0, last_read=time.time(), blocks=[]
@@ -145,6 +140,62 @@ def transcode(
     return resume_transfer(inFile, outFile, 0)
 
 
+class AsyncProcess:
+    """Popen-like view of an asyncio subprocess, so that kill(), is_resumable()
+    and the reaper work on it too."""
+
+    def __init__(self, process: asyncio.subprocess.Process) -> None:
+        self.process = process
+        self.pid = process.pid
+        self.stdout = process.stdout
+
+    def poll(self) -> Optional[int]:
+        return self.process.returncode
+
+
+async def transcode_async(
+    inFile: str,
+    writer: asyncio.StreamWriter,
+    tsn: str = "",
+    mime: str = "",
+    thead: bytes = b"",
+) -> int:
+    """transcode(), for the asyncio server."""
+    cmds = transcode_cmds(inFile, tsn, mime)
+    if cmds is None:
+        return 0
+
+    LOGGER.debug("transcoding to tivo model " + tsn[:3] + " using command:")
+    LOGGER.debug(" | ".join(" ".join(cmd) for cmd in cmds))
+
+    pytivo.metrics.TRANSCODES.inc("video")
+    stdin: Optional[int] = None
+    for cmd in cmds[:-1]:
+        read_fd, write_fd = os.pipe()
+        await asyncio.create_subprocess_exec(*cmd, stdin=stdin, stdout=write_fd)
+        os.close(write_fd)
+        if stdin is not None:
+            os.close(stdin)
+        stdin = read_fd
+    ffmpeg = await asyncio.create_subprocess_exec(
+        *cmds[-1], stdin=stdin, stdout=asyncio.subprocess.PIPE, limit=BLOCKSIZE
+    )
+    if stdin is not None:
+        os.close(stdin)
+
+    FFMPEG_PROCS[inFile] = FfmpegProcess(
+        process=AsyncProcess(ffmpeg),  # type: ignore
+        start=0,
+        end=0,
+        last_read=time.time(),
+        blocks=[],
+    )
+    if thead:
+        FFMPEG_PROCS[inFile].blocks.append(thead)
+    reap_process(inFile)
+    return await resume_transfer_async(inFile, writer, 0)
+
+
 def is_resumable(inFile: str, offset: int) -> bool:
     if inFile in FFMPEG_PROCS:
         proc = FFMPEG_PROCS[inFile]
@@ -225,6 +276,79 @@ def transfer_blocks(inFile: str, outFile: BinaryIO) -> int:
     return count
 
 
+async def write_chunk(writer: asyncio.StreamWriter, block: bytes) -> None:
+    writer.write(b"%x\r\n" % len(block))
+    writer.write(block)
+    writer.write(b"\r\n")
+    await writer.drain()
+
+
+async def resume_transfer_async(
+    inFile: str, writer: asyncio.StreamWriter, offset: int
+) -> int:
+    """resume_transfer(), for the asyncio server."""
+    proc = FFMPEG_PROCS[inFile]
+    offset -= proc.start
+    count = 0
+
+    try:
+        for block in proc.blocks:
+            length = len(block)
+            if offset < length:
+                if offset > 0:
+                    block = block[offset:]
+                await write_chunk(writer, block)
+                count += len(block)
+            offset -= length
+    except Exception as msg:
+        LOGGER.info(msg)
+        return count
+
+    proc.start = proc.end
+    proc.blocks = []
+
+    return count + await transfer_blocks_async(inFile, writer)
+
+
+async def transfer_blocks_async(inFile: str, writer: asyncio.StreamWriter) -> int:
+    """transfer_blocks(), for the asyncio server."""
+    proc = FFMPEG_PROCS[inFile]
+    blocks = proc.blocks
+    count = 0
+
+    while True:
+        try:
+            block = await proc.process.stdout.read(BLOCKSIZE)  # type: ignore
+            proc.last_read = time.time()
+        except Exception as msg:
+            LOGGER.info(msg)
+            cleanup(inFile)
+            # kill() waits for the process, so keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, kill, proc.process
+            )
+            break
+
+        if not block:
+            cleanup(inFile)
+            break
+
+        blocks.append(block)
+        proc.end += len(block)
+        if len(blocks) > MAXBLOCKS:
+            proc.start += len(blocks[0])
+            blocks.pop(0)
+
+        try:
+            await write_chunk(writer, block)
+            count += len(block)
+        except Exception as msg:
+            LOGGER.info(msg)
+            break
+
+    return count
+
+
 def reap_process(inFile: str) -> None:
     if FFMPEG_PROCS and inFile in FFMPEG_PROCS:
         proc = FFMPEG_PROCS[inFile]
@@ -300,7 +424,7 @@ def select_audioch(inFile: str, tsn: str) -> List[str]:
 
 def select_audiolang(inFile: str, tsn: str) -> str:
     vInfo = video_info(inFile)
-    audio_lang = get_tsn("audio_lang", tsn)
+    audio_lang = tivo_profile(tsn).audio_lang
     LOGGER.debug("audio_lang: %s" % audio_lang)
     if vInfo.mapAudio:
         # default to first detected audio stream to begin with
@@ -380,10 +504,11 @@ def select_videostr(inFile: str, tsn: str, mime: str = "") -> int:
             video_str -= vInfo.aKbps
         video_str *= 1000
     else:
-        video_str = strtod(getVideoBR(tsn))
-        if isHDtivo(tsn) and vInfo.kbps:
+        profile = tivo_profile(tsn)
+        video_str = profile.video_bps
+        if profile.hd and vInfo.kbps:
             video_str = max(video_str, vInfo.kbps * 1000)
-        video_str = int(min(strtod(getMaxVideoBR(tsn)) * 0.95, video_str))
+        video_str = int(min(profile.max_video_bps * 0.95, video_str))
     return video_str
 
 
@@ -455,18 +580,19 @@ def pad_LR(
 
 
 def select_aspect(inFile: str, tsn: str = "") -> List[str]:
-    tivo_width = getTivoWidth(tsn)
-    tivo_height = getTivoHeight(tsn)
+    profile = tivo_profile(tsn)
+    tivo_width = profile.width
+    tivo_height = profile.height
 
     vInfo = video_info(inFile)
 
     LOGGER.debug("tsn: %s" % tsn)
 
-    aspect169 = get169Setting(tsn)
+    aspect169 = profile.aspect169
 
     LOGGER.debug("aspect169: %s" % aspect169)
 
-    optres = getOptres(tsn)
+    optres = profile.optres
 
     LOGGER.debug("optres: %s" % optres)
 
@@ -507,7 +633,7 @@ def select_aspect(inFile: str, tsn: str = "") -> List[str]:
         )
     )
 
-    if isHDtivo(tsn) and not optres:
+    if profile.hd and not optres:
         if vInfo.par:
             npar = par2
 
@@ -551,10 +677,10 @@ def select_aspect(inFile: str, tsn: str = "") -> List[str]:
     elif (
         (rwidth, rheight) in [(16, 9), (20, 11), (40, 33), (118, 81), (59, 27)]
         or vInfo.dar1 == "16:9"
-    ) and (aspect169 or get169Letterbox(tsn)):
+    ) and (aspect169 or profile.letterbox169):
         LOGGER.debug("File is within 16:9 list and 16:9 allowed.")
 
-        if get169Blacklist(tsn) or (aspect169 and get169Letterbox(tsn)):
+        if profile.blacklist169 or (aspect169 and profile.letterbox169):
             aspect = "4:3"
         else:
             aspect = "16:9"
@@ -578,7 +704,7 @@ def select_aspect(inFile: str, tsn: str = "") -> List[str]:
             if aspect169 and ratio > 135:  # If file would fall in 4:3
                 # assume it is supposed to be 4:3
 
-                if get169Blacklist(tsn) or get169Letterbox(tsn):
+                if profile.blacklist169 or profile.letterbox169:
                     settings.append("4:3")
                 else:
                     settings.append("16:9")
@@ -604,7 +730,7 @@ def select_aspect(inFile: str, tsn: str = "") -> List[str]:
                     )
 
             else:  # this is a 4:3 file or 16:9 output not allowed
-                if ratio > 135 and get169Letterbox(tsn):
+                if ratio > 135 and profile.letterbox169:
                     settings.append("16:9")
                     multiplier = multiplier16by9
                 else:
@@ -635,6 +761,7 @@ def tivo_compatible_video(
     vInfo: VideoInfo, tsn: str, mime: str = ""
 ) -> Tuple[bool, str]:
     message = (True, "")
+    profile = tivo_profile(tsn)
     codec = vInfo.vCodec
     if mime == "video/x-tivo-mpeg-ts":
         if not (codec in ("h264", "mpeg2video")):
@@ -645,20 +772,20 @@ def tivo_compatible_video(
         return (False, "vCodec %s not compatible" % codec)
 
     if vInfo.kbps is not None and vInfo.aKbps is not None:
-        if vInfo.kbps - max(0, vInfo.aKbps) > strtod(getMaxVideoBR(tsn)) / 1000:
+        if vInfo.kbps - max(0, vInfo.aKbps) > profile.max_video_bps / 1000:
             return (False, "%s kbps exceeds max video bitrate" % vInfo.kbps)
     else:
         return (False, "%s kbps not supported" % vInfo.kbps)
 
-    if isHDtivo(tsn):
+    if profile.hd:
         # HD Tivo detected, skipping remaining tests.
         return message
 
     if vInfo.vFps not in ["29.97", "59.94"]:
         return (False, "%s vFps, should be 29.97" % vInfo.vFps)
 
-    if (get169Blacklist(tsn) and not get169Setting(tsn)) or (
-        get169Letterbox(tsn) and get169Setting(tsn)
+    if (profile.blacklist169 and not profile.aspect169) or (
+        profile.letterbox169 and profile.aspect169
     ):
         if vInfo.dar1 and vInfo.dar1 not in ("4:3", "8:9", "880:657"):
             return (
@@ -709,7 +836,7 @@ def tivo_compatible_audio(
             message = (False, "%s kbps exceeds max audio bitrate" % vInfo.aKbps)
             break
 
-        audio_lang = get_tsn("audio_lang", tsn)
+        audio_lang = tivo_profile(tsn).audio_lang
         if audio_lang:
             if (
                 vInfo.mapAudio is None
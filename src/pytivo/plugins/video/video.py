@@ -1,5 +1,5 @@
+import asyncio
 import calendar
-from functools import lru_cache
 import logging
 import os
 import struct
@@ -7,7 +7,17 @@ import time
 import zlib
 from collections.abc import MutableMapping
 from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, Optional, List, Dict, Any, Iterator
+from typing import (
+    TYPE_CHECKING,
+    Optional,
+    List,
+    Dict,
+    Any,
+    Iterator,
+    Tuple,
+    BinaryIO,
+    NamedTuple,
+)
 from xml.sax.saxutils import escape
 
 from Cheetah.Template import Template  # type: ignore
@@ -23,8 +33,12 @@ from pytivo.config import (
     get_server,
     get_ts_flag,
     is_ts_capable,
+    tivo_profile,
+    tsn_class,
 )
+from pytivo.lrucache import CacheKeyError, LockedLRUCache
 import pytivo.metadata
+import pytivo.metrics
 from pytivo.metadata import (
     basic,
     from_mscore,
@@ -34,19 +48,26 @@ from pytivo.metadata import (
     get_stars,
     get_tv,
     human_size,
+    tivo_header_info,
     video_info,
 )
 from pytivo.plugins.video.transcode import (
     is_resumable,
     resume_transfer,
+    resume_transfer_async,
     select_videostr,
     supported_format,
     tivo_compatible,
     transcode,
+    transcode_async,
     transcode_settings,
 )
-from pytivo.plugin import Plugin, quote
-from pytivo.pytivo_types import Query
+from pytivo.plugin import Plugin, quote, sort_files
+from pytivo.prefetch import Batch, get_prefetcher
+from pytivo.pytivo_types import Bdict, FileData, Query, Settings
+from pytivo.responsecache import ResponseCache, response_key
+import pytivo.socktune
+from pytivo.xmlstream import STREAM_MIN_ITEMS, FragmentCache, join_page, send_page
 
 if TYPE_CHECKING:
     from pytivo.httpserver import TivoHTTPHandler
@@ -58,8 +79,11 @@ SCRIPTDIR = os.path.dirname(__file__)
 CLASS_NAME = "Video"
 
 # Compile the templates
-VIDEO_CONTAINER_XML_TCLASS = Template.compile(
-    file=os.path.join(SCRIPTDIR, "templates", "container_xml.tmpl")
+VIDEO_CONTAINER_HEAD_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_head.tmpl")
+)
+VIDEO_CONTAINER_ITEM_TCLASS = Template.compile(
+    file=os.path.join(SCRIPTDIR, "templates", "container_item.tmpl")
 )
 TVBUS_TCLASS = Template.compile(file=os.path.join(SCRIPTDIR, "templates", "TvBus.tmpl"))
 
@@ -71,6 +95,16 @@ EXTENSIONS = """.tivo .mpg .avi .wmv .mov .flv .f4v .vob .mp4 .m4v .mkv
 .rts .scm .smv .ssm .svi .vdo .vfw .vid .viv .vivo .vp6 .vp7 .vro .webm
 .wm .wmd .wtv .yuv""".split()
 
+# rendered TvBus details and packed tivo_header()s, keyed by path, mtime,
+# TiVo class and config generation (and mime, for headers); rebuilt after
+# DETAILS_TTL seconds, to pick up edited .txt and .nfo metadata files
+DETAILS_CACHE = LockedLRUCache(100)
+HEADER_CACHE = LockedLRUCache(20)
+DETAILS_TTL = 300
+RESPONSE_CACHE = ResponseCache(50)  # rendered QueryContainer pages
+# rendered container items, see Video.container_item
+FRAGMENT_CACHE = FragmentCache(1000)
+
 LIKELYTS = """.ts .tp .trp .3g2 .3gp .3gp2 .3gpp .m2t .m2ts .mts .mp4
 .m4v .flv .mkv .mov .wtv .dvr-ms .webm""".split()
 
@@ -93,6 +127,10 @@ def isogm(iso: str) -> int:
     return int(calendar.timegm(uniso(iso)))
 
 
+def crc_str(in_str: str) -> int:
+    return zlib.crc32(in_str.encode("utf-8"))
+
+
 def pad(length: int, align: int) -> int:
     extra = length % align
     if extra:
@@ -100,6 +138,22 @@ def pad(length: int, align: int) -> int:
     return extra
 
 
+class SendPlan(NamedTuple):
+    """How Video.send_file() sends a file, decided before the body is sent."""
+
+    path: str
+    tsn: str
+    mime: str
+    tivo_name: str
+    valid: bool
+    compatible: bool
+    offset: int
+    faking: bool
+    thead: bytes
+    start: float
+    corked: bool
+
+
 class VideoDetails(MutableMapping):
     def __init__(self, d: Optional[Dict[str, Any]] = None):
         self.d: Dict[str, Any]
@@ -145,8 +199,10 @@ class VideoDetails(MutableMapping):
 class Video(Plugin):
     CONTENT_TYPE = "x-container/tivo-videos"
 
-    def video_file_filter(self, full_path: str, type: Optional[str] = None) -> bool:
-        if os.path.isdir(full_path):
+    def video_file_filter(
+        self, full_path: str, type: Optional[str] = None, isdir: Optional[bool] = None
+    ) -> bool:
+        if isdir or (isdir is None and os.path.isdir(full_path)):
             return True
         if use_extensions:
             return os.path.splitext(full_path)[1].lower() in EXTENSIONS
@@ -154,6 +210,40 @@ class Video(Plugin):
             return supported_format(full_path)
 
     def send_file(self, handler: "TivoHTTPHandler", path: str, query: Query) -> None:
+        with pytivo.metrics.REQUEST_SECONDS.time("send_file"):
+            plan = self.send_headers(handler, path, query)
+        if handler.defer_body is not None:
+            handler.defer_body(self.send_body_async, plan)
+            return
+
+        count = 0
+        if plan.valid:
+            with pytivo.metrics.ACTIVE_STREAMS.track():
+                if plan.compatible:
+                    LOGGER.debug('"%s" is tivo compatible' % path)
+                    count = self.send_compatible(handler.wfile, plan)
+                else:
+                    LOGGER.debug('"%s" is not tivo compatible' % path)
+                    if plan.offset:
+                        count = resume_transfer(path, handler.wfile, plan.offset)
+                    else:
+                        count = transcode(
+                            path, handler.wfile, plan.tsn, plan.mime, plan.thead
+                        )
+        try:
+            if not plan.compatible:
+                handler.wfile.write(b"0\r\n\r\n")
+            handler.wfile.flush()
+        except Exception as msg:
+            LOGGER.info(msg)
+        if plan.corked:
+            pytivo.socktune.uncork(handler.connection)
+        self.log_sent(plan, count)
+
+    def send_headers(
+        self, handler: "TivoHTTPHandler", path: str, query: Query
+    ) -> SendPlan:
+        """Decide how to send path, and send the response headers."""
         mime = "video/x-tivo-mpeg"
         tsn = handler.headers.get("tsn", "")
         try:
@@ -176,7 +266,7 @@ class Video(Plugin):
             offset = 0
 
         if needs_tivodecode:
-            valid = bool(get_bin("tivodecode") and get_server("tivo_mak", ""))
+            valid = bool(get_server("tivo_mak", ""))
         else:
             valid = True
 
@@ -190,6 +280,7 @@ class Video(Plugin):
         thead = b""
         if faking:
             thead = self.tivo_header(tsn, path, mime)
+        corked = pytivo.socktune.tune_stream(handler.connection, tivo_profile(tsn))
         if compatible:
             size = os.path.getsize(path) + len(thead)
             handler.send_response(200)
@@ -207,71 +298,126 @@ class Video(Plugin):
             '[%s] Start sending "%s" to %s'
             % (time.strftime("%d/%b/%Y %H:%M:%S"), path, tivo_name)
         )
-        start = time.time()
+        return SendPlan(
+            path,
+            tsn,
+            mime,
+            tivo_name,
+            valid,
+            compatible,
+            offset,
+            faking,
+            thead,
+            time.time(),
+            corked,
+        )
+
+    def send_compatible(self, wfile: BinaryIO, plan: SendPlan) -> int:
         count = 0
+        offset = plan.offset
+        if plan.faking and not offset:
+            wfile.write(plan.thead)
+        f = open(plan.path, "rb")
+        try:
+            if offset:
+                offset -= len(plan.thead)
+                f.seek(offset)
+            while True:
+                block = f.read(512 * 1024)
+                if not block:
+                    break
+                wfile.write(block)
+                count += len(block)
+        except Exception as msg:
+            LOGGER.info(msg)
+        f.close()
+        return count
 
-        if valid:
-            if compatible:
-                if faking and not offset:
-                    handler.wfile.write(thead)
-                LOGGER.debug('"%s" is tivo compatible' % path)
-                f = open(path, "rb")
-                try:
-                    if offset:
-                        offset -= len(thead)
-                        f.seek(offset)
-                    while True:
-                        block = f.read(512 * 1024)
-                        if not block:
-                            break
-                        handler.wfile.write(block)
-                        count += len(block)
-                except Exception as msg:
-                    LOGGER.info(msg)
-                f.close()
-            else:
-                LOGGER.debug('"%s" is not tivo compatible' % path)
-                if offset:
-                    count = resume_transfer(path, handler.wfile, offset)
-                else:
-                    count = transcode(path, handler.wfile, tsn, mime, thead)
+    async def send_body_async(
+        self, writer: asyncio.StreamWriter, plan: SendPlan
+    ) -> None:
+        """The body half of send_file(), for the asyncio server."""
+        count = 0
+        if plan.valid:
+            with pytivo.metrics.ACTIVE_STREAMS.track():
+                count = await self.send_valid_async(writer, plan)
         try:
-            if not compatible:
-                handler.wfile.write(b"0\r\n\r\n")
-            handler.wfile.flush()
+            if not plan.compatible:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
         except Exception as msg:
             LOGGER.info(msg)
+        if plan.corked:
+            pytivo.socktune.uncork(writer.get_extra_info("socket"))
+        self.log_sent(plan, count)
 
-        mega_elapsed = (time.time() - start) * 1024 * 1024
+    async def send_valid_async(
+        self, writer: asyncio.StreamWriter, plan: SendPlan
+    ) -> int:
+        count = 0
+        if plan.compatible:
+            LOGGER.debug('"%s" is tivo compatible' % plan.path)
+            offset = plan.offset
+            if plan.faking and not offset:
+                writer.write(plan.thead)
+            if offset:
+                offset -= len(plan.thead)
+            try:
+                await writer.drain()
+                with open(plan.path, "rb") as f:
+                    count = await asyncio.get_running_loop().sendfile(
+                        writer.transport, f, offset
+                    )
+            except Exception as msg:
+                LOGGER.info(msg)
+        else:
+            LOGGER.debug('"%s" is not tivo compatible' % plan.path)
+            if plan.offset:
+                count = await resume_transfer_async(plan.path, writer, plan.offset)
+            else:
+                count = await transcode_async(
+                    plan.path, writer, plan.tsn, plan.mime, plan.thead
+                )
+        return count
+
+    def log_sent(self, plan: SendPlan, count: int) -> None:
+        pytivo.metrics.SENT_BYTES.inc(amount=count)
+        mega_elapsed = (time.time() - plan.start) * 1024 * 1024
         if mega_elapsed < 1:
             mega_elapsed = 1
         rate = count * 8.0 / mega_elapsed
         LOGGER.info(
             '[%s] Done sending "%s" to %s, %d bytes, %.2f Mb/s'
-            % (time.strftime("%d/%b/%Y %H:%M:%S"), path, tivo_name, count, rate)
+            % (
+                time.strftime("%d/%b/%Y %H:%M:%S"),
+                plan.path,
+                plan.tivo_name,
+                count,
+                rate,
+            )
         )
 
     def __duration(self, full_path: str) -> Optional[float]:
         return video_info(full_path).millisecs
 
-    def __total_items(self, full_path: str) -> int:
-        count = 0
-        try:
-            for f in os.listdir(full_path):
-                if f.startswith("."):
-                    continue
-                f = os.path.join(full_path, f)
-                if os.path.isdir(f):
-                    count += 1
-                elif use_extensions:
-                    if os.path.splitext(f)[1].lower() in EXTENSIONS:
-                        count += 1
-                elif f in pytivo.metadata.INFO_CACHE:
-                    if supported_format(f):
-                        count += 1
-        except:
-            pass
-        return count
+    def __counted_file(
+        self, full_path: str, type: Optional[str] = None, isdir: Optional[bool] = None
+    ) -> bool:
+        # like video_file_filter, but never probes a file that isn't known yet
+        if isdir:
+            return True
+        if use_extensions:
+            return os.path.splitext(full_path)[1].lower() in EXTENSIONS
+        return full_path in pytivo.metadata.INFO_CACHE and supported_format(full_path)
+
+    def __total_items(self, handler: "TivoHTTPHandler", full_path: str) -> int:
+        # files probed since the count was cached may now be counted
+        return self.child_count(
+            handler,
+            full_path,
+            self.__counted_file,
+            stamp=pytivo.metadata.info_added(full_path),
+        )
 
     def __est_size(self, full_path: str, tsn: str = "", mime: str = "") -> int:
         # Size is estimated by taking audio and video bit rate adding 2%
@@ -407,79 +553,238 @@ class Video(Plugin):
             handler, query, self.video_file_filter, force_alpha, allow_recurse
         )
 
-        videos = []
-        local_base_path = self.get_local_base_path(handler, query)
-        start_time = time.time()
-        # This loop takes the most amount of time in the first query
+        if len(files) >= STREAM_MIN_ITEMS:
+            head, items = self.render_container(handler, query, files, total, start)
+            send_page(handler, head, items, len(files))
+        else:
+            key = response_key(query, tsn)
+            stamp = self.page_stamp(files, total, start)
+            response = RESPONSE_CACHE.lookup(key, stamp)
+            if response is None:
+                head, items = self.render_container(
+                    handler, query, files, total, start
+                )
+                response = RESPONSE_CACHE.store(key, stamp, join_page(head, items))
+            handler.send_cached(response, "text/xml")
+
+        self.prefetch(handler, query, files, start, total, force_alpha, allow_recurse)
+
+    def page_stamp(self, files: List[FileData], total: int, start: int) -> Tuple:
+        """What a rendered page depends on, besides the query and config."""
+        stamp: List[Any] = [total, start]
         for f in files:
-            video = VideoDetails()
-            mtime = f.mdate
-            try:
-                ltime = time.localtime(mtime)
-            except:
-                LOGGER.warning("Bad file time on " + str(f.name, "utf-8"))
-                mtime = time.time()
-                ltime = time.localtime(mtime)
-            video["captureDate"] = hex(int(mtime))
-            video["textDate"] = time.strftime("%b %d, %Y", ltime)
-            video["name"] = os.path.basename(f.name)
-            video["path"] = f.name
-            video["part_path"] = f.name.replace(local_base_path, "", 1)
-            if not video["part_path"].startswith(os.path.sep):
-                video["part_path"] = os.path.sep + video["part_path"]
-            video["title"] = os.path.basename(f.name)
-            video["is_dir"] = f.isdir
-            if video["is_dir"]:
-                video["small_path"] = subcname + "/" + video["name"]
-                video["total_items"] = self.__total_items(f.name)
+            if f.isdir:
+                # for the folder's item count
+                try:
+                    mtime: Optional[float] = os.path.getmtime(f.name)
+                except OSError:
+                    mtime = None
+                stamp.append((f.name, mtime, pytivo.metadata.info_added(f.name)))
             else:
-                if len(files) == 1 or f.name in pytivo.metadata.INFO_CACHE:
-                    video["valid"] = supported_format(f.name)
-                    if video["valid"]:
-                        video.update(self.metadata_full(f.name, tsn, mtime=mtime))
-                        if len(files) == 1:
-                            video["captureDate"] = hex(isogm(video["time"]))
-                else:
-                    video["valid"] = True
-                    video.update(basic(f.name, mtime))
-
-                if self.use_ts(tsn, f.name):
-                    video["mime"] = "video/x-tivo-mpeg-ts"
-                else:
-                    video["mime"] = "video/x-tivo-mpeg"
+                stamp.append(
+                    (f.name, f.mdate, f.size, f.name in pytivo.metadata.INFO_CACHE)
+                )
+        return tuple(stamp)
 
-                video["textSize"] = human_size(f.size)
-
-            videos.append(video)
-        end_time_ms = (time.time() - start_time) * 1000
-        LOGGER.info(f"for f in files: {end_time_ms:.1f}ms")
-
-        def crc_str(in_str: str) -> int:
-            return zlib.crc32(in_str.encode("utf-8"))
+    def render_container(
+        self,
+        handler: "TivoHTTPHandler",
+        query: Query,
+        files: List[FileData],
+        total: int,
+        start: int,
+    ) -> Tuple[str, Iterator[bytes]]:
+        """The head of the page, and its items, rendered as they are read."""
+        tsn = handler.headers.get("tsn", "")
+        subcname = query["Container"][0]
+        local_base_path = self.get_local_base_path(handler, query)
 
-        t = VIDEO_CONTAINER_XML_TCLASS()
-        t.container = handler.cname
+        t = VIDEO_CONTAINER_HEAD_TCLASS()
         t.name = subcname
         t.total = total
         t.start = start
-        t.videos = videos
-        t.quote = quote
+        t.count = len(files)
         t.escape = escape
-        t.crc = crc_str  # applied to (guid + name) and (guid + video.name)
+        t.crc = crc_str
         t.guid = getGUID()
-        t.tivos = pytivo.config.TIVOS
-        handler.send_xml(str(t))
+        items = (
+            self.container_item(
+                handler, tsn, subcname, f, local_base_path, len(files) == 1
+            )
+            for f in files
+        )
+        return str(t), items
+
+    def container_item(
+        self,
+        handler: "TivoHTTPHandler",
+        tsn: str,
+        subcname: str,
+        f: FileData,
+        local_base_path: str,
+        single: bool,
+    ) -> bytes:
+        total_items = None
+        if f.isdir:
+            total_items = self.__total_items(handler, f.name)
+
+        def render() -> str:
+            video = self.container_details(tsn, subcname, f, local_base_path, single)
+            if f.isdir:
+                video["total_items"] = total_items
+            t = VIDEO_CONTAINER_ITEM_TCLASS()
+            t.video = video
+            t.container = handler.cname
+            t.name = subcname
+            t.quote = quote
+            t.escape = escape
+            t.crc = crc_str  # applied to (guid + video.small_path)
+            t.guid = getGUID()
+            return str(t)
+
+        key = (handler.cname, subcname, f.name, tsn_class(tsn))
+        stamp = (
+            f.mdate,
+            f.size,
+            total_items,
+            single,
+            f.name in pytivo.metadata.INFO_CACHE,
+            pytivo.config.CONFIG_GENERATION,
+        )
+        return FRAGMENT_CACHE.render(key, stamp, render)
 
-    def use_ts(self, tsn: str, file_path: str) -> bool:
+    def container_details(
+        self,
+        tsn: str,
+        subcname: str,
+        f: FileData,
+        local_base_path: str,
+        single: bool,
+    ) -> VideoDetails:
+        video = VideoDetails()
+        mtime = f.mdate
+        try:
+            ltime = time.localtime(mtime)
+        except:
+            LOGGER.warning("Bad file time on " + str(f.name, "utf-8"))
+            mtime = time.time()
+            ltime = time.localtime(mtime)
+        video["captureDate"] = hex(int(mtime))
+        video["textDate"] = time.strftime("%b %d, %Y", ltime)
+        video["name"] = os.path.basename(f.name)
+        video["path"] = f.name
+        video["part_path"] = f.name.replace(local_base_path, "", 1)
+        if not video["part_path"].startswith(os.path.sep):
+            video["part_path"] = os.path.sep + video["part_path"]
+        video["title"] = os.path.basename(f.name)
+        video["is_dir"] = f.isdir
+        if video["is_dir"]:
+            video["small_path"] = subcname + "/" + video["name"]
+        else:
+            # a single item gets full details, as the TiVo shows them
+            if single or f.name in pytivo.metadata.INFO_CACHE:
+                video["valid"] = supported_format(f.name)
+                if video["valid"]:
+                    video.update(self.metadata_full(f.name, tsn, mtime=mtime))
+                    if single:
+                        video["captureDate"] = hex(isogm(video["time"]))
+            else:
+                video["valid"] = True
+                video.update(basic(f.name, mtime))
+
+            if self.use_ts(tsn, f.name, f.mdate):
+                video["mime"] = "video/x-tivo-mpeg-ts"
+            else:
+                video["mime"] = "video/x-tivo-mpeg"
+
+            video["textSize"] = human_size(f.size)
+        return video
+
+    def prefetch(
+        self,
+        handler: "TivoHTTPHandler",
+        query: Query,
+        files: List[FileData],
+        start: int,
+        total: int,
+        force_alpha: bool,
+        allow_recurse: bool,
+    ) -> None:
+        """Probe in the background the videos the client is likely to look at
+        next: this page, the next page, and the first page of each folder
+        on this page."""
+        prefetcher = get_prefetcher()
+        if prefetcher is None:
+            return
+        try:
+            count = int(query["ItemCount"][0])
+        except (KeyError, ValueError):
+            return
+        if count <= 0:
+            return
+
+        tsn = handler.headers.get("tsn", "")
+        batch = prefetcher.batch(tsn or handler.address_string())
+        self.prefetch_details(batch, files, tsn)
+
+        # the next page is the rest of the listing this page came from
+        if files and start + len(files) < total:
+            listing = self.cached_files(handler, query, allow_recurse)
+            after = start + len(files)
+            self.prefetch_details(batch, listing[after : after + count], tsn)
+
+        # a folder is listed here, not through get_files(), so that neither
+        # its cached listings nor the position of the last page change
+        path = self.get_local_path(handler, query)
+        file_type = query.get("Filter", [""])[0]
+        sortby = query.get("SortOrder", ["Normal"])[0]
+        container = Bdict(handler.container)
+        for f in files:
+            if f.isdir:
+                batch.submit(
+                    self.prefetch_folder,
+                    batch,
+                    container,
+                    os.path.join(path, os.path.basename(f.name)),
+                    file_type,
+                    sortby,
+                    force_alpha,
+                    count,
+                    tsn,
+                )
+
+    def prefetch_folder(
+        self,
+        batch: Batch,
+        container: Settings,
+        path: str,
+        file_type: str,
+        sortby: str,
+        force_alpha: bool,
+        count: int,
+        tsn: str,
+    ) -> None:
+        files = self.list_share_files(
+            container, path, False, self.video_file_filter, file_type
+        )
+        files = sort_files(files, sortby, force_alpha)
+        self.prefetch_details(batch, files[:count], tsn)
+
+    def prefetch_details(self, batch: Batch, files: List[FileData], tsn: str) -> None:
+        for f in files:
+            if not f.isdir and f.name not in pytivo.metadata.INFO_CACHE:
+                batch.submit(self.prefetch_file, f.name, tsn, f.mdate)
+
+    def prefetch_file(self, full_path: str, tsn: str, mtime: float) -> None:
+        if supported_format(full_path):
+            self.metadata_full(full_path, tsn, mtime=mtime)
+
+    def use_ts(self, tsn: str, file_path: str, mtime: Optional[float] = None) -> bool:
         if is_ts_capable(tsn):
             ext = os.path.splitext(file_path)[1].lower()
             if ext == ".tivo":
-                try:
-                    with open(file_path, "rb") as flag_fh:
-                        flag = flag_fh.read(8)
-                except:
-                    return False
-                if flag[7] & 0x20:
+                header = tivo_header_info(file_path, mtime)
+                if header is not None and header.is_ts:
                     return True
             else:
                 opt = get_ts_flag()
@@ -490,9 +795,24 @@ class Video(Plugin):
 
         return False
 
-    @lru_cache(maxsize=1)
+    def details_key(self, tsn: str, file_path: str) -> Tuple[Any, ...]:
+        try:
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            mtime = 0
+        return (file_path, mtime, tsn_class(tsn), pytivo.config.CONFIG_GENERATION)
+
     def get_details_xml(self, tsn: str, file_path: str) -> str:
-        details: str
+        key = self.details_key(tsn, file_path)
+        try:
+            details = DETAILS_CACHE[key]
+            if DETAILS_CACHE.mtime(key) + DETAILS_TTL > time.time():
+                pytivo.metrics.cache_lookup("details", True)
+                return details
+        except CacheKeyError:
+            pass
+        pytivo.metrics.cache_lookup("details", False)
+
         file_info = VideoDetails()
         file_info["valid"] = supported_format(file_path)
         if file_info["valid"]:
@@ -506,9 +826,18 @@ class Video(Plugin):
         t.get_stars = get_stars
         t.get_color = get_color
         details = str(t)
+        DETAILS_CACHE[key] = details
         return details
 
     def tivo_header(self, tsn: str, path: str, mime: str) -> bytes:
+        key = self.details_key(tsn, path) + (mime,)
+        try:
+            header = HEADER_CACHE[key]
+            if HEADER_CACHE.mtime(key) + DETAILS_TTL > time.time():
+                return header
+        except CacheKeyError:
+            pass
+
         if mime == "video/x-tivo-mpeg-ts":
             flag = 45
         else:
@@ -520,7 +849,7 @@ class Video(Plugin):
         blocklen = lc * 2 + 40
         padding = pad(blocklen, 1024)
 
-        return b"".join(
+        header = b"".join(
             [
                 b"TiVo",
                 struct.pack(">HHHLH", 4, flag, 0, padding + blocklen, 2),
@@ -531,6 +860,8 @@ class Video(Plugin):
                 b"\0" * padding,
             ]
         )
+        HEADER_CACHE[key] = header
+        return header
 
     def TVBusQuery(self, handler: "TivoHTTPHandler", query: Query) -> None:
         tsn = handler.headers.get("tsn", "")
@@ -0,0 +1,78 @@
+"""Background work a client will probably want next, such as probing the
+videos on the next page of a listing.
+
+Work is grouped in batches, one per client. Starting a new batch for a
+client cancels whatever is left of its previous one, since a client that
+has moved on no longer needs it.
+"""
+
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from pytivo.config import get_prefetch_workers
+
+LOGGER = logging.getLogger(__name__)
+
+PREFETCHER: Optional["Prefetcher"] = None
+PREFETCHER_LOCK = threading.Lock()
+
+
+class Batch:
+    def __init__(self, pool: concurrent.futures.ThreadPoolExecutor) -> None:
+        self.pool = pool
+        self.cancelled = False
+        self.futures: List[concurrent.futures.Future] = []
+        self.lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args: Any) -> None:
+        with self.lock:
+            if not self.cancelled:
+                self.futures.append(self.pool.submit(self._run, fn, *args))
+
+    def _run(self, fn: Callable, *args: Any) -> None:
+        # a job may have started just before the batch was cancelled
+        if self.cancelled:
+            return
+        try:
+            fn(*args)
+        except Exception:
+            LOGGER.debug("Prefetch failed", exc_info=True)
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            for future in self.futures:
+                future.cancel()
+            self.futures = []
+
+
+class Prefetcher:
+    def __init__(self, workers: int) -> None:
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="prefetch"
+        )
+        self.batches: Dict[str, Batch] = {}
+        self.lock = threading.Lock()
+
+    def batch(self, client: str) -> Batch:
+        """Start a new batch for client, cancelling its previous one."""
+        batch = Batch(self.pool)
+        with self.lock:
+            old = self.batches.get(client)
+            self.batches[client] = batch
+        if old is not None:
+            old.cancel()
+        return batch
+
+
+def get_prefetcher() -> Optional[Prefetcher]:
+    global PREFETCHER
+    with PREFETCHER_LOCK:
+        if PREFETCHER is None:
+            workers = get_prefetch_workers()
+            if not workers:
+                return None
+            PREFETCHER = Prefetcher(workers)
+        return PREFETCHER
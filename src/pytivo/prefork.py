@@ -0,0 +1,227 @@
+"""Pre-fork mode, used with processes > 1.
+
+The parent forks that many workers and then only supervises them. Each worker
+binds the server port itself with SO_REUSEPORT, so the kernel spreads new
+connections across them, and runs the configured server_mode in its own
+interpreter, so menus, metadata and image work use more than one core.
+
+Worker 0 owns the state that can't be split between processes: it runs the
+beacon, keeps the ToGo queue, holds the ffmpeg processes that a resumed
+video transfer reattaches to, and saves the snapshot. The other workers hand
+it the connections that need that state, passing the client socket itself
+over a Unix socket (SCM_RIGHTS), so the owner answers the client directly.
+Caches are per worker; each worker reloads the config when the file changes.
+"""
+
+import array
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, unquote_plus
+
+import pytivo.config
+from pytivo.config import config_reset
+from pytivo.httpserver import TivoHTTPServer, peek_request_line
+
+LOGGER = logging.getLogger(__name__)
+
+# TiVoConnect commands that read or change the ToGo queue
+OWNER_COMMANDS = {"NPL", "ToGo", "ToGoStop", "Unqueue"}
+
+# share types whose file requests go to the owner, for resumes
+OWNER_SHARE_TYPES = {"video"}
+
+EXIT_QUIT = 0
+EXIT_RESTART = 3
+
+RESPAWN_DELAY = 1
+CONFIG_POLL = 5
+
+
+def available() -> bool:
+    return all(
+        hasattr(mod, name)
+        for mod, name in [
+            (os, "fork"),
+            (socket, "SO_REUSEPORT"),
+            (socket, "SCM_RIGHTS"),
+            (socket, "AF_UNIX"),
+        ]
+    )
+
+
+class Router:
+    """One worker's end of the socket that connections are handed to the
+    owner through."""
+
+    def __init__(self, sock: socket.socket, owner: bool) -> None:
+        self.sock = sock
+        self.owner = owner
+
+    def wants(self, server: TivoHTTPServer, method: str, path: str) -> bool:
+        """Whether a request for path has to be answered by the owner."""
+        if "?" in path:
+            path, opts = path.split("?", 1)
+        else:
+            opts = ""
+        if path == "/TiVoConnect":
+            # a POST's Command is in the body (the ToGo and Settings forms)
+            return method == "POST" or bool(
+                OWNER_COMMANDS.intersection(parse_qs(opts).get("Command", []))
+            )
+        splitpath = [x for x in unquote_plus(path).split("/") if x]
+        if not splitpath or splitpath[0] not in server.containers:
+            return False
+        settings = server.containers[splitpath[0]]
+        return settings.get("type", "").lower() in OWNER_SHARE_TYPES
+
+    def forward(
+        self, server: TivoHTTPServer, request: Any, client_address: Tuple[str, int]
+    ) -> bool:
+        """Hand the connection to the owner if its first request needs it.
+        Later requests on a kept-alive connection stay where the first went."""
+        if self.owner:
+            return False
+        line = peek_request_line(request)
+        if line is None or not self.wants(server, *line):
+            return False
+        path = line[1]
+        fds = array.array("i", [request.fileno()])
+        try:
+            self.sock.sendmsg(
+                [json.dumps(client_address).encode("utf-8")],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+            )
+        except OSError as msg:
+            LOGGER.warning("Unable to pass %s to worker 0: %s" % (path, msg))
+            return False
+        # the owner has its own copy now; shutdown() would end it for both
+        request.close()
+        return True
+
+    def receive(self, server: TivoHTTPServer) -> None:
+        """Serve the connections handed over by other workers (owner only)."""
+        fd_size = array.array("i").itemsize
+        while True:
+            try:
+                msg, ancdata, _, _ = self.sock.recvmsg(
+                    1024, socket.CMSG_SPACE(fd_size)
+                )
+            except OSError:
+                return
+            fds = array.array("i")
+            for level, type_, data in ancdata:
+                if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                    fds.frombytes(data[: len(data) - len(data) % fd_size])
+            for fd in fds:
+                request = socket.socket(fileno=fd)
+                server.process_request(request, tuple(json.loads(msg)))
+
+    def start(self, server: TivoHTTPServer) -> None:
+        server.router = self
+        if self.owner:
+            threading.Thread(
+                target=self.receive, args=(server,), name="router", daemon=True
+            ).start()
+        threading.Thread(
+            target=watch_config, args=(server,), name="config", daemon=True
+        ).start()
+
+
+def config_mtimes() -> List[float]:
+    mtimes = []
+    for path in pytivo.config.CONFIGS_FOUND:
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(0)
+    return mtimes
+
+
+def watch_config(server: TivoHTTPServer) -> None:
+    """Pick up settings saved through another worker."""
+    last = config_mtimes()
+    while True:
+        time.sleep(CONFIG_POLL)
+        mtimes = config_mtimes()
+        if mtimes != last:
+            last = mtimes
+            config_reset()
+            server.reset()
+
+
+def interrupt(signum: int, frame: Any) -> None:
+    """SIGTERM handler for worker 0, so that it stops the way Ctrl-C stops a
+    single process: withdrawing the beacon and saving the snapshot."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    raise KeyboardInterrupt
+
+
+def run(processes: int, run_worker: Callable[[int, Router], bool]) -> bool:
+    """Fork and supervise the workers until one of them quits or restarts
+    pyTivo; returns whether to restart. run_worker(index, router) serves
+    in a worker, and returns whether to restart."""
+    owner_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    workers: Dict[int, int] = {}
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid:
+            workers[pid] = index
+            return
+        signal.signal(signal.SIGTERM, interrupt if index == 0 else signal.SIG_DFL)
+        status = 1
+        try:
+            if index == 0:
+                worker_end.close()
+                router = Router(owner_end, True)
+            else:
+                owner_end.close()
+                router = Router(worker_end, False)
+            status = EXIT_RESTART if run_worker(index, router) else EXIT_QUIT
+        except KeyboardInterrupt:
+            status = EXIT_QUIT
+        except BaseException:
+            LOGGER.exception("Worker %d failed" % index)
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    restart = False
+    # let a service manager stopping the parent stop the workers too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+    try:
+        for index in range(processes):
+            spawn(index)
+        LOGGER.info("Started %d worker processes" % processes)
+        while True:
+            pid, status = os.wait()
+            index = workers.pop(pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) in [
+                EXIT_QUIT,
+                EXIT_RESTART,
+            ]:
+                restart = os.WEXITSTATUS(status) == EXIT_RESTART
+                break
+            LOGGER.error("Worker %d died (status %d), restarting it" % (index, status))
+            time.sleep(RESPAWN_DELAY)
+            spawn(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        owner_end.close()
+        worker_end.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    return restart
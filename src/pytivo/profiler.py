@@ -0,0 +1,170 @@
+"""Sampling profiler for live requests, started by the Settings Profile command.
+
+While a session runs, the thread that asked for it reads the stack of every
+other thread with sys._current_frames() every SAMPLE_INTERVAL seconds; the
+server's own code isn't traced, and when no session runs the only cost is
+the check in request(). A session either samples all threads for some
+seconds, or only the threads answering a given command, until that many
+such requests are done. Only one session runs at a time, and each process
+(see prefork) has its own.
+"""
+
+import marshal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, ContextManager, Dict, Iterator, Optional, Set, Tuple
+
+SAMPLE_INTERVAL = 0.01
+
+# longest a session may run, in seconds, however it was asked to end
+MAX_SECONDS = 300
+
+FORMATS = ("collapsed", "pstats")
+
+FuncKey = Tuple[str, int, str]  # as in pstats: file, first line, name
+
+
+@contextmanager
+def no_session() -> Iterator[None]:
+    # contextlib.nullcontext is Python 3.7 and up
+    yield
+
+
+class Session:
+    def __init__(
+        self, seconds: float, command: Optional[str] = None, requests: int = 0
+    ) -> None:
+        self.deadline = time.time() + min(seconds, MAX_SECONDS)
+        self.command = command
+        self.requests = requests
+        self.lock = threading.Lock()
+        # idents of the threads answering a matching request
+        self.matching: Set[int] = set()
+        self.stacks: Dict[Tuple[FuncKey, ...], int] = {}
+        self.samples = 0
+        self.done = threading.Event()
+
+    @contextmanager
+    def request(self, command: str) -> Iterator[None]:
+        if self.command is None or command != self.command or self.done.is_set():
+            yield
+            return
+        ident = threading.get_ident()
+        with self.lock:
+            self.matching.add(ident)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.matching.discard(ident)
+                self.requests -= 1
+                if self.requests <= 0:
+                    self.done.set()
+
+    def sample(self, skip: int) -> None:
+        frames = sys._current_frames()
+        with self.lock:
+            if self.command is not None:
+                idents = self.matching.intersection(frames)
+            else:
+                idents = set(frames)
+                idents.discard(skip)
+            for ident in idents:
+                stack = []
+                frame = frames[ident]
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                key = tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def run(self) -> None:
+        """Sample until the session is done, leaving out the calling thread."""
+        ident = threading.get_ident()
+        while not self.done.is_set():
+            if time.time() >= self.deadline:
+                self.done.set()
+                break
+            self.sample(ident)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def collapsed(self) -> bytes:
+        """One line per distinct stack, outermost frame first, then the
+        number of samples: the input of flamegraph.pl and speedscope."""
+        lines = []
+        for stack, count in sorted(self.stacks.items()):
+            names = ["%s (%s:%d)" % (name, path, line) for path, line, name in stack]
+            lines.append("%s %d" % (";".join(names), count))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def pstats(self) -> bytes:
+        """The samples as a marshalled stats dict, as written by
+        cProfile.Profile.dump_stats(), for pstats.Stats() or snakeviz.
+        Times are samples * SAMPLE_INTERVAL; call counts are sample counts."""
+        own: Dict[FuncKey, int] = {}
+        total: Dict[FuncKey, int] = {}
+        callers: Dict[FuncKey, Dict[FuncKey, int]] = {}
+        for stack, count in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for func in set(stack):
+                total[func] = total.get(func, 0) + count
+            for caller, func in set(zip(stack, stack[1:])):
+                func_callers = callers.setdefault(func, {})
+                func_callers[caller] = func_callers.get(caller, 0) + count
+
+        stats: Dict[FuncKey, Any] = {}
+        for func, count in total.items():
+            stats[func] = (
+                count,
+                count,
+                own.get(func, 0) * SAMPLE_INTERVAL,
+                count * SAMPLE_INTERVAL,
+                {
+                    caller: (n, n, 0.0, n * SAMPLE_INTERVAL)
+                    for caller, n in callers.get(func, {}).items()
+                },
+            )
+        return marshal.dumps(stats)
+
+
+SESSION: Optional[Session] = None
+SESSION_LOCK = threading.Lock()
+
+
+def request(command: str) -> ContextManager[None]:
+    """Wrap the answer to a request, so a session can tell which threads
+    to sample."""
+    session = SESSION
+    if session is None:
+        return no_session()
+    return session.request(command)
+
+
+def profile(
+    seconds: float, command: Optional[str] = None, requests: int = 0
+) -> Optional[Session]:
+    """Sample for seconds, or until requests commands have been answered
+    (but no longer than seconds), and return the finished session; None if
+    another session is running."""
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is not None:
+            return None
+        session = SESSION = Session(seconds, command, requests)
+    try:
+        session.run()
+    finally:
+        with SESSION_LOCK:
+            SESSION = None
+    return session
+
+
+def render(session: Session, fmt: str) -> bytes:
+    if fmt == "pstats":
+        return session.pstats()
+    return session.collapsed()
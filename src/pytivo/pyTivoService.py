@@ -9,6 +9,7 @@ import win32event
 import win32serviceutil
 
 from pytivo.main import setup
+from pytivo.snapshot import save_snapshot
 
 
 class PyTivoService(win32serviceutil.ServiceFramework):
@@ -31,7 +32,9 @@ class PyTivoService(win32serviceutil.ServiceFramework):
             if rc == win32event.WAIT_OBJECT_0 or httpd.stop:
                 break
 
+        httpd.server_close()
         httpd.beacon.stop()
+        save_snapshot()
         return httpd.restart
 
     def SvcDoRun(self):
@@ -1,5 +1,5 @@
 import os
-from typing import Dict, List, TypeVar
+from typing import Dict, List, Optional, TypeVar
 
 
 class Bdict(dict):
@@ -8,13 +8,56 @@ class Bdict(dict):
 
 
 class FileData:
-    def __init__(self, name: str, isdir: bool) -> None:
+    """A listed file. The stat fields are looked up on first use unless
+    given, since most listings only need them for the page being shown."""
+
+    __slots__ = ("name", "isdir", "_mdate", "_cdate", "_size")
+
+    def __init__(
+        self,
+        name: str,
+        isdir: bool,
+        mdate: Optional[float] = None,
+        cdate: Optional[float] = None,
+        size: Optional[int] = None,
+    ) -> None:
         self.name: str = name
         self.isdir: bool = isdir
-        st = os.stat(name)
-        self.mdate: float = st.st_mtime
-        self.cdate: float = st.st_ctime
-        self.size: int = st.st_size
+        self._mdate = mdate
+        self._cdate = cdate
+        self._size = size
+
+    def _stat(self) -> None:
+        try:
+            st = os.stat(self.name)
+            mdate, cdate, size = st.st_mtime, st.st_ctime, st.st_size
+        except (OSError, ValueError):
+            # e.g. a playlist entry that is a URL
+            mdate, cdate, size = 0.0, 0.0, 0
+        if self._mdate is None:
+            self._mdate = mdate
+        if self._cdate is None:
+            self._cdate = cdate
+        if self._size is None:
+            self._size = size
+
+    @property
+    def mdate(self) -> float:
+        if self._mdate is None:
+            self._stat()
+        return self._mdate  # type: ignore
+
+    @property
+    def cdate(self) -> float:
+        if self._cdate is None:
+            self._stat()
+        return self._cdate  # type: ignore
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._stat()
+        return self._size  # type: ignore
 
 
 FileDataLike = TypeVar("FileDataLike", bound=FileData)
@@ -0,0 +1,73 @@
+"""Rendered responses, kept with a stamp of what they were rendered from.
+
+A cached response is reused only while the stamp its caller computes for
+the request still matches, and for at most RESPONSE_TTL seconds, to pick up
+changes the stamp can't see, such as edited metadata text files.
+"""
+
+import gzip
+import hashlib
+import io
+import time
+from typing import Any, NamedTuple, Optional, Tuple
+
+import pytivo.config
+from pytivo.config import tsn_class
+from pytivo.lrucache import CacheKeyError, LockedLRUCache
+import pytivo.metrics
+from pytivo.pytivo_types import Query
+
+RESPONSE_TTL = 300
+
+
+class CachedResponse(NamedTuple):
+    stamp: Any
+    body: bytes
+    gzipped: Optional[bytes]  # None if body is too small to be worth it
+    etag: str
+
+
+def gzip_body(body: bytes) -> bytes:
+    """body gzipped without a timestamp, so the same body always gives the
+    same bytes (gzip.compress() only takes mtime from Python 3.8)."""
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as gz_fh:
+        gz_fh.write(body)
+    return out.getvalue()
+
+
+def response_key(query: Query, tsn: str) -> Tuple[Any, ...]:
+    return (
+        tuple(sorted((k, tuple(v)) for k, v in query.items())),
+        tsn_class(tsn),
+        pytivo.config.CONFIG_GENERATION,
+    )
+
+
+class ResponseCache:
+    def __init__(self, size: int) -> None:
+        self.cache = LockedLRUCache(size)
+
+    def lookup(self, key: Any, stamp: Any) -> Optional[CachedResponse]:
+        try:
+            response = self.cache[key]
+            added = self.cache.mtime(key)
+        except CacheKeyError:
+            pytivo.metrics.cache_lookup("response", False)
+            return None
+        if response.stamp != stamp or added + RESPONSE_TTL < time.time():
+            pytivo.metrics.cache_lookup("response", False)
+            return None
+        pytivo.metrics.cache_lookup("response", True)
+        return response
+
+    def store(self, key: Any, stamp: Any, body: bytes) -> CachedResponse:
+        response = CachedResponse(
+            stamp,
+            body,
+            gzip_body(body) if len(body) > 256 else None,
+            # weak, as the plain and gzipped bodies share it
+            'W/"%s"' % hashlib.sha1(body).hexdigest(),
+        )
+        self.cache[key] = response
+        return response
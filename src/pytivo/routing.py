@@ -0,0 +1,86 @@
+"""Share lookup for request dispatch.
+
+getShares() rebuilds the settings of every share from the ConfigParser, with
+interpolation, each time it's called. The routing table does that, and the
+plugin lookup, once per config generation; a request then finds its share by
+name in a dict. Tables and their settings are shared by all requests, so
+they must not be changed.
+"""
+
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import pytivo.config
+from pytivo.config import getShares
+from pytivo.plugin import Error, GetPlugin, Plugin
+from pytivo.pytivo_types import Bdict, Settings
+
+LOGGER = logging.getLogger(__name__)
+
+# plugin content types that are listed in the root container
+ROOT_TYPES = ("tivo-videos", "tivo-music", "tivo-photos")
+
+
+class Route(NamedTuple):
+    name: str
+    settings: Settings
+    plugin: Union[Plugin, Error]
+
+
+class ShareRoutes:
+    """The shares one TiVo can see, in getShares() order."""
+
+    def __init__(self, shares: List[Tuple[str, Settings]]) -> None:
+        self.routes: Tuple[Route, ...] = tuple(
+            Route(name, settings, GetPlugin(settings.get("type", "")))
+            for name, settings in shares
+        )
+        self.by_name: Dict[str, Route] = {}
+        for route in self.routes:
+            self.by_name.setdefault(route.name, route)
+
+        # (name, settings with content_type) for the root container
+        self.containers: List[Tuple[str, Settings]] = []
+        for route in self.routes:
+            mime = route.plugin.CONTENT_TYPE
+            if mime.split("/")[-1] in ROOT_TYPES:
+                self.containers.append(
+                    (route.name, Bdict(route.settings, content_type=mime))
+                )
+
+    def get(self, name: str) -> Optional[Route]:
+        return self.by_name.get(name)
+
+
+class RoutingTable:
+    def __init__(self) -> None:
+        self.generation = pytivo.config.CONFIG_GENERATION
+        self.default = ShareRoutes(getShares())
+        # TiVos whose section limits them to some shares
+        self.restricted: Dict[str, ShareRoutes] = {}
+        config = pytivo.config.CONFIG
+        for section in config.sections():
+            if section.startswith("_tivo_") and config.has_option(section, "shares"):
+                tsn = section[6:]
+                self.restricted[tsn] = ShareRoutes(getShares(tsn))
+
+    def for_tsn(self, tsn: str) -> ShareRoutes:
+        return self.restricted.get(tsn, self.default)
+
+
+TABLE: Optional[RoutingTable] = None
+TABLE_LOCK = threading.Lock()
+
+
+def get_routes(tsn: str = "") -> ShareRoutes:
+    """The shares visible to tsn, rebuilt after the config is reloaded."""
+    global TABLE
+
+    table = TABLE
+    if table is None or table.generation != pytivo.config.CONFIG_GENERATION:
+        with TABLE_LOCK:
+            table = TABLE
+            if table is None or table.generation != pytivo.config.CONFIG_GENERATION:
+                table = TABLE = RoutingTable()
+    return table.for_tsn(tsn)
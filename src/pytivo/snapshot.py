@@ -0,0 +1,161 @@
+"""Save registered in-memory caches on shutdown and restore them on startup.
+
+Each cache entry is stored together with the mtime of the file it was built
+from, and is only restored if that file is unchanged.
+
+The snapshot is a pickle, and loading a pickle can run arbitrary code, so it
+is off unless cache_snapshot is set, and the file must be writable only by
+the user pyTivo runs as. A snapshot that can't be read is ignored.
+"""
+
+import logging
+import os
+import pickle
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from pytivo.config import get_cache_snapshot
+from pytivo.lrucache import CacheKeyError, LockedLRUCache, LRUCache
+
+LOGGER = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 2
+
+
+class RegisteredCache(NamedTuple):
+    cache: LRUCache
+    source: Callable[[Any], str]  # path whose mtime validates a cache key
+
+
+CACHES: Dict[str, RegisteredCache] = {}
+PENDING: Dict[str, bytes] = {}  # snapshot data for caches not registered yet
+LOADED = False
+
+
+def register_cache(
+    name: str, cache: LRUCache, source: Callable[[Any], str] = lambda key: key
+) -> None:
+    CACHES[name] = RegisteredCache(cache, source)
+    if name in PENDING:
+        _restore(name, PENDING.pop(name))
+
+
+def _source_mtime(registered: RegisteredCache, key: Any) -> Optional[float]:
+    try:
+        return os.path.getmtime(registered.source(key))
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _restore(name: str, blob: bytes) -> None:
+    registered = CACHES[name]
+    restored = 0
+    try:
+        entries: List[Tuple[Any, float, Any]] = pickle.loads(blob)
+        # entries are stored least-recently-used first, so recency is preserved
+        for key, mtime, value in entries:
+            if _source_mtime(registered, key) == mtime:
+                registered.cache[key] = value
+                restored += 1
+    except Exception as msg:
+        LOGGER.warning("Unable to restore %s cache: %s" % (name, msg))
+        return
+    LOGGER.info("Restored %d of %d %s cache entries" % (restored, len(entries), name))
+
+
+def _trusted(path: str) -> bool:
+    """Whether only this user can have written path."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & 0o022
+
+
+def load_snapshot() -> None:
+    global LOADED
+    # a restart keeps this process and its caches, so only load once
+    if LOADED:
+        return
+    LOADED = True
+
+    path = get_cache_snapshot()
+    if path is None or not os.path.exists(path):
+        return
+    if not _trusted(path):
+        LOGGER.error(
+            "Ignoring cache snapshot %s: it must belong to this user, and"
+            " not be writable by others" % path
+        )
+        return
+
+    try:
+        with open(path, "rb") as snap_fh:
+            data = pickle.load(snap_fh)
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            LOGGER.info("Ignoring cache snapshot %s from another version" % path)
+            return
+        blobs = dict(data["caches"])
+    except Exception as msg:
+        LOGGER.warning("Unable to read cache snapshot %s: %s" % (path, msg))
+        return
+
+    for name, blob in blobs.items():
+        if name in CACHES:
+            _restore(name, blob)
+        else:
+            PENDING[name] = blob
+
+
+def _items(cache: LRUCache) -> List[Tuple[Any, Any]]:
+    """The entries of cache, least recently used first, taken under its lock
+    if it has one, since prefetch threads may still be adding to it."""
+    if isinstance(cache, LockedLRUCache):
+        with cache.lock:
+            return [(key, cache[key]) for key in cache]
+    items = []
+    for key in list(cache):
+        try:
+            items.append((key, cache[key]))
+        except CacheKeyError:
+            continue
+    return items
+
+
+def save_snapshot() -> None:
+    path = get_cache_snapshot()
+    if path is None:
+        return
+
+    caches = {}
+    for name, registered in CACHES.items():
+        try:
+            entries = []
+            for key, value in _items(registered.cache):
+                mtime = _source_mtime(registered, key)
+                if mtime is not None:
+                    entries.append((key, mtime, value))
+            caches[name] = pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+        except Exception as msg:
+            LOGGER.warning("Unable to save %s cache: %s" % (name, msg))
+
+    # keep snapshots of caches whose plugin was never loaded this run
+    caches.update((name, blob) for name, blob in PENDING.items() if name not in caches)
+
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # private, or load_snapshot() would refuse it
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as snap_fh:
+            pickle.dump(
+                {"version": SNAPSHOT_VERSION, "caches": caches},
+                snap_fh,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+    except OSError as msg:
+        LOGGER.error("Unable to write cache snapshot %s: %s" % (path, msg))
+        return
+    LOGGER.info("Saved cache snapshot to %s" % path)
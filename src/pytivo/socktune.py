@@ -0,0 +1,53 @@
+"""Socket options for a TiVo's connections, from its profile.
+
+stream_sndbuf sets SO_SNDBUF for video sends; 0 leaves the kernel to size
+the buffer (on Linux a fixed size also turns off its autotuning).
+stream_cork sets TCP_CORK for the length of a video send, so the response
+headers go out in the same segment as the start of the body, and the rest
+in full segments whatever the size of the writes; it's Linux only, and
+ignored elsewhere. xml_nodelay sets TCP_NODELAY on connections that
+TiVoConnect commands are answered on, so a short XML reply isn't held back
+by Nagle's algorithm.
+"""
+
+import logging
+import socket
+from typing import Any
+
+from pytivo.config import TivoProfile
+
+LOGGER = logging.getLogger(__name__)
+
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+
+def set_option(sock: Any, level: int, option: int, value: int) -> bool:
+    try:
+        sock.setsockopt(level, option, value)
+    except (OSError, AttributeError) as msg:
+        LOGGER.debug("setsockopt %d failed: %s" % (option, msg))
+        return False
+    return True
+
+
+def tune_xml(sock: Any, profile: TivoProfile) -> None:
+    if sock is not None and profile.xml_nodelay:
+        set_option(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def tune_stream(sock: Any, profile: TivoProfile) -> bool:
+    """Apply the stream options, before the response headers are sent;
+    returns whether the socket was corked."""
+    if sock is None:
+        return False
+    if profile.stream_sndbuf:
+        set_option(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, profile.stream_sndbuf)
+    if profile.stream_cork and TCP_CORK is not None:
+        return set_option(sock, socket.IPPROTO_TCP, TCP_CORK, 1)
+    return False
+
+
+def uncork(sock: Any) -> None:
+    if TCP_CORK is not None:
+        set_option(sock, socket.IPPROTO_TCP, TCP_CORK, 0)
+
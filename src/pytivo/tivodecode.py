@@ -0,0 +1,569 @@
+"""Decrypt .TiVo files to plain MPEG program or transport streams.
+
+This stands in for the tivodecode binary when it isn't installed. The
+command line mirrors tivodecode's:
+
+    python -m pytivo.tivodecode -m MAK [-o outfile] [-j workers] infile|-
+
+Each encrypted PES packet (program streams) or TS packet (transport
+streams) is decrypted with a Turing keystream derived from the MAK, the
+stream id and a block number carried in the stream. Consecutive packets
+of a stream share one keystream until its block number changes.
+Decryption is spread over a pool of worker processes and the output is
+reassembled in order.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sys
+from typing import (
+    BinaryIO,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from pytivo.config import get_bin
+from pytivo.metadata import (
+    TIVO_CHUNK_ENCRYPTED,
+    TIVO_HEADER_SIZE,
+    TIVO_KEY_CHUNK_ID,
+    TivoHeader,
+    parse_tivo_header,
+    tivo_turing_key,
+)
+from pytivo.turing import Turing
+
+LOGGER = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+TS_PACKET_SIZE = 188
+TS_TIVO_STREAM_TYPE = 0x97  # PMT stream type of the TiVo private data PID
+PES_HEADER_STREAMS = set([0xBD] + list(range(0xC0, 0xF0)))
+
+
+class EncryptedUnit(NamedTuple):
+    header: bytes  # clear bytes, with scrambling bits already cleared
+    stream_id: int
+    block_no: int
+    payload: bytes  # encrypted bytes following the header
+
+
+Piece = Union[bytes, EncryptedUnit]
+
+
+def decoder_cmd(mak: str) -> List[str]:
+    """Command line for a tivodecode compatible decoder, preferring the
+    tivodecode binary if there is one."""
+    tivodecode_path = get_bin("tivodecode")
+    if tivodecode_path:
+        return [tivodecode_path, "-m", mak]
+    return [sys.executable, "-m", "pytivo.tivodecode", "-m", mak]
+
+
+def private_data_fields(data: bytes) -> Tuple[int, int]:
+    """Block number and crypted word from the 16 bytes of TiVo private
+    data. Both are packed between marker bits."""
+    block_no = (
+        ((data[1] & 0x3F) << 18)
+        | (data[2] << 10)
+        | ((data[3] & 0xC0) << 2)
+        | ((data[3] & 0x1F) << 3)
+        | ((data[4] & 0xE0) >> 5)
+    )
+    crypted = (
+        ((data[7] & 0x03) << 30)
+        | (data[8] << 22)
+        | ((data[9] & 0xFC) << 14)
+        | ((data[9] & 0x01) << 15)
+        | (data[10] << 7)
+        | ((data[11] & 0xFE) >> 1)
+    )
+    return block_no, crypted
+
+
+def frame_key(base_key: bytes, stream_id: int, block_no: int) -> bytes:
+    return base_key + bytes(
+        [stream_id, (block_no >> 16) & 0xFF, (block_no >> 8) & 0xFF, block_no & 0xFF]
+    )
+
+
+class Keystream:
+    """Byte addressable keystream for one frame key.
+
+    Requests are expected at increasing offsets; going backwards
+    restarts the cipher.
+    """
+
+    def __init__(self, key: bytes) -> None:
+        self.key = key
+        self.reset()
+
+    def reset(self) -> None:
+        self.turing = Turing(*tivo_turing_key(self.key))
+        self.start = 0  # stream offset of buf
+        self.buf = b""  # generated but unused keystream, ends on a round
+
+    def crypt(self, offset: int, data: bytes) -> bytes:
+        if offset < self.start:
+            self.reset()
+        end = offset + len(data)
+        boundary = self.start + len(self.buf)
+        if end > boundary:
+            skip_rounds = max(offset - boundary, 0) // 20
+            rounds = -(-(end - boundary - 20 * skip_rounds) // 20)
+            more = self.turing.keystream(rounds, skip_rounds)
+            if skip_rounds:
+                self.start, self.buf = boundary + 20 * skip_rounds, more
+            else:
+                self.buf += more
+        keys = self.buf[offset - self.start : end - self.start]
+        self.buf = self.buf[end - self.start :]
+        self.start = end
+        return (int.from_bytes(data, "big") ^ int.from_bytes(keys, "big")).to_bytes(
+            len(data), "big"
+        )
+
+
+# per-process keystreams, so a worker handed the next job for a frame can
+# continue where it left off
+WORKER_KEYSTREAMS: "collections.OrderedDict[bytes, Keystream]" = (
+    collections.OrderedDict()
+)
+MAX_WORKER_KEYSTREAMS = 32
+
+
+def decrypt_job(key: bytes, segments: List[Tuple[int, bytes]]) -> List[bytes]:
+    stream = WORKER_KEYSTREAMS.pop(key, None)
+    if stream is None:
+        stream = Keystream(key)
+    WORKER_KEYSTREAMS[key] = stream
+    while len(WORKER_KEYSTREAMS) > MAX_WORKER_KEYSTREAMS:
+        WORKER_KEYSTREAMS.popitem(last=False)
+    return [stream.crypt(offset, data) for offset, data in segments]
+
+
+def pes_header_length(data: bytes, pos: int) -> int:
+    """Length of the PES header at pos, plus any MPEG video headers
+    following it in the same packet, which are sent in the clear."""
+    start = pos
+    end = len(data)
+    if data[pos : pos + 3] != b"\0\0\x01" or pos + 9 > end:
+        return 0
+    is_video = 0xE0 <= data[pos + 3] <= 0xEF
+    pos += 9 + data[pos + 8]
+
+    while is_video and pos + 6 <= end and data[pos : pos + 3] == b"\0\0\x01":
+        code = data[pos + 3]
+        if code == 0xB3:  # sequence header, maybe with quantiser matrices
+            size = 12
+            if pos + size <= end and data[pos + 11] & 0x02:
+                size += 64
+            if pos + size <= end and data[pos + size - 1] & 0x01:
+                size += 64
+        elif code == 0xB8:  # group of pictures
+            size = 8
+        elif code == 0x00:  # picture; P and B frames carry f_codes
+            size = 8 if (data[pos + 5] >> 3) & 7 == 1 else 9
+        elif code == 0xB5:
+            ext = data[pos + 4] >> 4
+            if ext == 1:  # sequence extension
+                size = 10
+            elif ext == 2:  # sequence display, maybe with colour description
+                size = 12 if data[pos + 4] & 0x01 else 9
+            elif ext == 8 and pos + 9 <= end:  # picture coding, maybe composite
+                size = 11 if data[pos + 8] & 0x40 else 9
+            else:
+                break
+        else:
+            break
+        pos += size
+
+    return min(pos, end) - start
+
+
+class PsParser:
+    """Split an MPEG program stream into clear and encrypted pieces."""
+
+    def __init__(self) -> None:
+        self.warned = False
+
+    def parse(self, buf: bytes, final: bool) -> Tuple[int, List[Piece]]:
+        pieces: List[Piece] = []
+        pos = 0
+        end = len(buf)
+        while pos + 4 <= end:
+            if buf[pos : pos + 3] != b"\0\0\x01":
+                sync = buf.find(b"\0\0\x01", pos + 1)
+                if sync < 0:
+                    sync = end if final else end - 2
+                pieces.append(buf[pos:sync])
+                pos = sync
+                continue
+
+            code = buf[pos + 3]
+            if code == 0xBA:  # pack header
+                if pos + 14 > end:
+                    break
+                if buf[pos + 4] & 0xC0 == 0x40:
+                    size = 14 + (buf[pos + 13] & 0x07)
+                else:
+                    size = 12
+            elif code == 0xB9:  # program end
+                size = 4
+            elif code >= 0xBB:  # system header and PES packets
+                if pos + 6 > end:
+                    break
+                size = 6 + ((buf[pos + 4] << 8) | buf[pos + 5])
+            else:
+                size = 4
+
+            if pos + size > end:
+                break
+            packet = buf[pos : pos + size]
+            pos += size
+
+            if code in PES_HEADER_STREAMS and size > 9 and packet[6] & 0x30:
+                pieces.append(self.encrypted_unit(code, packet))
+            else:
+                pieces.append(packet)
+
+        if final and pos < end:
+            pieces.append(buf[pos:])
+            pos = end
+        return pos, pieces
+
+    def encrypted_unit(self, code: int, packet: bytes) -> Piece:
+        flags = packet[7]
+        header_end = 9 + packet[8]
+
+        # find the PES private data in the PES extension
+        private = None
+        if flags & 0x01:
+            pos = 9
+            pos += {0x80: 5, 0xC0: 10}.get(flags & 0xC0, 0)
+            for flag, size in ((0x20, 6), (0x10, 3), (0x08, 1), (0x04, 1), (0x02, 2)):
+                if flags & flag:
+                    pos += size
+            if pos + 17 <= header_end and packet[pos] & 0x80:
+                private = packet[pos + 1 : pos + 17]
+
+        if private is None:
+            if not self.warned:
+                LOGGER.warning("Scrambled PES packet without TiVo private data")
+                self.warned = True
+            return packet
+
+        block_no, crypted = private_data_fields(private)
+        header = bytearray(packet[:header_end])
+        header[6] &= 0xCF
+        return EncryptedUnit(bytes(header), code, block_no, packet[header_end:])
+
+
+class TsParser:
+    """Split an MPEG transport stream into clear and encrypted pieces.
+
+    Keys for each PID come from the TiVo private data PID, which is
+    listed in the PMT with stream type 0x97.
+    """
+
+    def __init__(self) -> None:
+        self.pmt_pids: Set[int] = set()
+        self.tivo_pids: Set[int] = set()
+        self.keys: Dict[int, Tuple[int, int]] = {}  # pid -> stream_id, block_no
+        self.warned: Set[int] = set()
+
+    def parse(self, buf: bytes, final: bool) -> Tuple[int, List[Piece]]:
+        pieces: List[Piece] = []
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            if buf[pos] != 0x47:
+                sync = buf.find(b"\x47", pos + 1)
+                if sync < 0:
+                    sync = end
+                pieces.append(buf[pos:sync])
+                pos = sync
+                continue
+            if pos + TS_PACKET_SIZE > end:
+                if final:
+                    pieces.append(buf[pos:])
+                    pos = end
+                break
+
+            packet = buf[pos : pos + TS_PACKET_SIZE]
+            pos += TS_PACKET_SIZE
+            pieces.append(self.packet(packet))
+
+        return pos, pieces
+
+    def packet(self, packet: bytes) -> Piece:
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        pusi = packet[1] & 0x40
+        control = packet[3]
+        if not control & 0x10:  # no payload
+            return packet
+        start = 4
+        if control & 0x20:
+            start += 1 + packet[4]
+        if start >= TS_PACKET_SIZE:
+            return packet
+
+        if control & 0xC0:
+            if pid not in self.keys:
+                if pid not in self.warned:
+                    LOGGER.warning("No key for scrambled PID 0x%04x" % pid)
+                    self.warned.add(pid)
+                return packet
+            if pusi:
+                start += pes_header_length(packet, start)
+            stream_id, block_no = self.keys[pid]
+            header = bytearray(packet[:start])
+            header[3] &= 0x3F
+            return EncryptedUnit(bytes(header), stream_id, block_no, packet[start:])
+
+        try:
+            if pid == 0 and pusi:
+                self.parse_pat(packet, start)
+            elif pid in self.pmt_pids and pusi:
+                self.parse_pmt(packet, start)
+            elif pid in self.tivo_pids:
+                self.parse_tivo(packet, start)
+        except IndexError:
+            LOGGER.debug("Truncated table in PID 0x%04x" % pid)
+        return packet
+
+    def section(self, packet: bytes, start: int) -> Tuple[int, int]:
+        """Start and end (excluding CRC) of the PSI section in packet."""
+        pos = start + 1 + packet[start]
+        length = ((packet[pos + 1] & 0x0F) << 8) | packet[pos + 2]
+        return pos, min(pos + 3 + length - 4, TS_PACKET_SIZE)
+
+    def parse_pat(self, packet: bytes, start: int) -> None:
+        pos, end = self.section(packet, start)
+        for entry in range(pos + 8, end - 3, 4):
+            program = (packet[entry] << 8) | packet[entry + 1]
+            if program:
+                self.pmt_pids.add(((packet[entry + 2] & 0x1F) << 8) | packet[entry + 3])
+
+    def parse_pmt(self, packet: bytes, start: int) -> None:
+        pos, end = self.section(packet, start)
+        pos += 12 + (((packet[pos + 10] & 0x0F) << 8) | packet[pos + 11])
+        while pos + 5 <= end:
+            stream_type = packet[pos]
+            pid = ((packet[pos + 1] & 0x1F) << 8) | packet[pos + 2]
+            if stream_type == TS_TIVO_STREAM_TYPE:
+                self.tivo_pids.add(pid)
+            pos += 5 + (((packet[pos + 3] & 0x0F) << 8) | packet[pos + 4])
+
+    def parse_tivo(self, packet: bytes, start: int) -> None:
+        pos = packet.find(b"TiVo", start)
+        if pos < 0 or pos + 10 > TS_PACKET_SIZE:
+            return
+        validator = (packet[pos + 4] << 8) | packet[pos + 5]
+        if validator != 0x8101:
+            LOGGER.debug("Unexpected TiVo private data validator 0x%04x" % validator)
+        stream_bytes = packet[pos + 9]
+        pos += 10
+        while stream_bytes >= 20 and pos + 20 <= TS_PACKET_SIZE:
+            pid = ((packet[pos] << 8) | packet[pos + 1]) & 0x1FFF
+            block_no, crypted = private_data_fields(packet[pos + 4 : pos + 20])
+            self.keys[pid] = (packet[pos + 2], block_no)
+            pos += 20
+            stream_bytes -= 20
+
+
+class TivoDecoder:
+    """Incremental .TiVo decoder: feed() it the file and it yields the
+    decrypted MPEG stream.
+
+    With workers > 1, decryption runs in a process pool, keeping up to
+    2 * workers batches in flight.
+    """
+
+    def __init__(self, mak: str, workers: int = 0) -> None:
+        self.mak = mak.encode("utf-8")
+        self.workers = workers
+        self.pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if workers > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+        self.buf = b""
+        self.header: Optional[TivoHeader] = None
+        self.base_key = b""
+        self.parser: Union[PsParser, TsParser, None] = None
+        self.skip = 0  # header bytes still to drop
+        self.streams: Dict[int, Tuple[int, int]] = {}  # stream_id -> block, offset
+        self.pending: Deque[
+            Tuple[List[Piece], Dict[bytes, "concurrent.futures.Future[List[bytes]]"]]
+        ] = collections.deque()
+
+    def start(self) -> bool:
+        if len(self.buf) < TIVO_HEADER_SIZE:
+            return False
+        offset = int.from_bytes(self.buf[10:14], "big")
+        if len(self.buf) < offset:
+            return False
+
+        self.header = parse_tivo_header(self.buf[:offset])
+        self.skip = offset
+        plaintext = [
+            chunk
+            for chunk in self.header.chunks
+            if chunk.type != TIVO_CHUNK_ENCRYPTED
+        ]
+        if not plaintext:
+            raise ValueError("No plaintext chunk to derive the key from")
+        key_chunk = next(
+            (chunk for chunk in plaintext if chunk.id == TIVO_KEY_CHUNK_ID),
+            plaintext[-1],
+        )
+        self.base_key = hashlib.sha1(self.mak + key_chunk.data).digest()[:16]
+        self.parser = TsParser() if self.header.is_ts else PsParser()
+        LOGGER.debug(
+            "Decoding %s stream, data at offset %d"
+            % ("TS" if self.header.is_ts else "PS", offset)
+        )
+        return True
+
+    def feed(self, data: bytes, final: bool = False) -> Iterator[bytes]:
+        self.buf += data
+        if self.parser is None and not self.start():
+            if final and self.buf:
+                raise ValueError("Truncated TiVo header")
+            return
+        assert self.parser is not None
+
+        if self.skip:
+            dropped = min(self.skip, len(self.buf))
+            self.buf = self.buf[dropped:]
+            self.skip -= dropped
+
+        used, pieces = self.parser.parse(self.buf, final)
+        self.buf = self.buf[used:]
+        if pieces:
+            self.submit(pieces)
+
+        window = 0 if final else 2 * max(self.workers, 1)
+        while len(self.pending) > window or (
+            self.pending and all(f.done() for f in self.pending[0][1].values())
+        ):
+            yield self.assemble(*self.pending.popleft())
+
+    def close(self) -> Iterator[bytes]:
+        """Flush everything still buffered or in flight."""
+        return self.feed(b"", final=True)
+
+    def shutdown(self) -> None:
+        if self.pool is not None:
+            # by hand, as shutdown(cancel_futures=True) is Python 3.9 and up
+            for _, futures in self.pending:
+                for future in futures.values():
+                    future.cancel()
+            self.pending.clear()
+            self.pool.shutdown()
+            self.pool = None
+
+    def submit(self, pieces: List[Piece]) -> None:
+        # group this batch's encrypted units by frame key, so each job
+        # walks one keystream forwards
+        jobs: Dict[bytes, List[Tuple[int, bytes]]] = {}
+        for piece in pieces:
+            if isinstance(piece, EncryptedUnit):
+                block_no, offset = self.streams.get(piece.stream_id, (-1, 0))
+                if block_no != piece.block_no:
+                    offset = 0
+                # the 4 byte crypted word takes the start of each unit's keystream
+                offset += 4
+                key = frame_key(self.base_key, piece.stream_id, piece.block_no)
+                jobs.setdefault(key, []).append((offset, piece.payload))
+                self.streams[piece.stream_id] = (
+                    piece.block_no,
+                    offset + len(piece.payload),
+                )
+
+        futures: Dict[bytes, "concurrent.futures.Future[List[bytes]]"] = {}
+        for key, segments in jobs.items():
+            if self.pool is not None:
+                futures[key] = self.pool.submit(decrypt_job, key, segments)
+            else:
+                future: "concurrent.futures.Future[List[bytes]]" = (
+                    concurrent.futures.Future()
+                )
+                future.set_result(decrypt_job(key, segments))
+                futures[key] = future
+        self.pending.append((pieces, futures))
+
+    def assemble(
+        self,
+        pieces: List[Piece],
+        futures: Dict[bytes, "concurrent.futures.Future[List[bytes]]"],
+    ) -> bytes:
+        results = {key: iter(future.result()) for key, future in futures.items()}
+        out = []
+        for piece in pieces:
+            if isinstance(piece, EncryptedUnit):
+                key = frame_key(self.base_key, piece.stream_id, piece.block_no)
+                out.append(piece.header)
+                out.append(next(results[key]))
+            else:
+                out.append(piece)
+        return b"".join(out)
+
+
+def decode(infile: BinaryIO, mak: str, workers: int = 0) -> Iterator[bytes]:
+    """Yield the decrypted MPEG stream of the .TiVo file infile."""
+    decoder = TivoDecoder(mak, workers)
+    try:
+        while True:
+            data = infile.read(READ_SIZE)
+            if not data:
+                break
+            yield from decoder.feed(data)
+        yield from decoder.close()
+    finally:
+        decoder.shutdown()
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m pytivo.tivodecode", description="Decode a .TiVo file"
+    )
+    parser.add_argument("-m", "--mak", required=True, help="media access key")
+    parser.add_argument("-o", "--out", help="output file (default stdout)")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes (default: number of CPUs)",
+    )
+    parser.add_argument("infile", help='.TiVo file, or "-" for stdin')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    infile = sys.stdin.buffer if args.infile == "-" else open(args.infile, "rb")
+    outfile = sys.stdout.buffer if args.out is None else open(args.out, "wb")
+    try:
+        for block in decode(infile, args.mak, args.jobs):
+            outfile.write(block)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            outfile.close()
+        except BrokenPipeError:
+            pass
+
+
+if __name__ == "__main__":
+    cli()
@@ -264,6 +264,7 @@ _SBOX = [
 _MAXKEY = 32  # bytes
 _MAXKIV = 48  # bytes
 _LFSRLEN = 17  # words
+_BATCH_ROUNDS = 1024  # rounds generated per pass over the LFSR window
 
 
 def _rotl(w: int, x: int) -> int:
@@ -371,37 +372,101 @@ class Turing:
     def _step(self, n: int = 1) -> None:
         """ Step the LFSR """
         lfsr = self.lfsr
-        while n:
-            oldw = lfsr.pop(0)
-            neww = lfsr[14] ^ lfsr[3] ^ ((oldw & 0xFFFFFF) << 8) ^ _MULTAB[oldw >> 24]
-            lfsr.append(neww)
-            n -= 1
+        lfsr.extend([0] * n)
+        for p in range(n):
+            oldw = lfsr[p]
+            lfsr[p + 17] = (
+                lfsr[p + 15]
+                ^ lfsr[p + 4]
+                ^ ((oldw & 0xFFFFFF) << 8)
+                ^ _MULTAB[oldw >> 24]
+            )
+        del lfsr[:n]
+
+    def _rounds(self, rounds: int, skip_rounds: int = 0) -> List[int]:
+        """ Run skip_rounds rounds without output, then rounds rounds,
+            returning their output as a list of 32-bit words.
+
+            Rather than rotating a 17 word register, new words are
+            appended to a window over the register's history, so word k
+            of the register at step p is simply lfsr[p + k].
+
+        """
+        out: List[int] = []
+        s0, s1, s2, s3 = self.sbox
+        multab = _MULTAB
+        lfsr = self.lfsr
+        total = skip_rounds + rounds
+
+        done = 0
+        while done < total:
+            batch = min(total - done, _BATCH_ROUNDS)
+            # all words needed by this batch of rounds
+            lfsr.extend([0] * (5 * batch))
+            for p in range(5 * batch):
+                oldw = lfsr[p]
+                lfsr[p + 17] = (
+                    lfsr[p + 15]
+                    ^ lfsr[p + 4]
+                    ^ ((oldw & 0xFFFFFF) << 8)
+                    ^ multab[oldw >> 24]
+                )
+
+            first = max(skip_rounds - done, 0)
+            for p in range(5 * first, 5 * batch, 5):
+                # mix, then keyed S-boxes with byte rotations 0, 1, 2, 3, 0
+                a, b, c, d, e = (
+                    lfsr[p + 17],
+                    lfsr[p + 14],
+                    lfsr[p + 7],
+                    lfsr[p + 2],
+                    lfsr[p + 1],
+                )
+                t = a + b + c + d + e
+                a = (a + t) & 0xFFFFFFFF
+                b = (b + t) & 0xFFFFFFFF
+                c = (c + t) & 0xFFFFFFFF
+                d = (d + t) & 0xFFFFFFFF
+                e = t & 0xFFFFFFFF
+                a = s0[a >> 24] ^ s1[a >> 16 & 0xFF] ^ s2[a >> 8 & 0xFF] ^ s3[a & 0xFF]
+                b = s0[b >> 16 & 0xFF] ^ s1[b >> 8 & 0xFF] ^ s2[b & 0xFF] ^ s3[b >> 24]
+                c = s0[c >> 8 & 0xFF] ^ s1[c & 0xFF] ^ s2[c >> 24] ^ s3[c >> 16 & 0xFF]
+                d = s0[d & 0xFF] ^ s1[d >> 24] ^ s2[d >> 16 & 0xFF] ^ s3[d >> 8 & 0xFF]
+                e = s0[e >> 24] ^ s1[e >> 16 & 0xFF] ^ s2[e >> 8 & 0xFF] ^ s3[e & 0xFF]
+                t = a + b + c + d + e
+                out.append((a + t + lfsr[p + 18]) & 0xFFFFFFFF)
+                out.append((b + t + lfsr[p + 16]) & 0xFFFFFFFF)
+                out.append((c + t + lfsr[p + 12]) & 0xFFFFFFFF)
+                out.append((d + t + lfsr[p + 5]) & 0xFFFFFFFF)
+                out.append((t + lfsr[p + 4]) & 0xFFFFFFFF)
+
+            del lfsr[: 5 * batch]
+            done += batch
+
+        return out
 
     def _round(self) -> bytes:
         """ A single round """
-        self._step()
-        things = _mixwords([self.lfsr[n] for n in (16, 13, 6, 1, 0)])
-        things = _mixwords(
-            [self._strans(i, n) for i, n in zip(things, (0, 1, 2, 3, 0))]
-        )
-        self._step(3)
-        things = [
-            (i + self.lfsr[n]) & 0xFFFFFFFF for i, n in zip(things, (14, 12, 8, 1, 0))
-        ]
-        self._step()
-        return pack(">5L", *things)
+        return pack(">5L", *self._rounds(1))
+
+    def keystream(self, rounds: int, skip_rounds: int = 0) -> bytes:
+        """ Return the output of rounds rounds (20 bytes each), after
+            discarding skip_rounds rounds.
+
+        """
+        words = self._rounds(rounds, skip_rounds)
+        return pack(">%dL" % len(words), *words)
 
     def gen(self, skip: int, length: int) -> bytes:
         """ Generate length characters of output, skipping the first
             skip characters.
 
         """
+        skip_rounds = 0
         while skip > 20:
-            self._step(5)
+            skip_rounds += 1
             skip -= 20
-        buf = b""
-        while len(buf) < length + skip:
-            buf += self._round()
+        buf = self.keystream(-(-(length + skip) // 20), skip_rounds)
         return buf[skip : length + skip]
 
     def crypt(self, source: bytes, skip: int = 0) -> bytes:
@@ -410,8 +475,45 @@ class Turing:
             data.
 
         """
-        xor_data = self.gen(skip, len(source))
-        fmt = "%dB" % len(source)
-        d2 = unpack(fmt, source)
-        x2 = unpack(fmt, xor_data)
-        return pack(fmt, *(a ^ b for a, b in zip(d2, x2)))
+        length = len(source)
+        xor_data = self.gen(skip, length)
+        return (
+            int.from_bytes(source, "big") ^ int.from_bytes(xor_data, "big")
+        ).to_bytes(length, "big")
+
+
+if __name__ == "__main__":
+    # Self-check against keystream recorded from the original
+    # list-rotating implementation, then report throughput.
+    import hashlib
+    import time
+
+    h = hashlib.sha1()
+    for seed in range(4):
+        t = Turing(
+            hashlib.sha1(b"key%d" % seed).digest(),
+            hashlib.sha1(b"iv%d" % seed).digest(),
+        )
+        data = bytes(range(256)) * 20
+        for skip, length in [
+            (0, 1),
+            (0, 20),
+            (3, 17),
+            (25, 100),
+            (0, 5000),
+            (41, 333),
+            (0, 0),
+            (19, 1),
+        ]:
+            h.update(t.crypt(data[:length], skip))
+        h.update(t.gen(7, 64))
+    assert h.hexdigest() == "c40becf7a09ce0c03e0d667e8acfac86c2a8a9d8", "bad keystream"
+    print("keystream OK")
+
+    for size in (1 << 12, 1 << 16, 1 << 20):
+        data = bytes(size)
+        t = Turing(b"\x01" * 20, b"\x02" * 20)
+        start = time.perf_counter()
+        t.crypt(data)
+        elapsed = time.perf_counter() - start
+        print("crypt %8d bytes: %6.2f MB/s" % (size, size / elapsed / 1e6))
@@ -0,0 +1,116 @@
+"""Container pages rendered item by item.
+
+A container page is a head, one fragment per item and CONTAINER_TAIL.
+Rendering the items separately lets a fragment be reused while the file it
+describes is unchanged, and lets a long listing go out as it is rendered,
+with chunked encoding, instead of being built up as one string first.
+"""
+
+import time
+import zlib
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Iterable, List
+
+from pytivo.lrucache import CacheKeyError, LockedLRUCache
+import pytivo.metrics
+
+if TYPE_CHECKING:
+    from pytivo.httpserver import TivoHTTPHandler
+
+CONTAINER_TAIL = "</TiVoContainer>\n"
+
+# pages with fewer items are sent whole, with a Content-Length
+STREAM_MIN_ITEMS = 100
+
+CHUNK_SIZE = 0x10000
+
+# a fragment is rerendered after this long even if its stamp still matches,
+# to pick up changes the stamp can't see, such as edited metadata files
+FRAGMENT_TTL = 300
+
+
+class FragmentCache:
+    def __init__(self, size: int) -> None:
+        self.cache = LockedLRUCache(size)
+
+    def render(self, key: Any, stamp: Any, render: Callable[[], str]) -> bytes:
+        """The fragment for key, from the cache if it was rendered from the
+        same stamp, else from render()."""
+        try:
+            cached_stamp, body = self.cache[key]
+            fresh = self.cache.mtime(key) + FRAGMENT_TTL > time.time()
+            if cached_stamp == stamp and fresh:
+                pytivo.metrics.cache_lookup("fragment", True)
+                return body
+        except CacheKeyError:
+            pass
+        pytivo.metrics.cache_lookup("fragment", False)
+        body = render().encode("utf-8")
+        self.cache[key] = (stamp, body)
+        return body
+
+
+class ChunkedWriter:
+    """Write a body with chunked transfer encoding, gzipped if asked, in
+    chunks of about CHUNK_SIZE."""
+
+    def __init__(self, wfile: BinaryIO, gzipped: bool) -> None:
+        self.wfile = wfile
+        # wbits 31: gzip framing, as Content-Encoding: gzip expects
+        self.compressor = zlib.compressobj(wbits=31) if gzipped else None
+        self.pending: List[bytes] = []
+        self.pending_size = 0
+
+    def write(self, data: bytes) -> None:
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= CHUNK_SIZE:
+                self.flush()
+
+    def flush(self) -> None:
+        if self.pending_size:
+            self.wfile.write(b"%x\r\n" % self.pending_size)
+            self.wfile.write(b"".join(self.pending))
+            self.wfile.write(b"\r\n")
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self) -> None:
+        if self.compressor is not None:
+            self.pending.append(self.compressor.flush())
+            self.pending_size += len(self.pending[-1])
+        self.flush()
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def join_page(head: str, items: Iterable[bytes]) -> bytes:
+    return b"".join([head.encode("utf-8"), *items, CONTAINER_TAIL.encode("utf-8")])
+
+
+def send_page(
+    handler: "TivoHTTPHandler", head: str, items: Iterable[bytes], count: int
+) -> None:
+    """Send a container page of count items. Short pages go out whole;
+    longer ones are streamed, each item rendered as it is written."""
+    if count < STREAM_MIN_ITEMS:
+        handler.send_fixed(join_page(head, items), "text/xml")
+        return
+
+    gzipped = "gzip" in handler.headers.get("Accept-Encoding", "")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/xml")
+    handler.send_header("Transfer-Encoding", "chunked")
+    if gzipped:
+        handler.send_header("Content-Encoding", "gzip")
+    handler.send_header("Expires", "0")
+    handler.end_headers()
+
+    writer = ChunkedWriter(handler.wfile, gzipped)
+    writer.write(head.encode("utf-8"))
+    for item in items:
+        writer.write(item)
+    writer.write(CONTAINER_TAIL.encode("utf-8"))
+    writer.close()
@@ -0,0 +1,22 @@
+import gzip
+
+from pytivo.responsecache import ResponseCache, gzip_body
+
+BODY = b"<TiVoContainer>" + b"<Item/>" * 100 + b"</TiVoContainer>"
+
+
+def test_gzip_body_is_deterministic():
+    first = gzip_body(BODY)
+    assert gzip_body(BODY) == first
+    # no timestamp in the header, so the bytes don't change over time
+    assert first[4:8] == b"\0\0\0\0"
+    assert gzip.decompress(first) == BODY
+
+
+def test_store_gzips_large_bodies_only():
+    cache = ResponseCache(2)
+    response = cache.store("big", 1, BODY)
+    assert response.gzipped == gzip_body(BODY)
+    assert cache.store("small", 1, b"<x/>").gzipped is None
+    assert cache.lookup("big", 1) == response
+    assert cache.lookup("big", 2) is None